@@ -4,19 +4,37 @@
 # http request(question) -> FastAPI receives it -> answer_question() runs
 # retriver + LLM --> answer -> returns JSON with {answer, source, latency}
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
+import asyncio
+import fcntl
+import json
 import os
 import boto3
+import hashlib
+import shutil
 import tempfile
+import time
+import numpy as np
+from pathlib import Path
 
 from themind.embedder import Embedder
-from themind.store import StoreKnowledge
+from themind.store import EmbeddingMismatchError, StoreKnowledge
+from themind.shards import is_shard_file
+from themind.delta import DELTA_STATE_NAME, is_delta_file
+from themind.chunking import chunk_spans
+from themind.loaders import load_document
 from themind.retrieve import Retriever
 from themind.llm_provider import LLMProvider
-from themind.rag import answer_question
-from themind import ingest
+from themind.rag import aanswer_question, answer_questions, astream_answer_question
+from themind.tenant_cache import TenantCache
+from themind.answer_cache import AnswerCache
+from themind.jobs import JobManager, ThreadPoolBackend
+from themind.s3_transfer import S3Transfer, make_client
+from themind import ingest, memory, metrics
 
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
@@ -28,46 +46,157 @@ session = boto3.session.Session(
     aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
     region_name=AWS_DEFAULT_REGION,
 )
-s3 = session.client("s3")
+s3 = make_client(session)
+# shared pool for every bulk download/upload, tenants loading in parallel share it too
+transfer = S3Transfer.from_env(s3, S3_BUCKET_NAME)
 
 # on startup get the global components (set as None, dont eat the ram away)
 embedder = None
-store = None
-retriever = None
 llm = None
 
+# downloaded tenant indexes, one folder per tenant shared by all workers on the host
+TENANT_DATA_DIR = os.getenv("TENANT_DATA_DIR", "/tmp")
+
+# loaded stores + retrievers per (env, user_id), budget is roughly the size of the index files
+tenant_cache = TenantCache(
+    max_bytes=int(os.getenv("TENANT_CACHE_MAX_MB", "1024")) * 1024 * 1024,
+    check_interval=float(os.getenv("TENANT_CACHE_CHECK_SECONDS", "5")),
+)
+
+# near identical questions for the same tenant + index version skip the LLM
+# ANSWER_CACHE_MAX_ENTRIES=0 turns it off
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2048"))
+answer_cache = AnswerCache(
+    threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97")),
+    ttl_seconds=float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600")),
+    max_entries=ANSWER_CACHE_MAX_ENTRIES,
+) if ANSWER_CACHE_MAX_ENTRIES > 0 else None
+
+# ingests run in the background, at most INGEST_WORKERS at once and one per tenant
+ingest_jobs = JobManager(ThreadPoolBackend(max_workers=int(os.getenv("INGEST_WORKERS", "2"))))
+INGEST_ATTEMPTS = 3 # builds before giving up on a tenant whose documents keep changing
+
+def list_objects(prefix: str) -> list[dict]:
+    """every object under prefix, list_objects_v2 only gives 1000 per page"""
+    return transfer.list_objects(prefix)
+
+def index_fingerprint(objects: list[dict]) -> tuple:
+    # ETag changes when the content changes, LastModified when someone re-uploads
+    return tuple(sorted(
+        (obj["Key"], obj.get("ETag", ""), str(obj.get("LastModified", ""))) for obj in objects
+    ))
+
+@contextmanager
+def tenant_lock(env: str, user_id: str, kind: str = "load"):
+    """exclusive per tenant lock shared by every process on this host (not across hosts)
+    "load": downloading / opening a version folder, "mutate": changing the tenant's index"""
+    os.makedirs(TENANT_DATA_DIR, exist_ok=True)
+    with open(os.path.join(TENANT_DATA_DIR, f"{env}-{user_id}.{kind}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+def reuse_files(tenant_dir: str, local_dir: str, etags: dict[str, str]) -> set[str]:
+    """hardlink files an older version folder already has with the same ETag, so a
+    document change only downloads the delta and not the whole build again"""
+    reused = set()
+    for name in os.listdir(tenant_dir):
+        old_dir = os.path.join(tenant_dir, name)
+        try:
+            with open(os.path.join(old_dir, ".objects.json"), "r", encoding="utf-8") as f:
+                old = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for filename, etag in etags.items():
+            src = os.path.join(old_dir, filename)
+            dst = os.path.join(local_dir, filename)
+            if filename in reused or old.get(filename) != etag or not os.path.exists(src):
+                continue
+            if not os.path.exists(dst):
+                os.link(src, dst) # same inode, a worker that mapped the old one shares the pages too
+            reused.add(filename)
+    return reused
+
+def load_tenant(user_id: str, env: str, objects: list[dict], version: tuple):
+    # every version gets its own folder so a reload never overwrites files a loaded store uses
+    # the folder is the same for every uvicorn worker on this host, they all mmap the same
+    # files and share the pages (indexing.read_index, memory.py)
+    tenant_dir = os.path.join(TENANT_DATA_DIR, f"{env}-{user_id}")
+    version_id = hashlib.sha1(repr(version).encode()).hexdigest()[:12]
+    local_dir = os.path.join(tenant_dir, version_id)
+    os.makedirs(local_dir, exist_ok=True)
+    keys = {os.path.basename(obj["Key"]): obj["Key"] for obj in objects}
+    etags = {os.path.basename(obj["Key"]): obj.get("ETag", "") for obj in objects}
+
+    def fetch_shard(name: str):
+        # under a temp name first, another worker can be pulling the same shard right now
+        path = os.path.join(local_dir, name)
+        part = f"{path}.{os.getpid()}.part"
+        transfer.download_many([(keys[name], part)])
+        os.replace(part, path)
+
+    # the lock is across processes: one worker downloads, the others wait and then map
+    # what it downloaded, and nobody deletes a version while another worker is opening it
+    # (once opened, deleting is fine, the mapping keeps the file alive)
+    with tenant_lock(env, user_id):
+        # if we already pulled this version (eg. it was evicted) dont download again
+        # shards of a big index are left for fetch_shard, the first search that needs one pulls it
+        complete_marker = os.path.join(local_dir, ".complete")
+        if not os.path.exists(complete_marker):
+            reused = reuse_files(tenant_dir, local_dir, etags)
+            transfer.download_many([(obj["Key"], os.path.join(local_dir, os.path.basename(obj["Key"])))
+                                    for obj in objects if os.path.basename(obj["Key"]) not in reused
+                                    and not is_shard_file(os.path.basename(obj["Key"]))])
+            with open(os.path.join(local_dir, ".objects.json"), "w", encoding="utf-8") as f:
+                json.dump(etags, f)
+            open(complete_marker, "w").close()
+
+        # older versions are not needed anymore
+        for name in os.listdir(tenant_dir):
+            if name != version_id:
+                shutil.rmtree(os.path.join(tenant_dir, name), ignore_errors=True)
+
+        # now we expect the index and the chunk metadata to exist
+        store = StoreKnowledge.from_dir(local_dir, fetch=fetch_shard)
+        with metrics.stage("tenant.load"):
+            store.load()
+    store.version = version_id
+    if os.getenv("SEARCH_RERANK"):
+        store.rerank_factor = int(os.environ["SEARCH_RERANK"]) # candidates per result, 1 turns the rerank off
+
+    retriever = Retriever(store=store, embedder=embedder, top_k=3,
+                          nprobe=int(os.environ["SEARCH_NPROBE"]) if os.getenv("SEARCH_NPROBE") else None,
+                          ef_search=int(os.environ["SEARCH_EF"]) if os.getenv("SEARCH_EF") else None)
+    nbytes = sum(obj.get("Size", 0) for obj in objects)
+    return retriever, nbytes
+
 # lazy loadings more effective
 def get_pipeline(user_id: str, env: str):
-    global embedder, store, retriever, llm
+    global embedder, llm
     if embedder is None:
         embedder = Embedder()
 
     if llm is None:
         llm = LLMProvider()
 
-    local_dir = f"/tmp/{env}-{user_id}"
-    os.makedirs(local_dir, exist_ok=True)
-    local_index_path = os.path.join(local_dir, "faiss.index")
-    local_chunks_path = os.path.join(local_dir, "chunks.jsonl")
-
-    if not (os.path.exists(local_index_path) and os.path.exists(local_chunks_path)):
-        prefix = f"{env}/users/{user_id}/indexes/"
-        resp = s3.list_objects_v2(Bucket=S3_BUCKET_NAME, Prefix=prefix)
-        for obj in resp.get("Contents", []):
-            key = obj["Key"]
-            if key.endswith("/"):
-                continue
-            fname = os.path.basename(key)
-            s3.download_file(S3_BUCKET_NAME, key, os.path.join(local_dir, fname))
-
-    # now we expect those 2 files to exist
-    store = StoreKnowledge(
-        index_path=local_index_path,
-        chunks_path=local_chunks_path,
-    )
-    store.load()
-
-    retriever = Retriever(store=store, embedder=embedder, top_k=3)
+    prefix = f"{env}/users/{user_id}/indexes/"
+    listing = {}
+
+    def fingerprint():
+        with metrics.stage("tenant.list"):
+            listing["objects"] = list_objects(prefix)
+        return index_fingerprint(listing["objects"])
+
+    def load(version):
+        if not listing["objects"]:
+            raise HTTPException(status_code=404, detail=f"{user_id} has no index, upload docs and run /ingest")
+        return load_tenant(user_id, env, listing["objects"], version)
+
+    try:
+        with metrics.stage("tenant.get"): # all of the above, near zero when the tenant is warm
+            retriever = tenant_cache.get((env, user_id), fingerprint, load)
+    except EmbeddingMismatchError as e:
+        # the tenant index needs a re-ingest with the backend this api runs
+        raise HTTPException(status_code=409, detail=str(e))
     return retriever, llm
 
 """you load your embedding model ONCE not every request
@@ -79,7 +208,17 @@ and IMPORTANTLY:
 # expose RAG pipepline thorugh HTTP so me or anyone cna ask questions to it from anywhere
 # adding metadata onto the API, makes it clearer for it to be used in the future
 # this will appear in swagger ui in /docs and /openai.json 
-app = FastAPI(title="MegaMind-Rag", summary="Context specific response using RAG",
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    ingest_jobs.shutdown()
+    # close the pooled http connections on shutdown
+    if llm is not None:
+        await llm.aclose()
+    if embedder is not None:
+        await embedder.aclose()
+
+app = FastAPI(lifespan=lifespan, title="MegaMind-Rag", summary="Context specific response using RAG",
                description="An api which gives context specific" \
 " response for specialized domains using retrieval augmented generation in unison " \
 "with modern GenAI", version="1.618")
@@ -98,10 +237,31 @@ class AskRequest(BaseModel):
     question: str
     user_id: str
     env: str = None
+    doc_names: list[str] | None = None # only answer from these documents
+    timings: bool = False # add timings_ms, where the time went per stage
+    max_context_tokens: int | None = None # prompt context budget, default CONTEXT_MAX_TOKENS
+
+class AskBatchRequest(BaseModel):
+    questions: list[str]
+    user_id: str
+    env: str | None = None
+    generate: bool = True # False -> only retrieval, no LLM calls
+    doc_names: list[str] | None = None
+    timings: bool = False
+    max_context_tokens: int | None = None
 
 class IngestRequest(BaseModel):
     user_id: str
     env: str | None = None
+    index_type: str | None = None # flat / hnsw / ivf / ivfpq, default picks by corpus size
+    compression: str | None = None # none / fp16 / sq8 / pq, smaller index to download and hold
+    keep_vectors: bool | None = None # keep the full vectors too so results get reranked exactly
+    shard_rows: int | None = None # split bigger indexes into shards of this many vectors, 0 never
+
+class DocumentRequest(BaseModel):
+    user_id: str
+    env: str | None = None
+    doc_name: str # file name under {env}/users/{user_id}/docs/
 
 
 # define a GET endpoint
@@ -109,60 +269,316 @@ class IngestRequest(BaseModel):
 def health_check():
     return {"status": "healthy"}
 
+# cache counters so we can see how much work (and money) we are saving
+@app.get("/stats")
+def stats():
+    return {
+        "tenant_cache": tenant_cache.stats(),
+        "embedding": embedder.describe() if embedder is not None else None,
+        "embedding_cache": embedder.cache.stats() if embedder is not None and embedder.cache else None,
+        "answer_cache": answer_cache.stats() if answer_cache is not None else None,
+        "llm_transport": llm.transport.stats() if llm is not None else None,
+        "ingest_jobs": ingest_jobs.stats(),
+        "s3_transfer": transfer.stats(),
+    }
+
+# memory of this worker (each request lands on one of them, pid says which): how much is
+# mapped from shared index files vs private, per loaded tenant and artifact
+@app.get("/stats/memory")
+def memory_stats():
+    tenants = []
+    for (env, user_id), retriever, _ in tenant_cache.items():
+        tenants.append({"env": env, "user_id": user_id, "version": retriever.store.version,
+                        "artifacts": retriever.store.artifacts()})
+    paths = [a["path"] for t in tenants for a in t["artifacts"].values() if a["mapped"]]
+    report = memory.process_report(paths)
+    files = report.pop("files", {})
+    for tenant in tenants:
+        for artifact in tenant["artifacts"].values():
+            artifact.update(files.get(os.path.realpath(artifact["path"]), {}))
+    return {**report, "tenants": tenants}
+
+# the same numbers plus the stage histograms and counters (metrics.py) for prometheus
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    current = stats()
+    current.pop("embedding") # labels, not numbers
+    body = metrics.REGISTRY.render() + "".join(metrics.render_stats(name, value) for name, value in current.items())
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4")
+
+# async so one slow LLM call doesnt hold up everyone else, loading the tenant (S3 + disk)
+# runs in a thread and the LLM/embedding calls are awaited on pooled connections
 @app.post("/ask")
-def ask(request: AskRequest):
+async def ask(request: AskRequest):
     env = request.env or "prod"
-    retriever, llm = get_pipeline(request.user_id, env)
-    response = answer_question(question=request.question, retriever=retriever, llm=llm)
+    with metrics.collect_timings() if request.timings else nullcontext() as timings, metrics.stage("ask"):
+        retriever, llm = await asyncio.to_thread(get_pipeline, request.user_id, env)
+        response = await aanswer_question(question=request.question, retriever=retriever, llm=llm,
+                                          cache=answer_cache, tenant=(env, request.user_id),
+                                          doc_names=request.doc_names,
+                                          max_context_tokens=request.max_context_tokens)
+    if timings is not None:
+        response["timings_ms"] = metrics.rounded(timings)
     return response
 # fast api turns JSON request into Python object of type AskRequest
 # the returned dictionary is returned as a HTTP response, then FastAPI converts it to JSON
 
+# same as /ask but as server-sent events, the UI can show sources and the first words
+# while the LLM is still writing instead of waiting for the whole answer
+@app.post("/ask/stream")
+async def ask_stream(request: AskRequest):
+    env = request.env or "prod"
+    retriever, llm = await asyncio.to_thread(get_pipeline, request.user_id, env)
+
+    async def events():
+        try:
+            with metrics.collect_timings() if request.timings else nullcontext() as timings:
+                async for event, data in astream_answer_question(request.question, retriever=retriever, llm=llm,
+                                                                 cache=answer_cache, tenant=(env, request.user_id),
+                                                                 doc_names=request.doc_names,
+                                                                 max_context_tokens=request.max_context_tokens):
+                    if event == "done" and timings is not None:
+                        data["timings_ms"] = metrics.rounded(timings) # tenant loading happened before the stream
+                    yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+        except Exception as e:
+            # headers are long gone by now, the only way to tell the client is another event
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+# many questions for one tenant, retrieval runs as one batch, generation is optional
+@app.post("/ask_batch")
+async def ask_batch(request: AskBatchRequest):
+    env = request.env or "prod"
+    time_start = time.perf_counter()
+    with metrics.collect_timings() if request.timings else nullcontext() as timings:
+        retriever, llm = await asyncio.to_thread(get_pipeline, request.user_id, env)
+        answers = await asyncio.to_thread(
+            answer_questions, request.questions, retriever=retriever, llm=llm, generate=request.generate,
+            max_workers=int(os.getenv("ASK_BATCH_WORKERS", "4")), doc_names=request.doc_names,
+            max_context_tokens=request.max_context_tokens,
+        )
+    response = {
+        "answers": answers,
+        "latency_ms": int((time.perf_counter() - time_start) * 1000),
+    }
+    if timings is not None:
+        response["timings_ms"] = metrics.rounded(timings)
+    return response
+
+# downloads, parsing, embedding and uploads take minutes, way longer than a client wants
+# to hold a request open. /ingest queues a job and answers straight away, poll the
+# status with GET /ingest/{job_id}. clicking twice gives back the job already running
 @app.post("/ingest")
-def ingest_user_docs(request: IngestRequest):
+async def ingest_user_docs(request: IngestRequest):
+    env = request.env or "prod"
+    job, created = ingest_jobs.submit((env, request.user_id),
+                                      lambda progress: run_user_ingest(request, progress), kind="ingest")
+    return {
+        "status": "queued" if created else "already_running",
+        "job_id": job.id,
+        "state": job.state,
+        "status_url": f"/ingest/{job.id}",
+    }
+
+@app.get("/ingest/{job_id}")
+def ingest_status(job_id: str):
+    job = ingest_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"no ingest job {job_id}")
+    return job.to_dict()
+
+@app.get("/ingest")
+def ingest_history(user_id: str, env: str | None = None):
+    """recent ingest jobs of a tenant, newest first"""
+    jobs = ingest_jobs.list_jobs(key=(env or "prod", user_id))
+    return {"jobs": [job.to_dict() for job in reversed(jobs)]}
+
+# one document changed: upload it under docs/ as usual and call upsert, or call remove
+# (that deletes it from docs/ too). only that document is parsed and embedded, it lands
+# in the tenant's delta (themind/delta.py) and the next /ask sees it. once the delta is
+# big a compaction (a normal re-ingest, shows up in GET /ingest) folds it into a new build
+@app.post("/documents/upsert")
+async def upsert_document(request: DocumentRequest):
+    return await asyncio.to_thread(change_document, request, False)
+
+@app.post("/documents/remove")
+async def remove_document(request: DocumentRequest):
+    return await asyncio.to_thread(change_document, request, True)
+
+def run_user_ingest(request: IngestRequest, progress=None):
+    # a document change landing mid build (/documents/*) means building again, unchanged
+    # docs come from the previous build so the next attempt only embeds what changed
+    for _ in range(INGEST_ATTEMPTS):
+        result = _run_user_ingest(request, progress)
+        if result is not None:
+            return result
+    raise RuntimeError(f"documents kept changing during {INGEST_ATTEMPTS} ingest attempts, run it again")
+
+def _run_user_ingest(request: IngestRequest, progress=None) -> dict | None:
+    """None when the delta changed under us and nothing was published"""
+    progress = progress or (lambda stage, **counters: None)
     env = request.env or "prod"
     prefix = f"{env}/users/{request.user_id}/docs/"
 
-    objects: list[dict] = []
-    continuation_token = None # page marker 
+    progress("listing")
+    objects = list_objects(prefix)
+    index_prefix = f"{env}/users/{request.user_id}/indexes/"
+    index_objects = list_objects(index_prefix)
 
-    while True:
-        kwargs = {"Bucket": S3_BUCKET_NAME, "Prefix": prefix}
-        if continuation_token:
-            kwargs["ContinuationToken"] = continuation_token
-
-        resp = s3.list_objects_v2(**kwargs)
-        if "Contents" in resp:
-            objects.extend(resp["Contents"])
-
-        if resp.get("IsTruncated"):
-            continuation_token = resp.get("NextContinuationToken")
-        else:
-            break
-
-    if not objects:
+    # no docs but an index -> every doc was deleted, the run below removes the index too
+    if not objects and not index_objects:
         return {"status": "ok", "message": f"no docs found under {prefix}"}
+    # documents changed while we build -> their delta is not in this build, see the upload
+    delta_etag = _delta_etag(index_objects)
 
-    with tempfile.TemporaryDirectory() as tmp_docs_dir:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_docs_dir = os.path.join(tmp_dir, "docs")
+        tmp_out_dir = os.path.join(tmp_dir, "data")
+        os.makedirs(tmp_docs_dir, exist_ok=True)
+        os.makedirs(tmp_out_dir, exist_ok=True)
+
+        # pull the previous build so unchanged docs keep their vectors, not its delta
+        # (changed docs are in docs/ with a new ETag and get embedded again anyway)
+        progress("downloading", docs_total=len(objects))
+        transfers = {"index_download": transfer.download_many(
+            [(obj["Key"], os.path.join(tmp_out_dir, os.path.basename(obj["Key"])))
+             for obj in index_objects if not is_delta_file(os.path.basename(obj["Key"]))])}
+        manifest_docs = ingest.load_manifest(tmp_out_dir).get("docs", {})
+
+        # the ETag is our fingerprint, only download what is new or changed
+        fingerprints: dict[str, str] = {}
+        to_download = []
         for obj in objects:
             key = obj["Key"]
-            if key.endswith("/"):
+            doc_name = os.path.basename(key)
+            fingerprints[doc_name] = obj.get("ETag", "").strip('"')
+            prev = manifest_docs.get(doc_name)
+            if prev is not None and prev["fingerprint"] == fingerprints[doc_name]:
                 continue
-            local_path = os.path.join(tmp_docs_dir, os.path.basename(key))
-            s3.download_file(S3_BUCKET_NAME, key, local_path)
-
-        tmp_out_dir = os.path.join(tmp_docs_dir, "data")
-        os.makedirs(tmp_out_dir, exist_ok=True)
-
-        ingest.run_ingest(docs_dir=tmp_docs_dir, out_dir=tmp_out_dir)
-
-        # copy the information to permanent memory
-        index_prefix = f"{env}/users/{request.user_id}/indexes/"
-        for filename in os.listdir(tmp_out_dir):
-            full_path = os.path.join(tmp_out_dir, filename)
-            s3.upload_file(full_path, S3_BUCKET_NAME, index_prefix + filename)
+            to_download.append((key, os.path.join(tmp_docs_dir, doc_name)))
+        transfers["docs_download"] = transfer.download_many(
+            to_download, progress=lambda files, nbytes: progress("downloading", files_downloaded=files,
+                                                                 bytes_downloaded=nbytes))
+
+        # the checkpoint lives next to the tenant folders not in tmp_dir, so a job that died
+        # (killed worker, an embedding error) resumes where it stopped the next time it runs.
+        # the lock keeps a second worker on this host out of the same work dir
+        with tenant_lock(env, request.user_id, "ingest"):
+            report = ingest.run_ingest(docs_dir=tmp_docs_dir, out_dir=tmp_out_dir, fingerprints=fingerprints,
+                                       index_type=request.index_type, progress=progress,
+                                       compression=request.compression, keep_vectors=request.keep_vectors,
+                                       shard_rows=request.shard_rows,
+                                       work_dir=os.path.join(TENANT_DATA_DIR, f"{env}-{request.user_id}.ingest-work"))
+
+        # copy the information to permanent memory, if nothing changed the old files stay
+        # as they are which also keeps every loaded copy of the index warm
+        changed = report["changed"]
+        with tenant_lock(env, request.user_id, "mutate"):
+            current = list_objects(index_prefix)
+            if _delta_etag(current) != delta_etag:
+                return None
+            if changed:
+                progress("uploading")
+                uploads = [(os.path.join(tmp_out_dir, filename), index_prefix + filename)
+                           for filename in os.listdir(tmp_out_dir)
+                           if os.path.isfile(os.path.join(tmp_out_dir, filename))]
+                transfers["index_upload"] = transfer.upload_many(uploads)
+                uploaded = {key for _, key in uploads}
+
+                # files an older build left behind (eg. chunks.jsonl, the delta it folded in)
+                # would just get downloaded for nothing
+                stale = [obj["Key"] for obj in current if obj["Key"] not in uploaded]
+                transfer.delete_many(stale)
+            elif delta_etag is not None:
+                # the docs are what the build has, whatever the delta held adds nothing
+                transfer.delete_many([obj["Key"] for obj in current if is_delta_file(os.path.basename(obj["Key"]))])
+                changed = True
+
+    # next /ask should pick up the new index straight away not after the check interval
+    # and none of the answers built from the old one should be served again
+    if changed:
+        tenant_cache.invalidate((env, request.user_id))
+        if answer_cache is not None:
+            answer_cache.invalidate((env, request.user_id))
 
     return {"status": "ok", "message": f"ingestion completed for {request.user_id}",
             "indexes_prefix": index_prefix,
+            "report": report,
+            "transfers": transfers,
             }
 
+
+def _delta_etag(index_objects: list[dict]) -> str | None:
+    for obj in index_objects:
+        if os.path.basename(obj["Key"]) == DELTA_STATE_NAME:
+            return obj.get("ETag")
+    return None
+
+def change_document(request: DocumentRequest, remove: bool) -> dict:
+    """add / replace / remove one document in the tenant's delta and upload the delta"""
+    time_start = time.perf_counter()
+    env = request.env or "prod"
+    key = (env, request.user_id)
+    doc_name = os.path.basename(request.doc_name)
+    doc_key = f"{env}/users/{request.user_id}/docs/{doc_name}"
+    index_prefix = f"{env}/users/{request.user_id}/indexes/"
+
+    # one change at a time per tenant, each starts from the delta the last one uploaded
+    with tenant_lock(env, request.user_id, "mutate"):
+        tenant_cache.invalidate(key) # whatever is cached may be older than S3
+        if not list_objects(index_prefix):
+            raise HTTPException(status_code=409, detail=f"{request.user_id} has no index yet, run /ingest first")
+        retriever, _ = get_pipeline(request.user_id, env)
+        # our own copy, queries keep using the cached one until the new delta is uploaded
+        local_dir = Path(retriever.store.index_path).parent
+        store = StoreKnowledge.from_dir(local_dir, fetch=retriever.store.fetch)
+        store.load()
+        manifest = ingest.load_manifest(str(local_dir))
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if remove:
+                if not store.remove_document(doc_name):
+                    raise HTTPException(status_code=404, detail=f"{doc_name} is not in the index")
+                chunks = 0
+            else:
+                path = os.path.join(tmp_dir, doc_name)
+                try:
+                    transfer.download_many([(doc_key, path)])
+                except Exception:
+                    raise HTTPException(status_code=404, detail=f"no document {doc_key}")
+                with metrics.stage("document.parse"):
+                    doc = load_document(Path(path))
+                    text = doc["text"] if doc is not None else ""
+                    texts = [text[start:end] for start, end in chunk_spans(len(text))]
+                with metrics.stage("document.embed"):
+                    vectors = embedder.encode(texts) if texts else np.empty((0, store.index.d), dtype="float32")
+                store.replace_document(doc_name, vectors, texts)
+                chunks = len(texts)
+
+            with metrics.stage("document.upload"):
+                files = store.save_delta(tmp_dir)
+                state = [f for f in files if os.path.basename(f) == DELTA_STATE_NAME]
+                # delta.json last, it is what compaction watches and says which rows are gone
+                transfer.upload_many([(f, index_prefix + os.path.basename(f)) for f in files if f not in state])
+                transfer.upload_many([(f, index_prefix + os.path.basename(f)) for f in state])
+            if remove:
+                transfer.delete_many([doc_key]) # so the next build doesnt bring it back
+
+    tenant_cache.invalidate(key)
+    if answer_cache is not None:
+        answer_cache.invalidate(key)
+
+    compaction = None
+    if store.needs_compaction():
+        # same index settings as the build it replaces, not whatever the env defaults are
+        options = {name: manifest[name] for name in ("index_type", "compression", "keep_vectors", "shard_rows")
+                   if name in manifest}
+        job, _ = ingest_jobs.submit(key, lambda progress: run_user_ingest(
+            IngestRequest(user_id=request.user_id, env=env, **options), progress), kind="compaction")
+        compaction = {"job_id": job.id, "status_url": f"/ingest/{job.id}"}
+
+    return {"status": "ok", "doc_name": doc_name, "action": "removed" if remove else "upserted",
+            "chunks": chunks, "delta": store.delta_stats(), "compaction": compaction,
+            "latency_ms": int((time.perf_counter() - time_start) * 1000)}
@@ -0,0 +1,141 @@
+# python -m benchmarks [--quick] [--only chunking,query] [--out results.json]
+# python -m benchmarks compare old.json new.json
+
+# runs the suites in suites.py on synthetic data with stub backends and writes one JSON
+# file per run (config + machine + git commit + results) so two runs can be diffed
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+SUITES = ["chunking", "ingest", "query", "ask"]
+
+# (full, quick) defaults, anything can be overridden on the command line
+DEFAULTS = {
+    "chunk_docs": (500, 50),
+    "words_per_doc": (3000, 1500),
+    "ingest_docs": ("50,200", "20"),
+    "index_sizes": ("10000,50000,200000", "5000,20000"),
+    "index_types": ("auto", "auto"),
+    "shard_rows": (0, 0), # > 0 splits the query benchmark indexes into shards of this many vectors
+    "dim": (256, 128),
+    "queries": (500, 200),
+    "ask_docs": (50, 10),
+    "ask_requests": (500, 100),
+    "concurrency": (16, 8),
+    "llm_ms": (0.0, 0.0),
+}
+
+
+def _machine() -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=Path(__file__).parent, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    import faiss
+    import numpy as np
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+        "faiss": faiss.__version__,
+    }
+
+
+def _ints(text: str) -> list[int]:
+    return [int(x) for x in str(text).split(",") if x]
+
+
+def run(args) -> dict:
+    from . import suites
+
+    only = args.only.split(",") if args.only else SUITES
+    unknown = set(only) - set(SUITES)
+    if unknown:
+        raise SystemExit(f"unknown suite {', '.join(sorted(unknown))}, use {SUITES}")
+
+    results = {}
+    for name in only:
+        print(f"[bench] {name} ...", file=sys.stderr)
+        start = time.perf_counter()
+        if name == "chunking":
+            results[name] = suites.bench_chunking(args.chunk_docs, args.words_per_doc, seed=args.seed)
+        elif name == "ingest":
+            results[name] = suites.bench_ingest(_ints(args.ingest_docs), args.words_per_doc, seed=args.seed)
+        elif name == "query":
+            results[name] = suites.bench_query(_ints(args.index_sizes), args.index_types.split(","), dim=args.dim,
+                                               n_queries=args.queries, shard_rows=args.shard_rows, seed=args.seed)
+        elif name == "ask":
+            results[name] = suites.bench_ask(args.ask_docs, args.words_per_doc, args.ask_requests,
+                                             args.concurrency, llm_ms=args.llm_ms, seed=args.seed)
+        print(f"[bench] {name} took {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+    config = {key: getattr(args, key) for key in DEFAULTS}
+    config.update(quick=args.quick, seed=args.seed)
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "machine": _machine(), "config": config,
+            "results": results}
+
+
+def _flatten(value, prefix: str = "") -> dict:
+    """numeric leaves as dotted paths"""
+    if isinstance(value, dict):
+        items = value.items()
+    else:
+        is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+        return {prefix: value} if is_number else {}
+    out = {}
+    for key, v in items:
+        out.update(_flatten(v, f"{prefix}.{key}" if prefix else key))
+    return out
+
+
+def compare(old_path: str, new_path: str):
+    with open(old_path, encoding="utf-8") as f:
+        old = _flatten(json.load(f)["results"])
+    with open(new_path, encoding="utf-8") as f:
+        new = _flatten(json.load(f)["results"])
+    width = max((len(k) for k in old.keys() | new.keys()), default=10)
+    for key in sorted(old.keys() | new.keys()):
+        a, b = old.get(key), new.get(key)
+        change = f"{(b - a) / a * 100:+.1f}%" if a and b is not None else ""
+        print(f"{key:<{width}}  {a!s:>12}  {b!s:>12}  {change:>8}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        if len(sys.argv) != 4:
+            raise SystemExit("usage: python -m benchmarks compare old.json new.json")
+        compare(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="ingest and query hot path benchmarks")
+    parser.add_argument("--quick", action="store_true", help="small sizes, a smoke run in about a minute")
+    parser.add_argument("--only", help=f"comma separated subset of {SUITES}")
+    parser.add_argument("--out", help="results file, default benchmarks/results/<time>.json")
+    parser.add_argument("--seed", type=int, default=0)
+    for key, (full, _) in DEFAULTS.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(full), default=None)
+    args = parser.parse_args()
+    for key, (full, quick) in DEFAULTS.items():
+        if getattr(args, key) is None:
+            setattr(args, key, quick if args.quick else full)
+
+    result = run(args)
+    out = Path(args.out or Path(__file__).parent / "results" / time.strftime("%Y%m%d-%H%M%S.json"))
+    out.parent.mkdir(parents=True, exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=1)
+    print(json.dumps(result["results"], indent=1))
+    print(f"[bench] wrote {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
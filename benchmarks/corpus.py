@@ -0,0 +1,64 @@
+# synthetic inputs for the benchmarks, same seed -> same corpus on every machine
+# words follow a zipf-ish distribution like real text so chunk sizes, the hashing
+# embedder and the parse/embedding caches behave roughly like they do on real docs
+
+from pathlib import Path
+import numpy as np
+
+_SYLLABLES = ["ka", "lo", "mi", "ne", "ru", "ta", "shi", "po", "ve", "dan", "tor", "el", "in", "ost", "ber", "qua"]
+
+
+def make_vocabulary(size: int = 5000, seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(_SYLLABLES, size=rng.integers(1, 5))))
+    return sorted(words)
+
+
+def make_text(rng: np.random.Generator, vocabulary: list[str], n_words: int) -> str:
+    """sentences of 5-25 words, a paragraph break every ~8 sentences"""
+    ranks = np.minimum(rng.zipf(1.3, size=n_words), len(vocabulary)) - 1
+    words = [vocabulary[r] for r in ranks]
+    parts = []
+    i = 0
+    sentence = 0
+    while i < n_words:
+        n = int(rng.integers(5, 26))
+        parts.append(" ".join(words[i:i + n]).capitalize() + ".")
+        i += n
+        sentence += 1
+        parts.append("\n\n" if sentence % 8 == 0 else " ")
+    return "".join(parts).strip()
+
+
+def make_texts(n_docs: int, words_per_doc: int, seed: int = 0) -> list[str]:
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(seed=seed)
+    # +-50% so documents dont all end on the same chunk boundary
+    sizes = rng.integers(words_per_doc // 2, words_per_doc * 3 // 2 + 1, size=n_docs)
+    return [make_text(rng, vocabulary, int(n)) for n in sizes]
+
+
+def write_corpus(out_dir: str, n_docs: int, words_per_doc: int, seed: int = 0) -> list[Path]:
+    """n_docs .txt files in out_dir, returns their paths"""
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for i, text in enumerate(make_texts(n_docs, words_per_doc, seed)):
+        path = out / f"doc{i:05d}.txt"
+        path.write_text(text, encoding="utf-8")
+        paths.append(path)
+    return paths
+
+
+def make_vectors(n: int, dim: int, seed: int = 0, clusters: int = 256) -> np.ndarray:
+    """unit vectors around a few hundred centers, closer to real embeddings than uniform noise"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype("float32")
+    out = np.empty((n, dim), dtype="float32")
+    for start in range(0, n, 65536):
+        m = min(65536, n - start)
+        block = centers[rng.integers(0, clusters, size=m)] + 0.5 * rng.standard_normal((m, dim)).astype("float32")
+        out[start:start + m] = block / np.linalg.norm(block, axis=1, keepdims=True)
+    return out
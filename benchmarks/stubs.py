@@ -0,0 +1,70 @@
+# stand-ins so a benchmark run needs no network, no API keys and no AWS account
+# embeddings come from the hashing backend (embedding_backends.py), the LLM is StubLLM
+# below and S3 is moto running in this process (pip install -r requirements-bench.txt)
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+
+BUCKET = "themind-bench"
+
+
+def use_stub_backends():
+    """env for everything that builds an Embedder itself (run_ingest, the api)"""
+    os.environ["EMBED_BACKEND"] = "hashing"
+    # caches would turn the second run into a cache benchmark, measure the real work
+    os.environ["EMBED_CACHE_PATH"] = "off"
+    os.environ["PARSE_CACHE_PATH"] = "off"
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+
+class StubLLM:
+    """same interface as LLMProvider, answers after latency_ms without calling anyone"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.model_name = "stub"
+        self.latency = latency_ms / 1000
+        self.calls = 0
+        self.transport = self # /stats asks llm.transport for its counters
+
+    def stats(self) -> dict:
+        return {"requests": self.calls}
+
+    def _answer(self, prompt: str) -> str:
+        self.calls += 1
+        return f"stub answer from a {len(prompt)} char prompt"
+
+    def generate_answer(self, prompt: str) -> str:
+        time.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def agenerate_answer(self, prompt: str) -> str:
+        await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def astream_answer(self, prompt: str):
+        await asyncio.sleep(self.latency)
+        for word in self._answer(prompt).split(" "):
+            yield word + " "
+
+    async def aclose(self):
+        pass
+
+
+@contextmanager
+def local_s3(bucket: str = BUCKET):
+    """moto in process, yields the bucket name. api.main has to be imported inside this"""
+    try:
+        from moto import mock_aws
+    except ImportError as e:
+        raise ImportError("the s3 benchmarks need moto, pip install -r requirements-bench.txt") from e
+
+    os.environ.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench",
+                      AWS_DEFAULT_REGION="eu-west-1", S3_BUCKET_NAME=bucket)
+    os.environ.pop("S3_ENDPOINT_URL", None) # moto patches the AWS endpoints only
+    with mock_aws():
+        import boto3
+        boto3.client("s3", region_name="eu-west-1").create_bucket(
+            Bucket=bucket, CreateBucketConfiguration={"LocationConstraint": "eu-west-1"})
+        yield bucket
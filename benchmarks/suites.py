@@ -0,0 +1,212 @@
+# the four things we measure, every function returns a plain dict that goes into the
+# results file as is. sizes come from the caller so a quick run and a full run use the
+# same code
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+import numpy as np
+
+from .corpus import make_texts, make_vectors, make_vocabulary, write_corpus
+from .stubs import StubLLM, local_s3, use_stub_backends
+
+
+def latency_summary(seconds: list[float]) -> dict:
+    ms = np.asarray(seconds) * 1000
+    return {
+        "count": int(len(ms)),
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "mean_ms": round(float(ms.mean()), 3),
+        "max_ms": round(float(ms.max()), 3),
+    }
+
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF) -> float:
+    peak = resource.getrusage(who).ru_maxrss
+    # linux reports KB, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def bench_chunking(n_docs: int, words_per_doc: int, repeat: int = 3, seed: int = 0) -> dict:
+    """chunks/sec and MB/sec of chunk_spans (what ingest uses) and chunk_text"""
+    from themind.chunking import chunk_spans, chunk_text
+
+    texts = make_texts(n_docs, words_per_doc, seed)
+    mb = sum(len(t.encode("utf-8")) for t in texts) / (1024 * 1024)
+    result = {"docs": n_docs, "mb": round(mb, 2)}
+    for name, fn in (("chunk_spans", lambda t: chunk_spans(len(t))), ("chunk_text", chunk_text)):
+        best = float("inf")
+        chunks = 0
+        for _ in range(repeat): # best of a few, the first one pays for warming up
+            start = time.perf_counter()
+            chunks = sum(len(fn(t)) for t in texts)
+            best = min(best, time.perf_counter() - start)
+        result[name] = {"seconds": round(best, 4), "chunks": chunks,
+                        "chunks_per_sec": round(chunks / best), "mb_per_sec": round(mb / best, 1)}
+    return result
+
+
+def _ingest_child(docs_dir: str, out_dir: str, index_type: str, results):
+    # runs in its own process so ru_maxrss is the peak of this ingest and nothing else
+    from themind.ingest import run_ingest
+
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        report = run_ingest(docs_dir, out_dir, index_type=index_type)
+    seconds = time.perf_counter() - start
+    results.put({
+        "seconds": round(seconds, 3),
+        "chunks": report["chunks_total"],
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": _peak_rss_mb(),
+        "peak_rss_parse_workers_mb": _peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "index_type": report["index"]["index_type"],
+    })
+
+
+def bench_ingest(doc_counts: list[int], words_per_doc: int, index_type: str = "auto", seed: int = 0) -> dict:
+    """docs/sec and peak RSS of a full run_ingest (parse, chunk, embed, build) per corpus size
+    keyed "<docs> docs" so two runs line up in compare"""
+    use_stub_backends()
+    ctx = multiprocessing.get_context("spawn")
+    rows = {}
+    for n_docs in doc_counts:
+        work = tempfile.mkdtemp(prefix="bench-ingest-")
+        try:
+            write_corpus(os.path.join(work, "docs"), n_docs, words_per_doc, seed)
+            results = ctx.Queue()
+            child = ctx.Process(target=_ingest_child,
+                                args=(os.path.join(work, "docs"), os.path.join(work, "out"), index_type, results))
+            child.start()
+            row = results.get()
+            child.join()
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+        row.update(docs=n_docs, docs_per_sec=round(n_docs / row["seconds"], 1),
+                   chunks_per_sec=round(row["chunks"] / row["seconds"], 1))
+        rows[f"{n_docs} docs"] = row
+    return rows
+
+
+def bench_query(index_sizes: list[int], index_types: list[str], dim: int = 256, n_queries: int = 500,
+                top_k: int = 5, shard_rows: int = 0, seed: int = 0) -> dict:
+    """StoreKnowledge.query latency (search + chunk lookup) per index size and type
+    keyed "<vectors> <index type>", "+ x<shards>" when shard_rows split the index"""
+    from themind.store import StoreKnowledge, save_index_chunk
+
+    rows = {}
+    for n in index_sizes:
+        vectors = make_vectors(n, dim, seed)
+        records = [{"doc_name": f"doc{i // 50:05d}", "chunk_id": i % 50, "text": f"chunk {i}"} for i in range(n)]
+        rng = np.random.default_rng(seed + 1)
+        picks = rng.choice(n, size=n_queries)
+        queries = vectors[picks] + 0.05 * rng.standard_normal((n_queries, dim)).astype("float32")
+        for index_type in index_types:
+            out = tempfile.mkdtemp(prefix="bench-query-")
+            try:
+                info = save_index_chunk(vectors, records, out, index_type, shard_rows=shard_rows)
+                store = StoreKnowledge.from_dir(out)
+                store.load()
+                for q in queries[:20]:
+                    store.query(q, top_k=top_k) # warm up
+                seconds = []
+                for q in queries:
+                    start = time.perf_counter()
+                    store.query(q, top_k=top_k)
+                    seconds.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                store.query_many(queries, top_k=top_k)
+                batch_seconds = time.perf_counter() - start
+            finally:
+                shutil.rmtree(out, ignore_errors=True)
+            shards = len(info.get("shards", [])) or 1
+            rows[f"{n} {info['index_type']}" + (f" x{shards}" if shards > 1 else "")] = {
+                "vectors": n,
+                "dim": dim,
+                "index_type": info["index_type"],
+                "shards": shards,
+                "build_seconds": info["build_seconds"],
+                "recall_at_k": info["recall_at_k"],
+                "index_bytes": info["index_bytes"],
+                "query": latency_summary(seconds),
+                "batch_queries_per_sec": round(n_queries / batch_seconds, 1),
+            }
+    return rows
+
+
+def bench_ask(n_docs: int, words_per_doc: int, requests: int, concurrency: int, llm_ms: float = 0.0,
+              seed: int = 0) -> dict:
+    """end to end /ask through the ASGI app (tenant cache, S3 listing, retrieval, stub LLM)"""
+    use_stub_backends()
+    # every request should do the whole path, not hit the answer cache
+    os.environ.setdefault("ANSWER_CACHE_MAX_ENTRIES", "0")
+
+    work = tempfile.mkdtemp(prefix="bench-ask-")
+    try:
+        with local_s3() as bucket:
+            import api.main as api
+
+            for path in write_corpus(os.path.join(work, "docs"), n_docs, words_per_doc, seed):
+                api.s3.upload_file(str(path), bucket, f"bench/users/bench/docs/{path.name}")
+            start = time.perf_counter()
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                ingested = api.run_user_ingest(api.IngestRequest(user_id="bench", env="bench"))
+            ingest_seconds = time.perf_counter() - start
+            api.llm = StubLLM(llm_ms)
+
+            rng = np.random.default_rng(seed + 2)
+            vocabulary = make_vocabulary(seed=seed)
+            questions = [" ".join(rng.choice(vocabulary, size=8)) + "?" for _ in range(requests)]
+            result = asyncio.run(_load(api.app, questions, concurrency))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    result.update(docs=n_docs, chunks=ingested["report"]["chunks_total"], ingest_seconds=round(ingest_seconds, 3),
+                  concurrency=concurrency, llm_ms=llm_ms)
+    return result
+
+
+async def _load(app, questions: list[str], concurrency: int) -> dict:
+    import httpx
+
+    body = lambda q: {"user_id": "bench", "env": "bench", "question": q}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        # the first request loads the tenant (download + open the index), report it on its own
+        start = time.perf_counter()
+        first = await client.post("/ask", json=body("warm up"))
+        cold_seconds = time.perf_counter() - start
+        first.raise_for_status()
+
+        seconds: list[float] = []
+        errors = 0
+        pending = iter(questions)
+
+        async def worker():
+            nonlocal errors
+            for question in pending: # shared iterator, each question goes to one worker
+                start = time.perf_counter()
+                resp = await client.post("/ask", json=body(question))
+                seconds.append(time.perf_counter() - start)
+                errors += resp.status_code != 200
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - start
+
+    return {
+        "requests": len(questions),
+        "errors": errors,
+        "cold_first_request_ms": round(cold_seconds * 1000, 3),
+        "requests_per_sec": round(len(questions) / wall, 1),
+        "latency": latency_summary(seconds),
+    }
@@ -0,0 +1,5 @@
+# the tests import themind / api / benchmarks from the repo root, same as running python -m
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,105 @@
+# chunks.bin (chunk_meta.py) round trips: what goes into the writers comes back out of ChunkMeta
+import json
+
+import numpy as np
+
+from themind.chunk_meta import ChunkMeta, ChunkMetaWriter, write_chunk_meta
+from themind.chunking import chunk_spans
+from themind.store import StoreKnowledge, save_index_chunk
+
+
+def rows(meta: ChunkMeta) -> list[dict]:
+    return [meta[i] for i in range(len(meta))]
+
+
+def test_append_document_matches_append(tmp_path):
+    text = "plain ascii. " * 30 + "naïve café — ünïcödé 漢字 and 🙂 emoji " * 20
+    spans = chunk_spans(len(text), chunk_size_chars=100, overlap_chars=20)
+    expected = [{"doc_name": "a.txt", "chunk_id": i, "text": text[s:e]} for i, (s, e) in enumerate(spans)]
+
+    by_spans = ChunkMetaWriter(str(tmp_path / "w1"))
+    by_spans.append_document("a.txt", text, spans)
+    by_spans.finish(str(tmp_path / "spans.bin"))
+    by_records = ChunkMetaWriter(str(tmp_path / "w2"))
+    by_records.append(expected)
+    by_records.finish(str(tmp_path / "records.bin"))
+
+    assert rows(ChunkMeta(tmp_path / "spans.bin")) == expected
+    assert rows(ChunkMeta(tmp_path / "records.bin")) == expected
+    # overlapping chunks share their bytes, the text blob only holds the document once
+    assert by_spans.text_bytes == len(text.encode("utf-8"))
+    assert by_records.text_bytes > by_spans.text_bytes
+
+
+def test_utf8_spans_mid_document(tmp_path):
+    # spans that dont start at 0, utf-8 offsets are relative to the first span
+    text = "ä" * 10 + "β" * 10 + "€" * 10 + "𝄞" * 10
+    spans = [(5, 15), (12, 25), (25, 40)]
+    writer = ChunkMetaWriter(str(tmp_path / "w"))
+    writer.append_document("d", text, spans)
+    writer.finish(str(tmp_path / "c.bin"))
+    assert [r["text"] for r in rows(ChunkMeta(tmp_path / "c.bin"))] == [text[s:e] for s, e in spans]
+
+
+def test_lone_surrogate_becomes_replacement(tmp_path):
+    text = "ab\ud800cd\udfffef"
+    writer = ChunkMetaWriter(str(tmp_path / "w"))
+    writer.append_document("d", text, [(0, 4), (3, 8)])
+    writer.finish(str(tmp_path / "c.bin"))
+    assert [r["text"] for r in rows(ChunkMeta(tmp_path / "c.bin"))] == ["ab?c", "cd?ef"]
+
+    write_chunk_meta(str(tmp_path / "r.bin"), [{"doc_name": "d", "chunk_id": 0, "text": text}])
+    assert ChunkMeta(tmp_path / "r.bin").text(0) == "ab?cd?ef"
+
+
+def test_doc_ranges(tmp_path):
+    records = [{"doc_name": name, "chunk_id": i, "text": f"{name}{i}"}
+               for name, n in [("a", 3), ("b", 2), ("a", 1), ("c", 4)] for i in range(n)]
+    write_chunk_meta(str(tmp_path / "c.bin"), records)
+    meta = ChunkMeta(tmp_path / "c.bin")
+    assert meta.doc_names == ["a", "b", "c"]
+    assert dict(zip(meta.doc_names, meta.doc_ranges)) == {"a": [[0, 3], [5, 6]], "b": [[3, 5]], "c": [[6, 10]]}
+    assert meta.doc_name(5) == "a" and meta[5]["chunk_id"] == 0
+
+
+def test_truncate_rolls_back(tmp_path):
+    writer = ChunkMetaWriter(str(tmp_path / "w"))
+    writer.append_document("a", "x" * 50, [(0, 30), (20, 50)])
+    state = writer.state()
+    writer.append_document("b", "ÿ" * 50, [(0, 50)])
+    writer.append([{"doc_name": "c", "chunk_id": 0, "text": "ccc"}])
+    writer.truncate(state)
+    writer.append_document("d", "yy", [(0, 2)])
+    writer.finish(str(tmp_path / "c.bin"))
+
+    meta = ChunkMeta(tmp_path / "c.bin")
+    assert meta.doc_names == ["a", "d"]
+    assert [r["text"] for r in rows(meta)] == ["x" * 30, "x" * 30, "yy"]
+
+
+def test_finish_zero_rows(tmp_path):
+    writer = ChunkMetaWriter(str(tmp_path / "w"))
+    writer.append_document("empty", "", [])
+    writer.finish(str(tmp_path / "c.bin"))
+    meta = ChunkMeta(tmp_path / "c.bin")
+    assert len(meta) == 0 and meta.doc_names == [] and meta.doc_ranges == []
+
+
+def test_store_loads_legacy_jsonl(tmp_path):
+    vectors = np.random.default_rng(0).standard_normal((6, 8)).astype("float32")
+    records = [{"doc_name": "a" if i < 4 else "b", "chunk_id": i, "text": f"t{i}"} for i in range(6)]
+    save_index_chunk(vectors, records, str(tmp_path), index_type="flat")
+    # an older build: chunks.jsonl instead of chunks.bin
+    (tmp_path / "chunks.bin").unlink()
+    with open(tmp_path / "chunks.jsonl", "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+    store = StoreKnowledge.from_dir(str(tmp_path))
+    store.load()
+    assert str(store.chunks_path).endswith("chunks.jsonl")
+    assert store.doc_ranges == {"a": [[0, 4]], "b": [[4, 6]]}
+    hit = store.query(vectors[5], top_k=1)[0]
+    assert (hit["doc_name"], hit["chunk_id"], hit["text"]) == ("b", 5, "t5")
+    filtered = store.query(vectors[5], top_k=3, doc_names="a")
+    assert len(filtered) == 3 and all(h["doc_name"] == "a" for h in filtered)
@@ -0,0 +1,152 @@
+# per document changes on top of a build (delta.py + the StoreKnowledge mutations)
+import json
+
+import numpy as np
+import pytest
+
+from themind import indexing, store as store_module
+from themind.delta import DELTA_FILES, DELTA_STATE_NAME, DeltaSegment
+from themind.store import StoreKnowledge, save_index_chunk
+
+DIM = 16
+DOCS, CHUNKS = 30, 100 # 3000 rows, doc{i} holds rows [i * 100, (i + 1) * 100)
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).standard_normal((DOCS * CHUNKS, DIM)).astype("float32")
+
+
+def records():
+    return [{"doc_name": f"doc{i // CHUNKS}", "chunk_id": i % CHUNKS, "text": f"t{i}"} for i in range(DOCS * CHUNKS)]
+
+
+def build(path, vectors, index_type="flat", shard_rows=0, compression="none", keep_vectors=False) -> StoreKnowledge:
+    save_index_chunk(vectors, records(), str(path), index_type=index_type, shard_rows=shard_rows,
+                     compression=compression, keep_vectors=keep_vectors)
+    return load(path)
+
+
+def load(path) -> StoreKnowledge:
+    store = StoreKnowledge.from_dir(str(path))
+    store.load()
+    return store
+
+
+def test_add_replace_remove(tmp_path, vectors):
+    store = build(tmp_path, vectors)
+    q = vectors[150]
+    assert store.query(q, 1)[0]["text"] == "t150"
+
+    assert store.remove_document("doc1")
+    assert not store.remove_document("doc1")
+    assert all(h["doc_name"] != "doc1" for h in store.query(q, 20))
+    assert store.query(q, 5, doc_names="doc1") == []
+    assert "doc1" not in store.documents()
+
+    new = vectors[100:200] + 0.001
+    ids = store.add_document("doc1", new, [f"new{i}" for i in range(100)])
+    assert ids == list(range(3000, 3100)) # after the build rows, nothing shifts
+    hit = store.query(q, 1)[0]
+    assert (hit["doc_name"], hit["chunk_id"], hit["text"]) == ("doc1", 50, "new50")
+    with pytest.raises(ValueError):
+        store.add_document("doc1", new, ["x"] * 100)
+
+    # doc_names: build docs and delta docs together, or only one of them
+    assert [h["text"] for h in store.query(q, 3, doc_names=["doc1", "doc2"])][0] == "new50"
+    assert {h["doc_name"] for h in store.query(q, 10, doc_names="doc2")} == {"doc2"}
+    assert {h["doc_name"] for h in store.query(q, 10, doc_names="doc1")} == {"doc1"}
+
+    # replacing a delta document again: its old delta ids are gone and never reused
+    ids = store.replace_document("doc1", vectors[:3], ["a", "b", "c"])
+    assert ids == [3100, 3101, 3102]
+    assert {h["text"] for h in store.query(q, 10, doc_names="doc1")} == {"a", "b", "c"}
+    assert all(not h["text"].startswith("new") for h in store.query(q, 50))
+
+
+def test_results_match_brute_force(tmp_path, vectors):
+    store = build(tmp_path, vectors)
+    store.remove_document("doc3")
+    store.replace_document("doc7", vectors[:5] * 0.5, list("abcde"))
+    store.add_document("extra", vectors[10:20] + 0.01, [f"e{i}" for i in range(10)])
+
+    alive = np.ones(len(vectors), dtype=bool)
+    alive[300:400] = alive[700:800] = False
+    every = np.vstack([vectors[alive], vectors[:5] * 0.5, vectors[10:20] + 0.01])
+    queries = np.random.default_rng(1).standard_normal((10, DIM)).astype("float32")
+    got = store.query_many(queries, 10)
+    want = np.sort(((queries[:, None] - every[None]) ** 2).sum(-1), axis=1)[:, :10]
+    np.testing.assert_allclose([[h["dist_score"] for h in hits] for hits in got], want, rtol=1e-4)
+
+
+@pytest.mark.parametrize("index_type,shard_rows,compression,keep_vectors", [
+    ("flat", 0, "none", False), ("hnsw", 0, "none", False), ("flat", 1000, "none", False),
+    ("hnsw", 1000, "none", False),
+    # flat + pq is a bare IndexPQ, it takes no selector so the tombstones get dropped after the search
+    ("flat", 0, "pq", False), ("flat", 0, "pq", True), ("flat", 1500, "pq", False),
+])
+def test_tombstoned_rows_never_come_back(tmp_path, vectors, monkeypatch, index_type, shard_rows, compression,
+                                         keep_vectors):
+    monkeypatch.setattr(indexing, "MIN_PQ_POINTS", 1000) # pq on these small builds too
+    store = build(tmp_path, vectors, index_type, shard_rows, compression, keep_vectors)
+    assert store.info["compression"] == compression
+    gone = [f"doc{i}" for i in range(0, DOCS, 3)] # some in every shard
+    for name in gone:
+        store.remove_document(name)
+    queries = np.vstack([vectors[i * CHUNKS + 5] for i in range(0, DOCS, 3)]) # right on top of removed rows
+    for hits in store.query_many(queries, 20):
+        assert len(hits) == 20 and not {h["doc_name"] for h in hits} & set(gone)
+    for hits in store.query_many(queries, 5, doc_names=gone + ["doc1"]):
+        assert {h["doc_name"] for h in hits} == {"doc1"}
+
+
+def test_save_and_load_round_trip(tmp_path, vectors):
+    store = build(tmp_path, vectors, shard_rows=1000)
+    store.remove_document("doc4")
+    store.replace_document("doc5", vectors[:2] + 1, ["x", "ÿ"])
+    store.add_document("new", vectors[20:23], ["n0", "n1", "n2"])
+    store.add_document("empty", np.empty((0, DIM), dtype="float32"), [])
+    files = store.save_delta()
+    assert sorted(p.rsplit("/", 1)[-1] for p in files) == sorted(DELTA_FILES)
+
+    again = load(tmp_path)
+    assert again.delta_stats() == store.delta_stats()
+    assert sorted(again.documents()) == sorted(store.documents())
+    queries = vectors[::97]
+    assert again.query_many(queries, 10) == store.query_many(queries, 10)
+    assert again.add_document("later", vectors[:1], ["l"]) == [3000 + 2 + 3] # next_id survived
+
+
+def test_delta_of_another_build_is_ignored(tmp_path, vectors):
+    store = build(tmp_path, vectors)
+    store.remove_document("doc0")
+    store.save_delta()
+    state = json.loads((tmp_path / DELTA_STATE_NAME).read_text())
+    state["base_rows"] += 1
+    (tmp_path / DELTA_STATE_NAME).write_text(json.dumps(state))
+    assert DeltaSegment.load(str(tmp_path), DIM, len(vectors)) is None
+    again = load(tmp_path)
+    assert again.delta is None and "doc0" in again.documents()
+    # and a new build throws the old delta away
+    store.save_delta()
+    build(tmp_path, vectors)
+    assert not any((tmp_path / name).exists() for name in DELTA_FILES)
+
+
+def test_needs_compaction(tmp_path, vectors, monkeypatch):
+    monkeypatch.setattr(store_module, "COMPACT_DELTA_ROWS", 50)
+    monkeypatch.setattr(store_module, "COMPACT_RATIO", 0.1) # 300 of the 3000 rows
+    store = build(tmp_path, vectors)
+    assert not store.needs_compaction()
+    store.add_document("a", vectors[:49], ["x"] * 49)
+    assert not store.needs_compaction()
+    store.add_document("b", vectors[:1], ["x"])
+    assert store.needs_compaction() # 50 delta rows
+
+    monkeypatch.setattr(store_module, "COMPACT_DELTA_ROWS", 10_000)
+    store = build(tmp_path, vectors)
+    for name in ("doc0", "doc1", "doc2"):
+        store.remove_document(name)
+    assert not store.needs_compaction() # 300 tombstoned, not over the share yet
+    store.add_document("c", vectors[:1], ["x"])
+    assert store.needs_compaction() # 301 changed rows > 10% of the build
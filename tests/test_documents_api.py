@@ -0,0 +1,81 @@
+# /documents/upsert + /documents/remove end to end: moto for S3, hashing embedder, stub LLM
+import time
+
+import pytest
+
+pytest.importorskip("moto")
+from fastapi.testclient import TestClient
+
+from benchmarks.stubs import StubLLM, local_s3
+from themind import store as store_module
+
+PREFIX = "t/users/u/"
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    with pytest.MonkeyPatch.context() as mp:
+        for name, value in {"EMBED_BACKEND": "hashing", "EMBED_CACHE_PATH": "off", "PARSE_CACHE_PATH": "off",
+                            "OPENAI_API_KEY": "test"}.items():
+            mp.setenv(name, value)
+        with local_s3() as bucket:
+            import api.main as main
+            mp.setattr(main, "TENANT_DATA_DIR", str(tmp_path_factory.mktemp("tenants")))
+            mp.setattr(main, "llm", StubLLM())
+            for i in range(12): # 120 rows, replacing d0 + removing d1 stays under COMPACT_RATIO
+                put(main, bucket, f"d{i}.txt", " ".join(f"word{i} filler{j}" for j in range(600)))
+            main.run_user_ingest(main.IngestRequest(user_id="u", env="t"))
+            yield main, bucket, TestClient(main.app)
+
+
+def put(main, bucket, name, text):
+    main.s3.put_object(Bucket=bucket, Key=f"{PREFIX}docs/{name}", Body=text.encode())
+
+
+def index_files(main) -> list[str]:
+    return sorted(obj["Key"].rsplit("/", 1)[-1] for obj in main.list_objects(f"{PREFIX}indexes/"))
+
+
+def sources(client, doc_names) -> list[dict]:
+    r = client.post("/ask", json={"user_id": "u", "env": "t", "question": "zebra", "doc_names": doc_names})
+    r.raise_for_status()
+    return r.json()["sources"]
+
+
+def change(client, action, doc_name, user_id="u"):
+    return client.post(f"/documents/{action}", json={"user_id": user_id, "env": "t", "doc_name": doc_name})
+
+
+def test_upsert_remove_and_compaction(api, monkeypatch):
+    main, bucket, client = api
+    assert {s["doc_name"] for s in sources(client, ["d0"])} == set() # doc names are file names
+    assert {s["doc_name"] for s in sources(client, ["d0.txt"])} == {"d0.txt"}
+
+    put(main, bucket, "d0.txt", "zebra stripes " * 20)
+    r = change(client, "upsert", "d0.txt")
+    assert r.status_code == 200 and r.json()["chunks"] == 1 and r.json()["compaction"] is None
+    assert {"delta.index", "delta.jsonl", "delta.json"} <= set(index_files(main))
+    assert [s["text"] for s in sources(client, ["d0.txt"])] == ["zebra stripes " * 20]
+
+    r = change(client, "remove", "d1.txt")
+    assert r.status_code == 200
+    assert sources(client, ["d1.txt"]) == []
+    assert not main.list_objects(f"{PREFIX}docs/d1.txt") # gone from docs/ too, a rebuild wont bring it back
+    assert change(client, "remove", "d1.txt").status_code == 404
+    assert change(client, "upsert", "missing.txt").status_code == 404
+    assert change(client, "upsert", "d0.txt", user_id="nobody").status_code == 409
+
+    # next change crosses the threshold -> background re-ingest folds the delta into a new build
+    monkeypatch.setattr(store_module, "COMPACT_RATIO", 0.0)
+    put(main, bucket, "d4.txt", "brand new document " * 10)
+    compaction = change(client, "upsert", "d4.txt").json()["compaction"]
+    for _ in range(200):
+        job = client.get(compaction["status_url"]).json()
+        if job["state"] in ("succeeded", "failed"):
+            break
+        time.sleep(0.05)
+    assert job["state"] == "succeeded", job.get("error")
+    assert not {"delta.index", "delta.jsonl", "delta.json"} & set(index_files(main))
+    assert [s["text"] for s in sources(client, ["d0.txt"])] == ["zebra stripes " * 20]
+    assert sources(client, ["d1.txt"]) == []
+    assert {s["doc_name"] for s in sources(client, ["d4.txt"])} == {"d4.txt"}
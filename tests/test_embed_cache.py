@@ -0,0 +1,48 @@
+# EmbeddingCache (embed_cache.py) shared by several processes, each with its own connection
+import multiprocessing
+import sqlite3
+
+import numpy as np
+
+from themind.embed_cache import EmbeddingCache
+
+DIM = 64 # 256 bytes a vector
+
+
+def file_bytes(path) -> int:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM vectors").fetchone()[0]
+
+
+def fill(path, name, n):
+    cache = EmbeddingCache(path, max_bytes=DIM * 4 * 10)
+    for i in range(n):
+        cache.put_many("m", [f"{name}{i}"], np.full((1, DIM), i, dtype="float32"))
+
+
+def test_max_bytes_holds_across_processes(tmp_path):
+    path = str(tmp_path / "e.sqlite")
+    one = EmbeddingCache(path, max_bytes=DIM * 4 * 10)
+    two = EmbeddingCache(path, max_bytes=DIM * 4 * 10)
+    one.put_many("m", [f"a{i}" for i in range(8)], np.ones((8, DIM), dtype="float32"))
+    two.put_many("m", [f"b{i}" for i in range(8)], np.ones((8, DIM), dtype="float32")) # 16 > 10 in the file
+    assert file_bytes(path) <= DIM * 4 * 10
+    assert one.stats()["used_bytes"] == two.stats()["used_bytes"] == file_bytes(path)
+
+    workers = [multiprocessing.Process(target=fill, args=(path, name, 40)) for name in "cde"]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    assert all(w.exitcode == 0 for w in workers)
+    assert one.stats()["used_bytes"] == file_bytes(path) <= DIM * 4 * 10
+
+
+def test_file_from_before_the_size_table(tmp_path):
+    path = str(tmp_path / "e.sqlite")
+    EmbeddingCache(path).put_many("m", ["x", "y"], np.ones((2, DIM), dtype="float32"))
+    with sqlite3.connect(path) as conn:
+        conn.execute("DROP TABLE size")
+    cache = EmbeddingCache(path)
+    assert cache.stats()["used_bytes"] == 2 * DIM * 4
+    assert cache.get_many("m", ["x", "z"])[1] is None
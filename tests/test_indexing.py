@@ -0,0 +1,50 @@
+# index choice + training limits in indexing.py
+import numpy as np
+import pytest
+
+from themind import indexing
+from themind.indexing import MAX_TRAIN_POINTS, _nlist, build_index
+from themind.store import StoreKnowledge, save_index_chunk
+
+
+def test_nlist_has_enough_training_points_per_list():
+    for n in (1, 100, 50_000, 410_000, 10_000_000):
+        assert 1 <= _nlist(n) <= max(1, min(n, MAX_TRAIN_POINTS) // 39)
+    assert _nlist(10_000_000) == MAX_TRAIN_POINTS // 39
+
+
+def test_small_ivfpq_falls_back_to_sq8():
+    vectors = np.random.default_rng(0).standard_normal((110, 16)).astype("float32")
+    index, info = build_index(vectors, index_type="ivfpq")
+    assert (info["index_type"], info["compression"]) == ("ivf", "sq8")
+    assert index.ntotal == 110
+
+
+def test_small_pq_compression_falls_back_to_sq8():
+    vectors = np.random.default_rng(0).standard_normal((300, 16)).astype("float32")
+    _, info = build_index(vectors, index_type="flat", compression="pq")
+    assert info["compression"] == "sq8"
+
+
+@pytest.mark.parametrize("keep_vectors,shard_rows", [(False, 0), (True, 0), (False, 2000)])
+def test_flat_pq_doc_filter(tmp_path, monkeypatch, keep_vectors, shard_rows):
+    # a bare IndexPQ takes no selector, doc filters have to work around it
+    monkeypatch.setattr(indexing, "MIN_PQ_POINTS", 1000) # pq on a small corpus, trains in no time
+    vectors = np.random.default_rng(0).standard_normal((4000, 32)).astype("float32")
+    records = [{"doc_name": f"doc{i // 200}", "chunk_id": i % 200, "text": f"t{i}"} for i in range(len(vectors))]
+    info = save_index_chunk(vectors, records, str(tmp_path), index_type="flat", compression="pq",
+                            keep_vectors=keep_vectors, shard_rows=shard_rows)
+    assert info["compression"] == "pq" and len(info.get("shards", [])) == (2 if shard_rows else 0)
+    store = StoreKnowledge.from_dir(str(tmp_path))
+    store.load()
+
+    rows = np.r_[600:800, 3000:3200] # doc3 + doc15, one in each shard
+    # kept vectors -> exact, otherwise the distances the pq codes give
+    known = vectors[rows] if keep_vectors else np.vstack([store.index.reconstruct_n(600, 200),
+                                                          store.index.reconstruct_n(3000, 200)])
+    queries = vectors[[605, 3005, 1400]]
+    want = np.sort(((queries[:, None] - known[None]) ** 2).sum(-1), axis=1)[:, :10]
+    got = store.query_many(queries, 10, doc_names=["doc3", "doc15"])
+    assert all({h["doc_name"] for h in hits} <= {"doc3", "doc15"} for hits in got)
+    np.testing.assert_allclose([[h["dist_score"] for h in hits] for hits in got], want, rtol=1e-4)
+    assert len(store.query(queries[2], 10)) == 10
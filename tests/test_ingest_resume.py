@@ -0,0 +1,74 @@
+# an ingest that dies half way resumes from its checkpoint and ends up with the same build
+import numpy as np
+import pytest
+
+from themind import ingest
+from themind.embedder import Embedder
+from themind.store import StoreKnowledge
+
+
+@pytest.fixture(autouse=True)
+def stub_backends(monkeypatch):
+    monkeypatch.setenv("EMBED_BACKEND", "hashing")
+    monkeypatch.setenv("EMBED_CACHE_PATH", "off")
+    monkeypatch.setenv("PARSE_CACHE_PATH", "off")
+    monkeypatch.setattr(ingest, "EMBED_GROUP_CHUNKS", 4) # a checkpoint every few chunks
+
+
+def write_docs(docs_dir, n=6):
+    docs_dir.mkdir()
+    for i in range(n):
+        words = " ".join(f"w{i}x{j} ünï" for j in range(400))
+        (docs_dir / f"d{i}.txt").write_text(words, encoding="utf-8")
+
+
+def build_files(out_dir) -> dict:
+    store = StoreKnowledge.from_dir(str(out_dir))
+    store.load()
+    return {"chunks": (out_dir / "chunks.bin").read_bytes(),
+            "vectors": store.index.reconstruct_n(0, store.index.ntotal)}
+
+
+def test_crash_then_resume_matches_fresh_build(tmp_path, monkeypatch, capsys):
+    docs = tmp_path / "docs"
+    write_docs(docs)
+    work = tmp_path / "work"
+
+    calls = {"n": 0}
+    encode = Embedder.encode
+
+    def dying_encode(self, texts):
+        calls["n"] += 1
+        if calls["n"] == 4:
+            raise RuntimeError("worker killed")
+        return encode(self, texts)
+
+    monkeypatch.setattr(Embedder, "encode", dying_encode)
+    with pytest.raises(RuntimeError, match="worker killed"):
+        ingest.run_ingest(str(docs), str(tmp_path / "out1"), work_dir=str(work))
+    assert (work / ingest.CHECKPOINT_NAME).exists()
+    monkeypatch.setattr(Embedder, "encode", encode)
+
+    # a fresh out_dir (the api's temp folder), only the work dir survived
+    resumed = ingest.run_ingest(str(docs), str(tmp_path / "out2"), work_dir=str(work))
+    assert "resuming" in capsys.readouterr().out
+    fresh = ingest.run_ingest(str(docs), str(tmp_path / "out3"))
+
+    assert resumed["chunks_total"] == fresh["chunks_total"]
+    assert resumed["chunks_embedded"] == fresh["chunks_embedded"] # counted across both runs
+    assert not work.exists() # cleaned up once the build is done
+    a, b = build_files(tmp_path / "out2"), build_files(tmp_path / "out3")
+    assert a["chunks"] == b["chunks"]
+    np.testing.assert_array_equal(a["vectors"], b["vectors"])
+
+
+def test_checkpoint_of_another_job_is_dropped(tmp_path):
+    docs = tmp_path / "docs"
+    write_docs(docs, 2)
+    work = tmp_path / "work"
+    work.mkdir()
+    (work / ingest.CHECKPOINT_NAME).write_text('{"job": "something else"}')
+    (work / "vectors.f32").write_bytes(b"junk")
+    report = ingest.run_ingest(str(docs), str(tmp_path / "out"), work_dir=str(work))
+    assert report["changed"]
+    assert report["chunks_total"] == len(build_files(tmp_path / "out")["vectors"])
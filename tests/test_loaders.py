@@ -0,0 +1,37 @@
+# DocumentParser (loaders.py): only PDFs go through the parsed-text cache
+from pypdf import PdfWriter
+
+from themind.loaders import DocumentParser
+from themind.parse_cache import ParsedTextCache
+
+
+def test_plain_text_skips_the_cache(tmp_path):
+    cache = ParsedTextCache(str(tmp_path / "parsed.sqlite"))
+    (tmp_path / "a.txt").write_text("hello there", encoding="utf-8")
+    (tmp_path / "b.md").write_text("# title\nbody", encoding="utf-8")
+    writer = PdfWriter()
+    writer.add_blank_page(width=200, height=200)
+    writer.write(str(tmp_path / "c.pdf"))
+    paths = [tmp_path / "a.txt", tmp_path / "b.md", tmp_path / "c.pdf"]
+
+    parser = DocumentParser(max_workers=1, cache=cache)
+    docs = [doc for _, doc in parser.parse(paths)]
+    assert [d["text"] for d in docs[:2]] == ["hello there", "# title\nbody"]
+    assert docs[2] is None # no text on a blank page, still worth remembering
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (0, 1) # only the pdf was looked up
+    assert cache._conn.execute("SELECT COUNT(*) FROM texts").fetchone()[0] == 1
+
+    list(parser.parse(paths))
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (1, 1)
+
+
+def test_parse_cache_size_is_shared(tmp_path):
+    path = str(tmp_path / "parsed.sqlite")
+    one = ParsedTextCache(path, max_bytes=4000)
+    two = ParsedTextCache(path, max_bytes=4000)
+    for i in range(6):
+        (one if i % 2 else two).put(f"k{i}", bytes(range(256)).decode("latin-1") * 4) # ~1.5kb compressed
+    on_disk = one._conn.execute("SELECT SUM(LENGTH(body)) FROM texts").fetchone()[0]
+    assert on_disk <= 4000
+    assert one.stats()["used_bytes"] == two.stats()["used_bytes"] == on_disk
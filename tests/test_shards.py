@@ -0,0 +1,109 @@
+# a sharded build has to answer exactly like one index over the same vectors
+import shutil
+
+import faiss
+import numpy as np
+import pytest
+
+from themind.indexing import mask_selector, range_selector
+from themind.shards import ShardedIndex, build_shards, merge_topk, shard_bounds
+
+N, DIM, K = 1000, 16, 10
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((N, DIM)).astype("float32"), rng.standard_normal((20, DIM)).astype("float32")
+
+
+@pytest.fixture
+def sharded(tmp_path, data):
+    vectors, _ = data
+    info = build_shards(vectors, str(tmp_path), shard_rows=300, index_type="flat")
+    return ShardedIndex(str(tmp_path), info), info
+
+
+def exact(vectors, queries, k, selector=None):
+    index = faiss.IndexFlatL2(DIM)
+    index.add(vectors)
+    params = faiss.SearchParameters(sel=selector) if selector is not None else None
+    return index.search(queries, k, params=params)
+
+
+def test_shard_bounds_cover_every_row():
+    bounds = shard_bounds(1000, 300)
+    assert bounds[0][0] == 0 and bounds[-1][1] == 1000
+    assert all(a[1] == b[0] for a, b in zip(bounds, bounds[1:]))
+    assert all(end - start <= 300 for start, end in bounds)
+
+
+def test_merge_topk_pads_and_orders():
+    a = (np.array([[1.0, 4.0]], dtype="float32"), np.array([[10, 11]]))
+    b = (np.array([[2.0, np.inf]], dtype="float32"), np.array([[20, -1]]))
+    distances, ids = merge_topk([a, b], 5, 1)
+    assert ids.tolist() == [[10, 20, 11, -1, -1]]
+    assert distances[0, :3].tolist() == [1.0, 2.0, 4.0] and np.isinf(distances[0, 3:]).all()
+
+
+def test_search_matches_unsharded(sharded, data):
+    vectors, queries = data
+    index, info = sharded
+    assert len(info["shards"]) == 4 and index.ntotal == N
+    distances, ids = index.search(queries, K)
+    want_d, want_i = exact(vectors, queries, K)
+    np.testing.assert_array_equal(ids, want_i)
+    np.testing.assert_allclose(distances, want_d, rtol=1e-5)
+
+
+def test_ranges_across_shard_edges(sharded, data):
+    vectors, queries = data
+    index, _ = sharded
+    ranges = [(100, 120), (240, 520), (990, 1000)] # the middle one spans three shards
+    _, ids = index.search(queries, K, params=index.params(ranges=ranges))
+    selector, _keep = range_selector(ranges, N)
+    _, want = exact(vectors, queries, K, selector)
+    np.testing.assert_array_equal(ids, want)
+
+
+def test_tombstones(sharded, data):
+    vectors, queries = data
+    index, _ = sharded
+    alive = np.ones(N, dtype=bool)
+    alive[:50] = alive[280:610] = False
+    index.set_alive(alive)
+    _, ids = index.search(queries, K)
+    assert alive[ids].all()
+    selector, _keep = mask_selector(alive)
+    _, want = exact(vectors, queries, K, selector)
+    np.testing.assert_array_equal(ids, want)
+
+    index.set_alive(None)
+    np.testing.assert_array_equal(index.search(queries, K)[1], exact(vectors, queries, K)[1])
+
+
+def test_reconstruct_across_shards(sharded, data):
+    vectors, _ = data
+    index, _ = sharded
+    np.testing.assert_array_equal(index.reconstruct_n(250, 400), vectors[250:650])
+    assert index.prepare_reconstruct()
+
+
+def test_range_in_one_shard_only_fetches_that_shard(tmp_path, data):
+    vectors, queries = data
+    built, remote = tmp_path / "built", tmp_path / "remote"
+    built.mkdir()
+    info = build_shards(vectors, str(built), shard_rows=300, index_type="flat")
+    shutil.move(str(built), str(remote)) # nothing local, every shard has to be fetched
+    built.mkdir()
+    fetched = []
+
+    def fetch(name):
+        fetched.append(name)
+        shutil.copy(remote / name, built / name)
+
+    index = ShardedIndex(str(built), info, fetch)
+    assert index.loaded() == []
+    _, ids = index.search(queries, K, params=index.params(ranges=[(260, 290)])) # shards are 250 rows
+    assert fetched == ["shard-001.index"] and [s.name for s in index.loaded()] == fetched
+    assert ((ids >= 260) & (ids < 290)).all()
@@ -0,0 +1,32 @@
+# TenantCache (tenant_cache.py): one load per cold tenant, nothing left behind per tenant
+import threading
+import time
+
+from themind.tenant_cache import TenantCache
+
+
+def test_concurrent_cold_load_happens_once():
+    cache = TenantCache()
+    loads = []
+
+    def load(version):
+        loads.append(version)
+        time.sleep(0.05) # long enough for the other threads to queue up behind it
+        return "store", 10
+
+    threads = [threading.Thread(target=cache.get, args=("t", lambda: "v1", load)) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loads == ["v1"]
+    assert cache.stats()["hits"] == 7 and cache._key_locks == {}
+
+
+def test_evicted_and_invalidated_tenants_leave_no_locks():
+    cache = TenantCache(max_bytes=100)
+    for i in range(50):
+        cache.get(i, lambda: "v", lambda version: (object(), 60)) # each one pushes the last out
+    cache.invalidate(49)
+    assert cache.stats()["tenants"] == 0 and cache.stats()["evictions"] == 49
+    assert cache._key_locks == {}
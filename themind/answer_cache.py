@@ -0,0 +1,119 @@
+# cache of finished answers keyed on the question embedding
+# lots of people ask the same thing in slightly different words, if a new question is
+# close enough (cosine similarity >= threshold) to one we already answered for the same
+# tenant and the same index version we hand back that answer and skip the LLM
+# an answer also only counts for the settings it was built with (settings = whatever the
+# caller says shaped it, rag.py passes top_k + the context budget)
+
+# entries live per tenant and remember the index version they were built from, once a
+# tenant re-ingests the version changes and all of its old answers are dropped
+
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class AnswerCache:
+    """in memory semantic cache of {answer, sources} with TTL + LRU eviction"""
+
+    def __init__(self, threshold: float = 0.97, ttl_seconds: float = 3600, max_entries: int = 2048):
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._tenants: dict = {} # tenant -> {"version": ..., "entries": OrderedDict(id -> entry)}
+        self._order: OrderedDict = OrderedDict() # (tenant, id) oldest first, across all tenants
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        vector = np.asarray(vector, dtype="float32").ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _tenant(self, tenant, version) -> dict:
+        # a different version means the tenant re-ingested, nothing old is valid anymore
+        bucket = self._tenants.get(tenant)
+        if bucket is not None and bucket["version"] != version:
+            self._drop_tenant(tenant)
+            bucket = None
+        if bucket is None:
+            bucket = self._tenants[tenant] = {"version": version, "entries": OrderedDict()}
+        return bucket
+
+    def _drop_tenant(self, tenant):
+        bucket = self._tenants.pop(tenant, None)
+        if bucket is not None:
+            for entry_id in bucket["entries"]:
+                self._order.pop((tenant, entry_id), None)
+
+    def _remove(self, tenant, entry_id):
+        bucket = self._tenants.get(tenant)
+        if bucket is not None:
+            bucket["entries"].pop(entry_id, None)
+        self._order.pop((tenant, entry_id), None)
+
+    def lookup(self, tenant, version, question_vector: np.ndarray, settings=None) -> dict | None:
+        """cached {answer, sources, similarity} for a close enough question asked with the
+        same settings, or None"""
+        query = self._normalize(question_vector)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._tenant(tenant, version)
+            entries = bucket["entries"]
+            for entry_id in [i for i, e in entries.items() if now - e["created"] > self.ttl_seconds]:
+                self._remove(tenant, entry_id)
+
+            ids = [i for i, e in entries.items() if e["settings"] == settings]
+            if not ids:
+                self.misses += 1
+                return None
+
+            matrix = np.stack([entries[i]["vector"] for i in ids])
+            sims = matrix @ query
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            entry_id = ids[best]
+            entries.move_to_end(entry_id)
+            self._order.move_to_end((tenant, entry_id))
+            self.hits += 1
+            entry = entries[entry_id]
+            return {"answer": entry["answer"], "sources": entry["sources"], "similarity": float(sims[best])}
+
+    def store(self, tenant, version, question_vector: np.ndarray, answer: str, sources: list[dict],
+              settings=None):
+        with self._lock:
+            bucket = self._tenant(tenant, version)
+            entry_id = self._next_id
+            self._next_id += 1
+            bucket["entries"][entry_id] = {
+                "vector": self._normalize(question_vector),
+                "answer": answer,
+                "sources": sources,
+                "settings": settings,
+                "created": time.monotonic(),
+            }
+            self._order[(tenant, entry_id)] = None
+            while len(self._order) > self.max_entries:
+                (old_tenant, old_id), _ = self._order.popitem(last=False)
+                self._remove(old_tenant, old_id)
+
+    def invalidate(self, tenant):
+        with self._lock:
+            self._drop_tenant(tenant)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._order),
+                "tenants": len(self._tenants),
+                "hits": self.hits,
+                "misses": self.misses,
+                "threshold": self.threshold,
+            }
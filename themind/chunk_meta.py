@@ -0,0 +1,284 @@
+# compact on-disk chunk metadata, replaces parsing chunks.jsonl into a list of dicts
+# a query only ever looks at top_k rows, so instead of building a dict per chunk on load
+# we mmap one file and decode just the rows a search hits
+
+# layout of chunks.bin:
+#   8 bytes magic | 8 bytes header length | json header | columns (8 byte aligned)
+# the header has the interned doc names and where every column starts, columns are
+#   doc_ids   int32  row -> index into doc_names
+#   chunk_ids int32  chunk number inside its document
+#   starts    int64  byte offset of the row text in the text blob
+#   ends      int64  byte offset where the row text stops
+#   text      utf-8 blob
+# the ingest writes every document's text into the blob once and rows are just spans
+# over it, overlapping chunks share their bytes instead of each keeping a copy
+# the header also keeps doc_ranges, the [start, end) rows of every document, so a search
+# limited to a few documents knows which vector ids to look at without touching the rows
+
+import json
+import mmap
+import os
+import numpy as np
+
+MAGIC = b"MMCHUNK1"
+_ALIGN = 8
+
+
+def _pad(n: int) -> int:
+    return (-n) % _ALIGN
+
+
+def utf8_offsets(text: str, char_offsets) -> tuple[bytes, np.ndarray]:
+    """text as utf-8 plus the byte position of every char offset in char_offsets"""
+    # the errors="replace" lets us replace really weird chars(happens in these kind of docs)
+    data = text.encode("utf-8", errors="replace")
+    char_offsets = np.asarray(char_offsets, dtype="int64")
+    if len(data) == len(text):
+        return data, char_offsets # plain ascii, chars and bytes line up
+    codepoints = np.frombuffer(text.encode("utf-32-le", errors="surrogatepass"), dtype="<u4")
+    widths = 1 + (codepoints >= 0x80).astype("int64") + (codepoints >= 0x800) + (codepoints >= 0x10000)
+    widths[(codepoints >= 0xD800) & (codepoints <= 0xDFFF)] = 1 # lone surrogates become "?"
+    byte_at = np.concatenate([[0], np.cumsum(widths)])
+    return data, byte_at[char_offsets]
+
+
+def doc_ranges(doc_ids: np.ndarray, n_docs: int) -> list[list[list[int]]]:
+    """[start, end) row ranges of every document, one range each unless its rows got split up"""
+    ranges: list[list[list[int]]] = [[] for _ in range(n_docs)]
+    if len(doc_ids) == 0:
+        return ranges
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(doc_ids)) + 1])
+    ends = np.append(starts[1:], len(doc_ids))
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        ranges[int(doc_ids[start])].append([start, end])
+    return ranges
+
+
+def write_chunk_meta(path: str, chunk_records: list[dict]):
+    """write chunk records (doc_name, chunk_id, text) in the columnar format"""
+    doc_index: dict[str, int] = {} # intern doc names, usually thousands of rows share a handful
+    doc_ids = np.empty(len(chunk_records), dtype="int32")
+    chunk_ids = np.empty(len(chunk_records), dtype="int32")
+    starts = np.empty(len(chunk_records), dtype="int64")
+    ends = np.empty(len(chunk_records), dtype="int64")
+    blobs: list[bytes] = []
+    offset = 0
+
+    for row, record in enumerate(chunk_records):
+        doc_ids[row] = doc_index.setdefault(record["doc_name"], len(doc_index))
+        chunk_ids[row] = record["chunk_id"]
+        # the errors="replace" lets us replace really weird chars(happens in these kind of docs)
+        data = record["text"].encode("utf-8", errors="replace")
+        starts[row] = offset
+        offset += len(data)
+        ends[row] = offset
+        blobs.append(data)
+
+    _write_columns(path, list(doc_index), doc_ids, chunk_ids, starts, ends, blobs, offset)
+
+
+def _write_columns(path: str, doc_names: list[str], doc_ids: np.ndarray, chunk_ids: np.ndarray,
+                   starts: np.ndarray, ends: np.ndarray, blobs, text_length: int):
+    """blobs is any iterable of bytes, so the text can be streamed from a file"""
+    columns = [("doc_ids", doc_ids), ("chunk_ids", chunk_ids), ("starts", starts), ("ends", ends)]
+    ranges = doc_ranges(doc_ids, len(doc_names))
+
+    # work out the offsets first, they go in the header which sits in front of everything
+    def build_header(base: int) -> dict:
+        sections = {}
+        pos = base
+        for name, arr in columns:
+            pos += _pad(pos)
+            sections[name] = {"offset": pos, "dtype": arr.dtype.str}
+            pos += arr.nbytes
+        pos += _pad(pos)
+        sections["text"] = {"offset": pos, "length": text_length}
+        return {"count": len(doc_ids), "doc_names": doc_names, "doc_ranges": ranges, "sections": sections}
+
+    # the header length moves the offsets which can change the header length, loop until it settles
+    header_length = 0
+    while True:
+        header = build_header(len(MAGIC) + 8 + header_length)
+        header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        if len(header_bytes) == header_length:
+            break
+        header_length = len(header_bytes)
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header_bytes)).tobytes())
+        f.write(header_bytes)
+        for name, arr in columns:
+            f.write(b"\0" * (header["sections"][name]["offset"] - f.tell()))
+            f.write(np.ascontiguousarray(arr).data) # memmapped columns go straight to disk
+        f.write(b"\0" * (header["sections"]["text"]["offset"] - f.tell()))
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path) # readers never see a half written file
+
+
+class ChunkMetaWriter:
+    """builds chunks.bin row by row without keeping the rows in memory
+
+    columns and text are appended to scratch files in work_dir, finish() stitches them
+    together. state() / truncate() let an interrupted ingest pick up where it stopped
+    """
+
+    _COLUMNS = [("doc_ids", "int32"), ("chunk_ids", "int32"), ("starts", "int64"), ("ends", "int64")]
+
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        os.makedirs(work_dir, exist_ok=True)
+        self._files = {name: open(os.path.join(work_dir, f"{name}.col"), "ab")
+                       for name, _ in self._COLUMNS + [("text", None)]}
+        self.doc_names: list[str] = []
+        self._doc_index: dict[str, int] = {}
+        self.rows = 0
+        self.text_bytes = 0
+
+    def _doc_id(self, doc_name: str) -> int:
+        doc_id = self._doc_index.get(doc_name)
+        if doc_id is None:
+            doc_id = self._doc_index[doc_name] = len(self.doc_names)
+            self.doc_names.append(doc_name)
+        return doc_id
+
+    def append_document(self, doc_name: str, text: str, spans: list[tuple[int, int]]):
+        """one row per (start, end) char span of text, the text is written once"""
+        if not spans:
+            return
+        spans = np.asarray(spans, dtype="int64").reshape(-1, 2)
+        lo, hi = int(spans[:, 0].min()), int(spans[:, 1].max())
+        data, offsets = utf8_offsets(text[lo:hi], (spans - lo).ravel())
+        offsets = offsets.reshape(-1, 2)
+        self.append_spans(doc_name, data, np.arange(len(spans)), offsets[:, 0], offsets[:, 1])
+
+    def append_spans(self, doc_name: str, blob: bytes, chunk_ids, starts, ends):
+        """rows that are [start, end) byte spans of blob, blob is written once"""
+        n = len(starts)
+        base = self.text_bytes
+        self._files["text"].write(blob)
+        self.text_bytes += len(blob)
+        columns = {
+            "doc_ids": np.full(n, self._doc_id(doc_name), dtype="int32"),
+            "chunk_ids": np.asarray(chunk_ids, dtype="int32"),
+            "starts": np.asarray(starts, dtype="int64") + base,
+            "ends": np.asarray(ends, dtype="int64") + base,
+        }
+        for name, _ in self._COLUMNS:
+            self._files[name].write(columns[name].tobytes())
+        self.rows += n
+
+    def append(self, records: list[dict]):
+        """rows that each bring their own text (eg. from an old chunks.jsonl)"""
+        n = len(records)
+        doc_ids = np.empty(n, dtype="int32")
+        chunk_ids = np.empty(n, dtype="int32")
+        starts = np.empty(n, dtype="int64")
+        ends = np.empty(n, dtype="int64")
+        text = self._files["text"]
+        for i, record in enumerate(records):
+            doc_ids[i] = self._doc_id(record["doc_name"])
+            chunk_ids[i] = record["chunk_id"]
+            data = record["text"].encode("utf-8", errors="replace")
+            starts[i] = self.text_bytes
+            self.text_bytes += len(data)
+            ends[i] = self.text_bytes
+            text.write(data)
+        for name, arr in [("doc_ids", doc_ids), ("chunk_ids", chunk_ids), ("starts", starts), ("ends", ends)]:
+            self._files[name].write(arr.tobytes())
+        self.rows += n
+
+    def state(self) -> dict:
+        for f in self._files.values():
+            f.flush()
+        return {"rows": self.rows, "text_bytes": self.text_bytes, "doc_names": list(self.doc_names)}
+
+    def truncate(self, state: dict):
+        """roll the scratch files back to an earlier state()"""
+        for name, dtype in self._COLUMNS:
+            self._files[name].truncate(state["rows"] * np.dtype(dtype).itemsize)
+        self._files["text"].truncate(state["text_bytes"])
+        self.rows = state["rows"]
+        self.text_bytes = state["text_bytes"]
+        self.doc_names = list(state["doc_names"])
+        self._doc_index = {name: i for i, name in enumerate(self.doc_names)}
+
+    def finish(self, path: str):
+        for f in self._files.values():
+            f.close()
+
+        def column(name, dtype):
+            if self.rows == 0:
+                return np.empty(0, dtype=dtype)
+            return np.memmap(os.path.join(self.work_dir, f"{name}.col"), dtype=dtype, mode="r", shape=(self.rows,))
+
+        def text_blocks():
+            with open(os.path.join(self.work_dir, "text.col"), "rb") as f:
+                yield from iter(lambda: f.read(1024 * 1024), b"")
+
+        doc_ids, chunk_ids, starts, ends = (column(name, dtype) for name, dtype in self._COLUMNS)
+        _write_columns(path, self.doc_names, doc_ids, chunk_ids, starts, ends, text_blocks(), self.text_bytes)
+
+
+class ChunkMeta:
+    """read only view over chunks.bin, behaves like a list of chunk dicts"""
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a chunk metadata file")
+        header_length = int(np.frombuffer(self._mm, dtype="uint64", count=1, offset=len(MAGIC))[0])
+        header_start = len(MAGIC) + 8
+        header = json.loads(self._mm[header_start:header_start + header_length].decode("utf-8"))
+
+        self.count = header["count"]
+        self.doc_names: list[str] = header["doc_names"]
+        sections = header["sections"]
+        # views straight into the mapped file, nothing is copied
+        self.doc_ids = self._column(sections["doc_ids"])
+        # files written before doc_ranges was in the header get it worked out from the column
+        self.doc_ranges = header.get("doc_ranges") or doc_ranges(self.doc_ids, len(self.doc_names))
+        self.chunk_ids = self._column(sections["chunk_ids"])
+        self.starts = self._column(sections["starts"])
+        self.ends = self._column(sections["ends"])
+        self._text_offset = sections["text"]["offset"]
+
+    def _column(self, section: dict) -> np.ndarray:
+        return np.frombuffer(self._mm, dtype=np.dtype(section["dtype"]), count=self.count,
+                             offset=section["offset"])
+
+    def __len__(self) -> int:
+        return self.count
+
+    def text(self, row: int) -> str:
+        start = self._text_offset + int(self.starts[row])
+        end = self._text_offset + int(self.ends[row])
+        return self._mm[start:end].decode("utf-8", errors="replace")
+
+    def spans(self, start: int, end: int) -> tuple[bytes, np.ndarray, np.ndarray, np.ndarray]:
+        """rows [start, end) as (text bytes they cover, chunk_ids, starts, ends) with the
+        offsets relative to those bytes, what ChunkMetaWriter.append_spans takes"""
+        lo = int(self.starts[start:end].min())
+        hi = int(self.ends[start:end].max())
+        blob = self._mm[self._text_offset + lo:self._text_offset + hi]
+        return blob, self.chunk_ids[start:end], self.starts[start:end] - lo, self.ends[start:end] - lo
+
+    def doc_name(self, row: int) -> str:
+        return self.doc_names[self.doc_ids[row]]
+
+    def __getitem__(self, row: int) -> dict:
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError(row)
+        return {
+            "doc_name": self.doc_name(row),
+            "chunk_id": int(self.chunk_ids[row]),
+            "text": self.text(row),
+        }
+
@@ -5,28 +5,22 @@
 # currently using char-based chunking first. works good for the MVP 
 # might go more advanced later
 
-def chunk_text( 
-        text: str,
+def chunk_spans(
+        text_length: int,
         chunk_size_chars: int = 1200,
         overlap_chars: int = 200,
-        ) -> list[dict]:
-    
-    chunks = []
+        ) -> list[tuple[int, int]]:
+    """(start, end) char offsets of every chunk, the text itself is never copied
+    with the default overlap ~17% of a document sits in two chunks, keeping spans over
+    one copy of the document means that text is only stored once"""
+    spans = []
     i = 0 # starting index in text
-    chunk_id = 0 # chunk index
-    n = len(text)
+    n = text_length
 
     while i < n:
         start = i
         end = min(i + chunk_size_chars, n) # you might be at the end of a text
-        chunk_body = text[start: end] # get length of the chunk start -> adjusted end
-        chunks.append({
-            "chunk_id": chunk_id,
-            "text": chunk_body,
-            "start": start,
-            "end": end,
-        })
-        chunk_id += 1
+        spans.append((start, end))
         i += chunk_size_chars - overlap_chars # start at overlap match point -> keeps context
 
         # in very small files you might have problems with i especially with low chars
@@ -34,4 +28,17 @@ def chunk_text(
         if i < start: # if they were equal it wouldnt be great either - havent considered it yet
             i = end
 
-    return chunks
\ No newline at end of file
+    return spans
+
+def chunk_text( 
+        text: str,
+        chunk_size_chars: int = 1200,
+        overlap_chars: int = 200,
+        ) -> list[dict]:
+    """chunks as dicts with their own copy of the text, ingest uses chunk_spans instead"""
+    return [{
+        "chunk_id": chunk_id,
+        "text": text[start: end], # get length of the chunk start -> adjusted end
+        "start": start,
+        "end": end,
+    } for chunk_id, (start, end) in enumerate(chunk_spans(len(text), chunk_size_chars, overlap_chars))]
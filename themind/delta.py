@@ -0,0 +1,169 @@
+# per document changes on top of a finished build, without rebuilding it
+# a build (faiss.index or shards + chunks.bin) never changes once written. adding,
+# replacing or removing one document only touches the delta next to it:
+#   delta.index  IndexIDMap2 over a flat index with the chunks added since the build
+#   delta.jsonl  {id, doc_name, chunk_id, text} of those chunks
+#   delta.json   next_id, the tombstoned build rows, which documents live where
+# so an update costs that document's parse + embed + a write of the (small) delta
+
+# ids are stable: build rows keep their row number as id, delta chunks get ids from
+# next_id up (never reused) so nothing shifts when a document goes away. a removed or
+# replaced document's build rows are tombstoned, searches skip them with an id selector
+
+# the delta and the tombstones only grow, compaction folds them back into a fresh build
+# (needs_compaction says when, the api runs it as a background re-ingest)
+
+import json
+import os
+import threading
+from pathlib import Path
+import faiss
+import numpy as np
+
+from .indexing import write_index
+
+DELTA_INDEX_NAME = "delta.index"
+DELTA_CHUNKS_NAME = "delta.jsonl"
+DELTA_STATE_NAME = "delta.json"
+DELTA_FILES = (DELTA_INDEX_NAME, DELTA_CHUNKS_NAME, DELTA_STATE_NAME)
+
+# compact once the delta has this many chunks or the delta + tombstones are this share of the build
+COMPACT_DELTA_ROWS = int(os.getenv("COMPACT_DELTA_ROWS", "50000"))
+COMPACT_RATIO = float(os.getenv("COMPACT_RATIO", "0.2"))
+
+
+def is_delta_file(name: str) -> bool:
+    return name in DELTA_FILES
+
+
+def remove_delta(index_dir: str):
+    """a new build already has everything the delta had"""
+    for name in DELTA_FILES:
+        path = Path(index_dir) / name
+        if path.exists():
+            path.unlink()
+
+
+class DeltaSegment:
+    """the chunks added since the build + the build rows that are gone"""
+
+    def __init__(self, dim: int, base_rows: int):
+        self.dim = dim
+        self.base_rows = base_rows
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+        self.records: dict[int, dict] = {} # id -> {doc_name, chunk_id, text}
+        self.docs: dict[str, list[int]] = {} # doc_name -> [first id, end id) in the delta
+        self.removed: list[str] = [] # build documents that are tombstoned
+        self.tombstones: list[list[int]] = [] # [start, end) build rows
+        self.next_id = base_rows
+        self.seq = 0 # bumps with every change, compaction checks it didnt move under it
+        self._lock = threading.Lock() # faiss' IDMap cant be searched while it is changed
+
+    @property
+    def rows(self) -> int:
+        return int(self.index.ntotal)
+
+    def tombstoned_rows(self) -> int:
+        return sum(end - start for start, end in self.tombstones)
+
+    def alive(self) -> np.ndarray | None:
+        """bool mask over the build rows, None when nothing is tombstoned"""
+        if not self.tombstones:
+            return None
+        mask = np.ones(self.base_rows, dtype=bool)
+        for start, end in self.tombstones:
+            mask[start:end] = False
+        return mask
+
+    def tombstone(self, doc_name: str, ranges: list):
+        self.removed.append(doc_name)
+        self.tombstones.extend([int(start), int(end)] for start, end in ranges)
+        self.seq += 1
+
+    def add(self, doc_name: str, vectors: np.ndarray, texts: list[str]) -> list[int]:
+        ids = np.arange(self.next_id, self.next_id + len(texts), dtype="int64")
+        with self._lock:
+            if len(texts):
+                self.index.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), ids)
+            for chunk_id, (i, text) in enumerate(zip(ids.tolist(), texts)):
+                self.records[i] = {"doc_name": doc_name, "chunk_id": chunk_id, "text": text}
+            self.docs[doc_name] = [self.next_id, self.next_id + len(texts)]
+            self.next_id += len(texts)
+            self.seq += 1
+        return ids.tolist()
+
+    def remove(self, doc_name: str) -> bool:
+        found = self.docs.pop(doc_name, None)
+        if found is None:
+            return False
+        start, end = found
+        with self._lock:
+            if end > start:
+                self.index.remove_ids(faiss.IDSelectorRange(start, end))
+            for i in range(start, end):
+                self.records.pop(i, None)
+            self.seq += 1
+        return True
+
+    def search(self, query_vectors: np.ndarray, k: int,
+               doc_names: list[str] | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """exact top-k over the delta chunks (of doc_names if given), ids are the stable ids"""
+        with self._lock:
+            if doc_names is None:
+                return self.index.search(query_vectors, k)
+            ids = [i for name in doc_names if name in self.docs for i in range(*self.docs[name])]
+            if not ids:
+                return (np.full((len(query_vectors), 0), np.inf, dtype="float32"),
+                        np.empty((len(query_vectors), 0), dtype="int64"))
+            ids = np.array(ids, dtype="int64")
+            vectors = self.index.reconstruct_batch(ids)
+        distances, rows = faiss.knn(query_vectors, vectors, min(k, len(ids)))
+        return distances, np.where(rows >= 0, ids[np.maximum(rows, 0)], -1)
+
+    def vectors(self, doc_name: str) -> np.ndarray:
+        start, end = self.docs[doc_name]
+        with self._lock:
+            return self.index.reconstruct_batch(np.arange(start, end, dtype="int64"))
+
+    def save(self, out_dir: str):
+        """the three delta files, each through a temp file so a reader never sees half of one"""
+        out = Path(out_dir)
+        with self._lock:
+            write_index(self.index, str(out / DELTA_INDEX_NAME))
+            records = sorted(self.records.items())
+        tmp = out / f"{DELTA_CHUNKS_NAME}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for i, record in records:
+                f.write(json.dumps({"id": i, **record}, ensure_ascii=False) + "\n")
+        os.replace(tmp, out / DELTA_CHUNKS_NAME)
+        state = {"base_rows": self.base_rows, "next_id": self.next_id, "seq": self.seq, "docs": self.docs,
+                 "removed": self.removed, "tombstones": self.tombstones}
+        tmp = out / f"{DELTA_STATE_NAME}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, out / DELTA_STATE_NAME)
+
+    @classmethod
+    def load(cls, index_dir: str, dim: int, base_rows: int) -> "DeltaSegment | None":
+        """the delta in index_dir, None if there is none. a delta made for another build
+        (different row count) is ignored, its tombstones would hit the wrong rows"""
+        index_dir = Path(index_dir)
+        if not all((index_dir / name).exists() for name in DELTA_FILES):
+            return None
+        with open(index_dir / DELTA_STATE_NAME, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if state["base_rows"] != base_rows:
+            return None
+        delta = cls(dim, base_rows)
+        delta.index = faiss.read_index(str(index_dir / DELTA_INDEX_NAME))
+        with open(index_dir / DELTA_CHUNKS_NAME, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    delta.records[record.pop("id")] = record
+        delta.next_id = state["next_id"]
+        delta.seq = state["seq"]
+        delta.docs = state["docs"]
+        delta.removed = state["removed"]
+        delta.tombstones = state["tombstones"]
+        return delta
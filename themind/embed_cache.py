@@ -0,0 +1,160 @@
+# disk cache for embeddings so the same text is never sent to the API twice
+# boilerplate pages show up in loads of PDFs and people ask the same questions, all of
+# that used to be re-embedded (and paid for) every time
+
+# keyed by sha256(model name + text), vectors stored as raw float32 bytes in sqlite
+# its in the standard library, handles the batch lookups for us and is safe to share
+# between threads and processes. when it grows past max_bytes the least recently
+# used vectors get dropped, the byte count lives in the file too (size table) so every
+# process sharing it evicts by the same number
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+import numpy as np
+
+DEFAULT_CACHE_PATH = "/tmp/themind/embeddings.sqlite"
+_LOOKUP_BATCH = 500 # sqlite has a limit on how many ? we can put in one query
+
+
+class EmbeddingCache:
+    """content addressed float32 vectors on disk with LRU eviction"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 512 * 1024 * 1024):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("BEGIN IMMEDIATE") # another process can be opening the same file
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS vectors ("
+            " key BLOB PRIMARY KEY, vec BLOB NOT NULL, last_used REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_last_used ON vectors(last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+        # files from before the size table start from whatever they hold
+        self._conn.execute(
+            "INSERT OR IGNORE INTO size (id, bytes) SELECT 0, COALESCE(SUM(LENGTH(vec)), 0) FROM vectors")
+        self._conn.commit()
+        self.used_bytes = self._size()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls):
+        """cache configured by EMBED_CACHE_PATH / EMBED_CACHE_MAX_MB, None if turned off"""
+        path = os.getenv("EMBED_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if not path or path.lower() == "off":
+            return None
+        max_mb = int(os.getenv("EMBED_CACHE_MAX_MB", "512"))
+        return cls(path, max_bytes=max_mb * 1024 * 1024)
+
+    @staticmethod
+    def make_key(model_name: str, text: str) -> bytes:
+        return hashlib.sha256(
+            model_name.encode("utf-8") + b"\0" + text.encode("utf-8", errors="surrogatepass")
+        ).digest()
+
+    def get_many(self, model_name: str, texts: list[str]) -> list[np.ndarray | None]:
+        """vector for every text, None where we dont have it"""
+        keys = [self.make_key(model_name, t) for t in texts]
+        found: dict[bytes, np.ndarray] = {}
+        unique_keys = list(dict.fromkeys(keys))
+
+        with self._lock:
+            for i in range(0, len(unique_keys), _LOOKUP_BATCH):
+                part = unique_keys[i:i + _LOOKUP_BATCH]
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM vectors WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype="float32")
+
+            if found:
+                # touch what we used so it survives the next eviction
+                now = time.time()
+                self._conn.executemany("UPDATE vectors SET last_used = ? WHERE key = ?",
+                                       [(now, k) for k in found])
+                self._conn.commit()
+
+            results = [found.get(k) for k in keys]
+            hits = sum(r is not None for r in results)
+            self.hits += hits
+            self.misses += len(results) - hits
+        return results
+
+    def put_many(self, model_name: str, texts: list[str], vectors: np.ndarray):
+        now = time.time()
+        rows = {}
+        for text, vec in zip(texts, vectors):
+            rows[self.make_key(model_name, text)] = np.ascontiguousarray(vec, dtype="float32").tobytes()
+        if not rows:
+            return
+
+        with self._lock:
+            # sqlite's write lock from the first read on, other processes cant change the
+            # size between us reading it and evicting by it
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # replacing an existing key should not count its bytes twice
+                existing = 0
+                keys = list(rows)
+                for i in range(0, len(keys), _LOOKUP_BATCH):
+                    part = keys[i:i + _LOOKUP_BATCH]
+                    existing += self._conn.execute(
+                        f"SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM vectors WHERE key IN ({','.join('?' * len(part))})",
+                        part,
+                    ).fetchone()[0]
+                self._conn.executemany("INSERT OR REPLACE INTO vectors (key, vec, last_used) VALUES (?, ?, ?)",
+                                       [(k, v, now) for k, v in rows.items()])
+                self._conn.execute("UPDATE size SET bytes = bytes + ?",
+                                   (sum(len(v) for v in rows.values()) - existing,))
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _size(self) -> int:
+        return self._conn.execute("SELECT bytes FROM size").fetchone()[0]
+
+    def _evict(self):
+        self.used_bytes = self._size() # includes what other processes wrote
+        if self.used_bytes <= self.max_bytes:
+            return
+        # go down to 90% so we dont evict again on the very next put
+        target = int(self.max_bytes * 0.9)
+        avg = self.used_bytes / max(1, self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0])
+        n = int((self.used_bytes - target) / max(avg, 1)) + 1
+        freed, count = self._conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(vec)), 0), COUNT(*) FROM ("
+            " SELECT vec FROM vectors ORDER BY last_used LIMIT ?)", (n,)
+        ).fetchone()
+        self._conn.execute(
+            "DELETE FROM vectors WHERE key IN (SELECT key FROM vectors ORDER BY last_used LIMIT ?)", (n,)
+        )
+        self._conn.execute("UPDATE size SET bytes = bytes - ?", (freed,))
+        self.used_bytes -= freed
+        self.evictions += count
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            self.used_bytes = self._size()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+            }
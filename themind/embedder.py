@@ -1,23 +1,101 @@
-from openai import OpenAI
+import asyncio
 import numpy as np
-import os
+
+from . import metrics
+from .embed_cache import EmbeddingCache
+from .embedding_backends import MAX_BATCH_ITEMS, MAX_BATCH_TOKENS, EmbeddingBackend, estimate_tokens, make_backend
 
 # load a pretrained sentence transformer model
 # we're using a class so that its reusable and loads once not every call -> more organized
-# model is 80mb so reloading it every time is slow and storing it globally is messy 
+# model is 80mb so reloading it every time is slow and storing it globally is messy
 # reduces reporducbility too!
+
+# the vectors come from a backend (embedding_backends.py: openai, local or hashing),
+# picked with EMBED_BACKEND. this class puts the embedding cache in front of it and
+# sends every distinct text to the backend only once, results always come back in
+# the same order as the input
+
+
 class Embedder:
-    def __init__(self, model_name: str = "text-embedding-3-small"):
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        self.model_name = model_name
+    def __init__(self, model_name: str | None = None,
+                 max_workers: int = None, max_batch_items: int = MAX_BATCH_ITEMS,
+                 max_batch_tokens: int = MAX_BATCH_TOKENS, cache: EmbeddingCache | None = None,
+                 backend: EmbeddingBackend | str | None = None):
+        if not isinstance(backend, EmbeddingBackend):
+            kwargs = {}
+            if (backend or "openai") == "openai":
+                kwargs = {"max_workers": max_workers, "max_batch_items": max_batch_items,
+                          "max_batch_tokens": max_batch_tokens}
+            backend = make_backend(backend, model_name, **kwargs)
+        self.backend = backend
+        # what the cache and the index are keyed on, differs per backend and model
+        self.model_name = backend.model_id
+        # on disk vectors we already paid for, shared by ingest and retrieval
+        self.cache = cache if cache is not None else EmbeddingCache.from_env()
+
+    @property
+    def dim(self) -> int | None:
+        return self.backend.dim
+
+    def describe(self) -> dict:
+        """what gets written into index_info.json so the index can check who is querying it"""
+        return {"backend": self.backend.name, "model": self.model_name, "dim": self.dim}
+
+    def _count(self, texts: list[str], sent: list[str]):
+        # sent = what actually went to the backend, the rest came out of the cache or
+        # was a duplicate within the same call
+        metrics.inc("themind_embedding_texts_total", len(texts) - len(sent), backend=self.backend.name, source="reused")
+        metrics.inc("themind_embedding_texts_total", len(sent), backend=self.backend.name, source="backend")
+        if metrics.ENABLED and sent:
+            metrics.inc("themind_embedding_tokens_total", sum(estimate_tokens(t) for t in sent),
+                        backend=self.backend.name)
 
     def encode(self, texts: list[str]) -> np.ndarray:
         # make sure its a list
         if isinstance(texts, str):
             texts = [texts]
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+
+        if self.cache is None:
+            self._count(texts, texts)
+            return self.backend.encode(texts)
+
+        cached = self.cache.get_many(self.model_name, texts)
+        # only the misses go to the backend and each distinct text only once
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        fresh: dict[str, np.ndarray] = {}
+        if missing:
+            vectors = self.backend.encode(missing)
+            self.cache.put_many(self.model_name, missing, vectors)
+            fresh = dict(zip(missing, vectors))
+        self._count(texts, missing)
+
+        return np.vstack([v if v is not None else fresh[t] for t, v in zip(texts, cached)]).astype("float32")
+
+    # async version for the api, same cache just without blocking the loop
+
+    async def aencode(self, texts: list[str]) -> np.ndarray:
+        if isinstance(texts, str):
+            texts = [texts]
+        if not texts:
+            return np.zeros((0, 0), dtype="float32")
+
+        if self.cache is None:
+            self._count(texts, texts)
+            return await self.backend.aencode(texts)
+
+        # sqlite is blocking so the cache runs in a thread
+        cached = await asyncio.to_thread(self.cache.get_many, self.model_name, texts)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, cached) if v is None))
+        fresh: dict[str, np.ndarray] = {}
+        if missing:
+            vectors = await self.backend.aencode(missing)
+            await asyncio.to_thread(self.cache.put_many, self.model_name, missing, vectors)
+            fresh = dict(zip(missing, vectors))
+        self._count(texts, missing)
 
-        response = self.client.embeddings.create(model=self.model_name, input=texts) # we want numpy not torch object - no training needed
-        
-        vectors = [item.embedding for item in response.data]
-        return np.array(vectors, dtype="float32")
+        return np.vstack([v if v is not None else fresh[t] for t, v in zip(texts, cached)]).astype("float32")
 
+    async def aclose(self):
+        await self.backend.aclose()
@@ -0,0 +1,271 @@
+# where the vectors actually come from, Embedder (embedder.py) puts the cache in front
+# of whichever one of these we use
+
+# openai   text-embedding-3-* over the API, batched + shared backoff on 429 / 5xx / dropped connections
+# local    a sentence-transformers model on our own CPU, no network round trip per
+#          question, optional int8 (dynamic quantization) or onnx for speed
+# hashing  feature hashing of words, deterministic and instant, not semantic at all.
+#          for tests and benchmarks that shouldnt need a network or a model download
+
+# every backend has a model_id, it keys the embedding cache and gets written into the
+# index so an index is never queried with vectors from a different backend
+
+import asyncio
+import hashlib
+import os
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from openai import (APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, OpenAI,
+                    RateLimitError)
+
+BACKENDS = ["openai", "local", "hashing"]
+
+MAX_BATCH_ITEMS = 256 # API allows 2048 inputs but big requests are slow to retry
+MAX_BATCH_TOKENS = 100_000 # API limit is 300k tokens per request, stay well below
+MAX_RETRIES = 6
+# what the openai client would have retried on its own: 429, 5xx, timeouts and connection resets
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APITimeoutError, APIConnectionError)
+
+# dimensions of the openai models so a mismatch is caught before the first API call
+OPENAI_DIMS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072, "text-embedding-ada-002": 1536}
+
+
+def estimate_tokens(text: str) -> int:
+    # roughly 4 chars per token for english, good enough for packing
+    return len(text) // 4 + 1
+
+
+def make_batches(texts: list[str], max_items: int = MAX_BATCH_ITEMS,
+                 max_tokens: int = MAX_BATCH_TOKENS) -> list[tuple[int, int]]:
+    """split texts into consecutive (start, end) ranges that respect both caps"""
+    batches = []
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        n = estimate_tokens(text)
+        if i > start and (i - start >= max_items or tokens + n > max_tokens):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+class EmbeddingBackend:
+    """texts in, float32 [len(texts), dim] out, in the same order"""
+
+    name = "base"
+
+    def __init__(self, model_name: str, dim: int | None = None):
+        self.model_name = model_name
+        self.dim = dim # None until we know it (eg. an openai model we have no table entry for)
+
+    @property
+    def model_id(self) -> str:
+        return f"{self.name}:{self.model_name}"
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        raise NotImplementedError
+
+    async def aencode(self, texts: list[str]) -> np.ndarray:
+        # cpu bound backends just move off the event loop
+        return await asyncio.to_thread(self.encode, texts)
+
+    async def aclose(self):
+        pass
+
+
+class OpenAIBackend(EmbeddingBackend):
+    name = "openai"
+
+    def __init__(self, model_name: str = "text-embedding-3-small", max_workers: int = None,
+                 max_batch_items: int = MAX_BATCH_ITEMS, max_batch_tokens: int = MAX_BATCH_TOKENS):
+        super().__init__(model_name, OPENAI_DIMS.get(model_name))
+        # we do our own retrying below so the client should not retry on its own
+        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        self._async_client = None # made on first aencode, it belongs to the running event loop
+        self.max_workers = max_workers or int(os.getenv("EMBED_MAX_WORKERS", "4"))
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+
+        # shared between worker threads -> one 429 (or 502) pauses every batch not just the one that got it
+        self._backoff_lock = threading.Lock()
+        self._backoff = 0.0 # current delay in seconds, grows on every retry and shrinks on success
+        self._pause_until = 0.0
+
+    @property
+    def model_id(self) -> str:
+        # plain model name, thats what every index and cache entry from before backends has
+        return self.model_name
+
+    def _wait_for_backoff(self):
+        with self._backoff_lock:
+            delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _on_retryable(self, error: Exception):
+        retry_after = None
+        try:
+            retry_after = float(error.response.headers.get("retry-after"))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        with self._backoff_lock:
+            self._backoff = min(max(self._backoff * 2, 0.5), 30.0)
+            delay = retry_after if retry_after is not None else self._backoff
+            delay *= 1 + random.random() * 0.25 # jitter so the workers dont all come back at once
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+
+    def _on_success(self):
+        with self._backoff_lock:
+            self._backoff /= 2
+
+    def _encode_batch(self, texts: list[str]) -> np.ndarray:
+        for attempt in range(MAX_RETRIES + 1):
+            self._wait_for_backoff()
+            try:
+                response = self.client.embeddings.create(model=self.model_name, input=texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                self._on_retryable(e)
+                continue
+            self._on_success()
+            # the API gives an index per item, dont rely on the order of data
+            vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            return np.array(vectors, dtype="float32")
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        batches = make_batches(texts, self.max_batch_items, self.max_batch_tokens)
+        if len(batches) == 1:
+            return self._encode_batch(texts) # single question, dont bother with threads
+
+        workers = min(self.max_workers, len(batches))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # map keeps the batch order so rows line up with the input texts
+            parts = list(pool.map(lambda b: self._encode_batch(texts[b[0]:b[1]]), batches))
+        return np.vstack(parts)
+
+    async def _aencode_batch(self, texts: list[str]) -> np.ndarray:
+        for attempt in range(MAX_RETRIES + 1):
+            with self._backoff_lock:
+                delay = self._pause_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                response = await self._async_client.embeddings.create(model=self.model_name, input=texts)
+            except RETRYABLE_ERRORS as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                self._on_retryable(e)
+                continue
+            self._on_success()
+            vectors = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            return np.array(vectors, dtype="float32")
+
+    async def aencode(self, texts: list[str]) -> np.ndarray:
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+        batches = make_batches(texts, self.max_batch_items, self.max_batch_tokens)
+        limit = asyncio.Semaphore(self.max_workers)
+
+        async def run(batch):
+            async with limit:
+                return await self._aencode_batch(texts[batch[0]:batch[1]])
+
+        # gather keeps the order of the batches
+        parts = await asyncio.gather(*(run(b) for b in batches))
+        return np.vstack(parts)
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+
+
+class LocalBackend(EmbeddingBackend):
+    """sentence-transformers on CPU, pip install sentence-transformers (+ optimum[onnxruntime] for onnx)"""
+
+    name = "local"
+
+    def __init__(self, model_name: str = "sentence-transformers/all-MiniLM-L6-v2", batch_size: int = 64,
+                 accel: str | None = None, device: str = "cpu"):
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError as e:
+            raise ImportError("the local embedding backend needs sentence-transformers installed") from e
+
+        if accel == "onnx":
+            model = SentenceTransformer(model_name, device=device, backend="onnx")
+        else:
+            model = SentenceTransformer(model_name, device=device)
+        if accel == "int8":
+            # int8 linear layers, ~2x faster on CPU for a tiny change in the vectors
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        elif accel not in (None, "onnx"):
+            raise ValueError(f"unknown accel {accel}, use int8 or onnx")
+
+        super().__init__(model_name, model.get_sentence_embedding_dimension())
+        self.model = model
+        self.batch_size = batch_size
+        self.accel = accel
+        self._lock = threading.Lock() # torch already uses every core, running two at once only thrashes
+
+    @property
+    def model_id(self) -> str:
+        # quantized vectors are close to the float ones but not the same, dont mix them in the cache
+        return f"local:{self.model_name}" + (f":{self.accel}" if self.accel else "")
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        with self._lock:
+            # encode sorts by length internally so each batch pads as little as possible
+            vectors = self.model.encode(texts, batch_size=self.batch_size, convert_to_numpy=True,
+                                        normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype="float32")
+
+
+_TOKEN = re.compile(r"\w+")
+
+
+class HashingBackend(EmbeddingBackend):
+    """signed feature hashing of words and word pairs, same text -> same vector, always"""
+
+    name = "hashing"
+
+    def __init__(self, dim: int = 256):
+        super().__init__(f"{dim}", dim)
+
+    def _hash(self, token: str) -> tuple[int, float]:
+        h = int.from_bytes(hashlib.blake2b(token.encode("utf-8", errors="replace"), digest_size=8).digest(), "little")
+        return h % self.dim, 1.0 if h >> 63 else -1.0
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            words = _TOKEN.findall(text.lower())
+            for token in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+                col, sign = self._hash(token)
+                out[row, col] += sign
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        return out / np.where(norms > 0, norms, 1)
+
+
+def make_backend(name: str | None = None, model_name: str | None = None, **kwargs) -> EmbeddingBackend:
+    """backend by name (default EMBED_BACKEND env, then openai), model_name None = its default
+    local reads EMBED_LOCAL_ACCEL (int8/onnx), hashing reads EMBED_HASH_DIM"""
+    name = name or os.getenv("EMBED_BACKEND", "openai")
+    if name == "openai":
+        return OpenAIBackend(model_name or "text-embedding-3-small", **kwargs)
+    if name == "local":
+        return LocalBackend(model_name or os.getenv("EMBED_LOCAL_MODEL", "sentence-transformers/all-MiniLM-L6-v2"),
+                            accel=os.getenv("EMBED_LOCAL_ACCEL") or None)
+    if name == "hashing":
+        return HashingBackend(int(model_name or os.getenv("EMBED_HASH_DIM", "256")))
+    raise ValueError(f"unknown embedding backend {name}, use one of {BACKENDS}")
@@ -0,0 +1,292 @@
+# http plumbing for talking to the LLM
+# a bare requests.post means a new TLS handshake every question and one 429 or 502
+# kills the whole /ask. this keeps pooled keep-alive connections around (requests.Session
+# for sync, httpx.AsyncClient for async), retries the errors worth retrying with jittered
+# backoff and can optionally hedge: if the first call is slower than our recent p95 we fire
+# a second identical one and take whichever answers first
+
+# every call records its attempts (status, time, whether it was a hedge) so we can tune it
+
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    """an attempt failed in a way that is worth trying again"""
+
+    def __init__(self, message: str, retry_after: float | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _retry_after(headers) -> float | None:
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class HedgedTransport:
+    """pooled POST-json-get-json with retries and optional hedged requests"""
+
+    def __init__(self, timeout: float = 20.0, retries: int = 3, backoff_base: float = 0.25,
+                 backoff_max: float = 8.0, hedge: bool = False, hedge_min_delay: float = 0.5,
+                 hedge_quantile: float = 0.95, pool_size: int = 20, window: int = 200):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_quantile = hedge_quantile
+        self.pool_size = pool_size
+
+        # keep-alive pool, one TLS handshake per connection instead of per question
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._hedge_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="llm-hedge")
+        self._async_client = None
+
+        self._lock = threading.Lock()
+        self._latencies: deque = deque(maxlen=window) # successful attempt times in seconds
+        self.recent_calls: deque = deque(maxlen=50) # attempt breakdown of the last calls
+        self.calls = 0
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            timeout=float(os.getenv("LLM_TIMEOUT_SECONDS", "20")),
+            retries=int(os.getenv("LLM_RETRIES", "3")),
+            hedge=os.getenv("LLM_HEDGE", "0") == "1",
+            hedge_min_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY_MS", "500")) / 1000,
+            pool_size=int(os.getenv("LLM_POOL_SIZE", "20")),
+        )
+
+    # timing bookkeeping
+
+    def hedge_delay(self) -> float | None:
+        """how long to wait before hedging, None until we have enough samples to know our p95"""
+        with self._lock:
+            if len(self._latencies) < 20:
+                return None
+            p = float(sorted(self._latencies)[int(self.hedge_quantile * (len(self._latencies) - 1))])
+        return max(self.hedge_min_delay, p)
+
+    def _backoff(self, attempt: int, retry_after: float | None) -> float:
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # full jitter, spreads retries out so we dont hammer a struggling server in sync
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _record(self, attempts: list[dict], hedged: bool, hedge_won: bool):
+        with self._lock:
+            self.calls += 1
+            self.retried += any(a["attempt"] > 0 for a in attempts)
+            self.hedged += hedged
+            self.hedge_wins += hedge_won
+            for a in attempts:
+                # stream attempts only time the headers, they would drag our p95 down
+                if a.get("ok") and not a.get("stream"):
+                    self._latencies.append(a["ms"] / 1000)
+            self.recent_calls.append(attempts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self._latencies)
+        pct = lambda q: round(lat[int(q * (len(lat) - 1))] * 1000, 1) if lat else None
+        hedge_delay = self.hedge_delay()
+        return {
+            "calls": self.calls,
+            "retried": self.retried,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "hedge_delay_ms": round(hedge_delay * 1000, 1) if hedge_delay is not None else None,
+            "recent_calls": list(self.recent_calls)[-5:],
+        }
+
+    # sync
+
+    def _attempt(self, url: str, headers: dict, payload: dict, log: dict) -> dict:
+        start = time.perf_counter()
+        try:
+            resp = self.session.post(url, headers=headers, json=payload, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            log.update(ms=round((time.perf_counter() - start) * 1000, 1), error=type(e).__name__)
+            raise RetryableError(str(e))
+        log.update(ms=round((time.perf_counter() - start) * 1000, 1), status=resp.status_code)
+        if resp.status_code in RETRY_STATUSES:
+            raise RetryableError(f"status {resp.status_code}", _retry_after(resp.headers))
+        # check if there were any issues by checking status
+        resp.raise_for_status()
+        log["ok"] = True
+        return resp.json()
+
+    def _hedged_attempt(self, url, headers, payload, attempt: int, attempts: list[dict]):
+        """one attempt, possibly raced against a hedge, returns (data, hedge_won)"""
+        primary_log = {"attempt": attempt, "hedge": False}
+        attempts.append(primary_log)
+        delay = self.hedge_delay() if self.hedge else None
+        if delay is None:
+            return self._attempt(url, headers, payload, primary_log), False
+
+        futures = {self._hedge_pool.submit(self._attempt, url, headers, payload, primary_log): False}
+        done, _ = wait(futures, timeout=delay)
+        if not done:
+            hedge_log = {"attempt": attempt, "hedge": True}
+            attempts.append(hedge_log)
+            futures[self._hedge_pool.submit(self._attempt, url, headers, payload, hedge_log)] = True
+
+        # first one that succeeds wins, only give up if all of them failed
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result(), futures[future]
+                except Exception as e:
+                    error = e
+        raise error
+
+    def post_json(self, url: str, headers: dict, payload: dict) -> dict:
+        attempts: list[dict] = []
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    data, hedge_won = self._hedged_attempt(url, headers, payload, attempt, attempts)
+                    self._record(attempts, any(a["hedge"] for a in attempts), hedge_won)
+                    return data
+                except RetryableError as e:
+                    if attempt == self.retries:
+                        raise
+                    time.sleep(self._backoff(attempt, e.retry_after))
+        except Exception:
+            self._record(attempts, any(a["hedge"] for a in attempts), False)
+            raise
+
+    # async
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.pool_size * 5, max_keepalive_connections=self.pool_size),
+            )
+        return self._async_client
+
+    async def _aattempt(self, url: str, headers: dict, payload: dict, log: dict) -> dict:
+        start = time.perf_counter()
+        try:
+            resp = await self._client().post(url, headers=headers, json=payload)
+        except httpx.TransportError as e:
+            log.update(ms=round((time.perf_counter() - start) * 1000, 1), error=type(e).__name__)
+            raise RetryableError(str(e))
+        log.update(ms=round((time.perf_counter() - start) * 1000, 1), status=resp.status_code)
+        if resp.status_code in RETRY_STATUSES:
+            raise RetryableError(f"status {resp.status_code}", _retry_after(resp.headers))
+        resp.raise_for_status()
+        log["ok"] = True
+        return resp.json()
+
+    async def _ahedged_attempt(self, url, headers, payload, attempt: int, attempts: list[dict]):
+        primary_log = {"attempt": attempt, "hedge": False}
+        attempts.append(primary_log)
+        delay = self.hedge_delay() if self.hedge else None
+        if delay is None:
+            return await self._aattempt(url, headers, payload, primary_log), False
+
+        tasks = {asyncio.ensure_future(self._aattempt(url, headers, payload, primary_log)): False}
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            hedge_log = {"attempt": attempt, "hedge": True}
+            attempts.append(hedge_log)
+            tasks[asyncio.ensure_future(self._aattempt(url, headers, payload, hedge_log))] = True
+
+        pending = set(tasks)
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result(), tasks[task]
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel() # the loser doesnt need to finish
+
+    async def apost_json(self, url: str, headers: dict, payload: dict) -> dict:
+        attempts: list[dict] = []
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    data, hedge_won = await self._ahedged_attempt(url, headers, payload, attempt, attempts)
+                    self._record(attempts, any(a["hedge"] for a in attempts), hedge_won)
+                    return data
+                except RetryableError as e:
+                    if attempt == self.retries:
+                        raise
+                    await asyncio.sleep(self._backoff(attempt, e.retry_after))
+        except Exception:
+            self._record(attempts, any(a["hedge"] for a in attempts), False)
+            raise
+
+    async def astream(self, url: str, headers: dict, payload: dict) -> httpx.Response:
+        """open a streaming response, retried until the first byte (after that its too late)
+        the caller has to aclose() it"""
+        attempts: list[dict] = []
+        for attempt in range(self.retries + 1):
+            log = {"attempt": attempt, "hedge": False, "stream": True}
+            attempts.append(log)
+            start = time.perf_counter()
+            try:
+                request = self._client().build_request("POST", url, headers=headers, json=payload)
+                resp = await self._client().send(request, stream=True)
+            except httpx.TransportError as e:
+                log.update(ms=round((time.perf_counter() - start) * 1000, 1), error=type(e).__name__)
+                if attempt == self.retries:
+                    self._record(attempts, False, False)
+                    raise
+                await asyncio.sleep(self._backoff(attempt, None))
+                continue
+
+            log.update(ms=round((time.perf_counter() - start) * 1000, 1), status=resp.status_code)
+            if resp.status_code in RETRY_STATUSES and attempt < self.retries:
+                await resp.aclose()
+                await asyncio.sleep(self._backoff(attempt, _retry_after(resp.headers)))
+                continue
+            if resp.status_code >= 400:
+                await resp.aclose()
+                self._record(attempts, False, False)
+                resp.raise_for_status()
+            log["ok"] = True
+            self._record(attempts, False, False)
+            return resp
+
+    async def aclose(self):
+        if self._async_client is not None:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def close(self):
+        self.session.close()
+        self._hedge_pool.shutdown(wait=False)
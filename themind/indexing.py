@@ -0,0 +1,359 @@
+# picks and builds the FAISS index for a corpus
+# IndexFlatL2 scans every vector on every query, fine for a few thousand chunks but our
+# big tenants have way more than that. approximate indexes (IVF, HNSW, IVF-PQ) trade a
+# little recall for a lot of speed so we pick one based on how many vectors there are
+
+# every build measures recall@k against an exact search on a sample of its own vectors
+# and writes it down in index_info.json so we know what we gave up
+
+# compression swaps the float32 vectors inside the index for fp16 / int8 (scalar
+# quantization) or PQ codes: 2x / 4x / ~64x smaller faiss.index, which is what every
+# tenant cold start downloads and holds in RAM. the full vectors can be kept next to it
+# (vectors.npy, mmap'd, only the rows we rerank get read) to re-score the top candidates
+# exactly, build_index reports size, latency and recall with and without that rerank
+
+# read_index maps faiss.index read only instead of copying it onto the heap (INDEX_MMAP,
+# on by default), the pages then belong to the page cache and every uvicorn worker that
+# maps the same file shares them. files that are mapped are never rewritten in place,
+# a new build goes to a temp file that replaces the old one
+
+import json
+import math
+import os
+import time
+from pathlib import Path
+import faiss
+import numpy as np
+
+INDEX_TYPES = ["flat", "hnsw", "ivf", "ivfpq"]
+COMPRESSIONS = ["none", "fp16", "sq8", "pq"]
+INFO_NAME = "index_info.json"
+VECTORS_NAME = "vectors.npy" # full float32 vectors of a compressed index, only if asked for
+
+RECALL_K = 10
+RECALL_QUERIES = 200
+HNSW_M = 32 # neighbours per node
+DEFAULT_EF_SEARCH = 64
+MAX_TRAIN_POINTS = 100_000 # kmeans doesnt get better past this, only slower
+ADD_BLOCK = 65536
+MIN_PQ_POINTS = 256 * 39 # PQ trains 256 centroids per sub quantizer, below this use sq8
+RERANK_FACTOR = 4 # candidates per wanted result when we rerank with the full vectors
+SCAN_BLOCK = 4096 # rows per step of an exact scan
+INDEX_MMAP = os.getenv("INDEX_MMAP", "on").lower() not in ("0", "off", "false", "no")
+
+
+def choose_index_type(n_vectors: int) -> str:
+    """exact search while its cheap, graph for mid size, inverted lists for big, compressed for huge"""
+    if n_vectors < 20_000:
+        return "flat"
+    if n_vectors < 200_000:
+        return "hnsw"
+    if n_vectors < 2_000_000:
+        return "ivf"
+    return "ivfpq"
+
+
+def _nlist(n_vectors: int) -> int:
+    # usual rule of thumb is ~4*sqrt(n) lists, kmeans wants 39+ training points per list
+    # and it only ever sees MAX_TRAIN_POINTS of them (build_index samples)
+    return max(1, min(int(4 * math.sqrt(n_vectors)), min(n_vectors, MAX_TRAIN_POINTS) // 39))
+
+
+def _pq_m(dim: int) -> int:
+    # number of sub quantizers has to divide the dimension, aim for ~16 dims each
+    for m in range(max(1, dim // 16), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def _storage(compression: str, dim: int) -> str:
+    """how each vector is stored inside the index"""
+    if compression == "none":
+        return "Flat"
+    if compression == "fp16":
+        return "SQfp16"
+    if compression == "sq8":
+        return "SQ8"
+    if compression == "pq":
+        return f"PQ{_pq_m(dim)}"
+    raise ValueError(f"unknown compression {compression}, use one of {COMPRESSIONS}")
+
+
+def factory_string(index_type: str, n_vectors: int, dim: int, compression: str = "none") -> str:
+    storage = _storage(compression, dim)
+    if index_type == "flat":
+        return storage
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}" if compression == "none" else f"HNSW{HNSW_M},{storage}"
+    if index_type == "ivf":
+        return f"IVF{_nlist(n_vectors)},{storage}"
+    if index_type == "ivfpq":
+        return f"IVF{_nlist(n_vectors)},PQ{_pq_m(dim)}" # already compressed, thats what the pq is
+    raise ValueError(f"unknown index type {index_type}, use one of {INDEX_TYPES} or auto")
+
+
+def search_params(index, nprobe: int | None = None, ef_search: int | None = None, selector=None):
+    """per call search knobs, None means use what the index was built with
+
+    passed to index.search(params=...) so concurrent queries never fight over
+    a setting stored on the shared index. selector (a faiss.IDSelector) limits the
+    search to some vector ids. indexes that cant take one (takes_selector) get None,
+    the caller has to filter those itself
+    """
+    if selector is not None and not takes_selector(index):
+        return None
+    extra = {"sel": selector} if selector is not None else {}
+    if isinstance(index, faiss.IndexIVF):
+        if nprobe is None and selector is None:
+            return None
+        # a params object replaces all the index settings, so carry over the ones we dont change
+        return faiss.SearchParametersIVF(nprobe=int(nprobe if nprobe is not None else index.nprobe), **extra)
+    if isinstance(index, faiss.IndexHNSW):
+        if ef_search is None and selector is None:
+            return None
+        return faiss.SearchParametersHNSW(
+            efSearch=int(ef_search if ef_search is not None else index.hnsw.efSearch), **extra)
+    return faiss.SearchParameters(**extra) if selector is not None else None
+
+
+def takes_selector(index) -> bool:
+    """False for a bare IndexPQ (flat + pq codes), its search refuses any params"""
+    return not isinstance(index, faiss.IndexPQ)
+
+
+def search_alive(index, queries: np.ndarray, k: int, alive: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """index.search that only returns rows where alive is True, for an index that cant take
+    a selector. asks for k + the number of dead rows so k alive ones are always left"""
+    dead = len(alive) - int(np.count_nonzero(alive))
+    distances, ids = index.search(queries, k + dead)
+    keep = (ids >= 0) & alive[np.maximum(ids, 0)]
+    order = np.argsort(~keep, axis=1, kind="stable")[:, :k] # alive ones first, still by distance
+    return (np.take_along_axis(np.where(keep, distances, np.inf), order, axis=1),
+            np.take_along_axis(np.where(keep, ids, -1), order, axis=1))
+
+
+def scan_ranges(queries: np.ndarray, k: int, ranges: list[tuple[int, int]],
+                rows) -> tuple[np.ndarray, np.ndarray]:
+    """exact top-k over just the [start, end) ranges, rows(start, n) gives their vectors
+    a block at a time, merged as we go. same (distances, ids) shape as index.search"""
+    best_d = np.full((len(queries), 0), np.inf, dtype="float32")
+    best_i = np.empty((len(queries), 0), dtype="int64")
+    for start, end in ranges:
+        for block in range(start, end, SCAN_BLOCK):
+            n = min(SCAN_BLOCK, end - block)
+            d, i = faiss.knn(queries, rows(block, n), min(k, n))
+            best_d = np.hstack([best_d, d])
+            best_i = np.hstack([best_i, i + block])
+            if best_d.shape[1] > k:
+                keep = np.argpartition(best_d, k - 1, axis=1)[:, :k]
+                best_d = np.take_along_axis(best_d, keep, axis=1)
+                best_i = np.take_along_axis(best_i, keep, axis=1)
+    order = np.argsort(best_d, axis=1, kind="stable")
+    return np.take_along_axis(best_d, order, axis=1), np.take_along_axis(best_i, order, axis=1)
+
+
+def range_selector(ranges: list[tuple[int, int]], ntotal: int):
+    """IDSelector for a list of [start, end) id ranges, returns (selector, buffer it needs alive)"""
+    if len(ranges) == 1:
+        return faiss.IDSelectorRange(int(ranges[0][0]), int(ranges[0][1])), None
+    mask = np.zeros(ntotal, dtype=bool)
+    for start, end in ranges:
+        mask[start:end] = True
+    return mask_selector(mask)
+
+
+def mask_selector(mask: np.ndarray):
+    """IDSelector for the ids where mask is True, returns (selector, buffer it needs alive)"""
+    bitmap = np.packbits(mask, bitorder="little") # faiss reads bit (id & 7) of byte (id >> 3)
+    return faiss.IDSelectorBitmap(len(mask), faiss.swig_ptr(bitmap)), bitmap
+
+
+def _exact_knn(queries: np.ndarray, vectors: np.ndarray, k: int, block: int = 65536) -> np.ndarray:
+    """exact top-k ids by scanning vectors in blocks, never needs a second copy of the corpus"""
+    best_d = np.full((len(queries), 0), np.inf, dtype="float32")
+    best_i = np.empty((len(queries), 0), dtype="int64")
+    for start in range(0, len(vectors), block):
+        part = np.ascontiguousarray(vectors[start:start + block], dtype="float32")
+        d = faiss.pairwise_distances(queries, part) # squared L2, same as IndexFlatL2
+        ids = np.broadcast_to(np.arange(start, start + len(part)), d.shape)
+        best_d = np.hstack([best_d, d])
+        best_i = np.hstack([best_i, ids])
+        if best_d.shape[1] > k:
+            keep = np.argpartition(best_d, k - 1, axis=1)[:, :k]
+            best_d = np.take_along_axis(best_d, keep, axis=1)
+            best_i = np.take_along_axis(best_i, keep, axis=1)
+    return best_i
+
+
+def rerank(queries: np.ndarray, candidates: np.ndarray, vectors: np.ndarray,
+           k: int) -> tuple[np.ndarray, np.ndarray]:
+    """exact (distances, ids) of the best k candidates per query, -1 candidates are skipped
+    vectors is the full [n, dim] matrix, usually a memmap, only candidate rows are read"""
+    out_d = np.full((len(queries), k), np.inf, dtype="float32")
+    out_i = np.full((len(queries), k), -1, dtype="int64")
+    for q, row in enumerate(candidates):
+        ids = np.unique(row[row >= 0]) # sorted, so the memmap reads go forward
+        if not len(ids):
+            continue
+        d = faiss.pairwise_distances(queries[q:q + 1], np.ascontiguousarray(vectors[ids], dtype="float32"))[0]
+        best = np.argsort(d, kind="stable")[:k]
+        out_d[q, :len(best)] = d[best]
+        out_i[q, :len(best)] = ids[best]
+    return out_d, out_i
+
+
+def _evaluate(index, vectors: np.ndarray, rerank_vectors: bool, k: int = RECALL_K,
+              n_queries: int = RECALL_QUERIES) -> dict:
+    """recall@k and search latency on a sample of the index's own vectors"""
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False))
+    queries = np.ascontiguousarray(vectors[rows], dtype="float32")
+    k = min(k, len(vectors))
+
+    truth = _exact_knn(queries, vectors, k)
+
+    def recall(found):
+        return round(sum(len(set(t) & set(f)) for t, f in zip(truth, found)) / (len(queries) * k), 4)
+
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    seconds = time.perf_counter() - start
+    result = {"recall_at_k": recall(found), "search_ms": round(seconds * 1000 / len(queries), 4)}
+
+    if rerank_vectors:
+        start = time.perf_counter()
+        _, candidates = index.search(queries, k * RERANK_FACTOR)
+        _, found = rerank(queries, candidates, vectors, k)
+        seconds = time.perf_counter() - start
+        result.update(rerank_recall_at_k=recall(found), rerank_search_ms=round(seconds * 1000 / len(queries), 4))
+    return result
+
+
+def build_index(vectors: np.ndarray, index_type: str = "auto", compression: str = "none",
+                keep_vectors: bool = False) -> tuple[faiss.Index, dict]:
+    """train (if needed) and fill an index, returns it together with its build info
+    keep_vectors says the full vectors get saved too, so the report includes the rerank"""
+    n, dim = vectors.shape
+    if index_type in (None, "", "auto"):
+        index_type = choose_index_type(n)
+    compression = compression or "none"
+    if index_type == "ivfpq":
+        if n < MIN_PQ_POINTS:
+            index_type, compression = "ivf", "sq8" # same fallback as below, eg. a small shard
+        else:
+            compression = "pq"
+    elif compression == "pq" and n < MIN_PQ_POINTS:
+        compression = "sq8" # too few vectors to train the PQ codebooks, int8 is the next best
+
+    start = time.perf_counter()
+    factory = factory_string(index_type, n, dim, compression)
+    index = faiss.index_factory(dim, factory, faiss.METRIC_L2)
+
+    if not index.is_trained:
+        # train on a sample, the whole corpus is slow and not more accurate
+        if n > MAX_TRAIN_POINTS:
+            rows = np.random.default_rng(0).choice(n, size=MAX_TRAIN_POINTS, replace=False)
+            index.train(np.ascontiguousarray(vectors[np.sort(rows)]))
+        else:
+            index.train(np.ascontiguousarray(vectors, dtype="float32"))
+
+    search = {}
+    if isinstance(index, faiss.IndexIVF):
+        # a few lists per query is the usual sweet spot, its overridable per query anyway
+        index.nprobe = min(index.nlist, max(8, min(64, index.nlist // 16)))
+        search["nprobe"] = index.nprobe
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = DEFAULT_EF_SEARCH
+        search["ef_search"] = DEFAULT_EF_SEARCH
+
+    # add in blocks, vectors can be a memmap of the ingest spool and we dont want it all paged in twice
+    for row in range(0, n, ADD_BLOCK):
+        index.add(np.ascontiguousarray(vectors[row:row + ADD_BLOCK], dtype="float32"))
+    build_seconds = time.perf_counter() - start
+
+    rerank_vectors = keep_vectors and compression != "none" and n > 0
+    quality = _evaluate(index, vectors, rerank_vectors) if n else {"recall_at_k": 1.0}
+    info = {
+        "index_type": index_type,
+        "compression": compression,
+        "factory": factory,
+        "ntotal": int(index.ntotal),
+        "dim": int(dim),
+        "search": search,
+        "build_seconds": round(build_seconds, 3),
+        "recall_k": RECALL_K,
+        **quality,
+        "rerank": rerank_vectors,
+        "raw_vector_bytes": int(n) * int(dim) * 4,
+    }
+    return index, info
+
+
+def keeps_exact_vectors(index) -> bool:
+    """False when the index only has compressed codes (PQ, SQ) that give an approximation back"""
+    if isinstance(index, faiss.IndexIVF):
+        return isinstance(index, faiss.IndexIVFFlat)
+    if isinstance(index, faiss.IndexHNSW):
+        return isinstance(faiss.downcast_index(index.storage), faiss.IndexFlat)
+    return isinstance(index, faiss.IndexFlat)
+
+
+def prepare_reconstruct(index) -> bool:
+    """get index ready for reconstruct_n, False when it doesnt keep the exact vectors"""
+    if not keeps_exact_vectors(index):
+        return False
+    if isinstance(index, faiss.IndexIVF):
+        index.make_direct_map()
+    return True
+
+
+def save_vectors(vectors: np.ndarray, out_dir: str) -> int:
+    """full vectors as .npy (loads with mmap_mode), copied in blocks, returns the file size"""
+    path = Path(out_dir) / VECTORS_NAME
+    tmp = path.with_suffix(".tmp") # the previous build's file can still be mmap'd by someone
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=vectors.shape)
+    for row in range(0, len(vectors), ADD_BLOCK):
+        out[row:row + ADD_BLOCK] = vectors[row:row + ADD_BLOCK]
+    out.flush()
+    del out
+    os.replace(tmp, path)
+    return path.stat().st_size
+
+
+def write_index(index, path: str) -> int:
+    """faiss.write_index through a temp file, a reader can have the old one mapped"""
+    tmp = f"{path}.tmp"
+    faiss.write_index(index, tmp)
+    os.replace(tmp, path)
+    return os.path.getsize(path)
+
+
+def read_index(path: str, mmap: bool = INDEX_MMAP):
+    """(index, mapped), mapped says whether the index data stayed in the file
+    faiss builds without IO_FLAG_MMAP_IFC (and index types it cant map) get read onto the heap"""
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if mmap and flag is not None:
+        try:
+            return faiss.read_index(str(path), flag | faiss.IO_FLAG_READ_ONLY), True
+        except RuntimeError:
+            pass
+    return faiss.read_index(str(path)), False
+
+
+def load_vectors(index_dir: str) -> np.ndarray | None:
+    path = Path(index_dir) / VECTORS_NAME
+    return np.load(path, mmap_mode="r") if path.exists() else None
+
+
+def save_info(info: dict, out_dir: str):
+    with open(Path(out_dir) / INFO_NAME, "w", encoding="utf-8") as f:
+        json.dump(info, f, indent=1)
+
+
+def load_info(index_dir: str) -> dict:
+    path = Path(index_dir) / INFO_NAME
+    if not path.exists():
+        return {"index_type": "flat", "search": {}} # everything before this was IndexFlatL2
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
@@ -3,73 +3,399 @@
 # create a semantic index that lives alongside our system
 
 # the data flow is the following:
-# docs -> load_documents() -> chunk_text() -> Embedder.encode() -> save_index_chunks() -v
+# docs -> load_documents() -> chunk_spans() -> Embedder.encode() -> save_index_chunks() -v
                                                                             # read for retrieval
 
+# re-ingesting only touches documents that changed since the last run, we keep a
+# manifest.json next to faiss.index/chunks.bin with a fingerprint per document
+# (sha256 of the file, or the S3 ETag when the api tells us) and reuse the old
+# vectors + chunk records of everything that is still the same
+
+# it runs as a pipeline so memory doesnt grow with the corpus: a loader thread reads and
+# chunks one document at a time into a small queue (it blocks when we fall behind), we embed
+# a group of chunks at a time and append vectors + records to scratch files in
+# out_dir/.ingest-work. a checkpoint after every finished group lets a killed ingest resume
+# from there instead of embedding everything again. only the final FAISS index is in RAM
+
+import hashlib
+import json
+import os
+import queue
+import contextvars
+import shutil
+import threading
 from pathlib import Path
 import numpy as np
 
-from .loaders import load_documents
-from .chunking import chunk_text
+from . import metrics
+from .loaders import DocumentParser, iter_document_paths
+from .chunking import chunk_spans
+from .chunk_meta import ChunkMeta, ChunkMetaWriter
 from .embedder import Embedder
-from .store import save_index_chunk
+from .store import StoreKnowledge, remove_index_files, save_index_chunk
+from .shards import SHARD_ROWS
+
+MANIFEST_NAME = "manifest.json"
+WORK_DIR_NAME = ".ingest-work"
+CHECKPOINT_NAME = "checkpoint.json"
+EMBED_GROUP_CHUNKS = int(os.getenv("INGEST_GROUP_CHUNKS", "512")) # chunks per embed call + checkpoint
+LOAD_QUEUE_DOCS = int(os.getenv("INGEST_QUEUE_DOCS", "4")) # parsed docs allowed to wait for the embedder
+
+
+def file_fingerprint(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(out_dir: str) -> dict:
+    path = Path(out_dir) / MANIFEST_NAME
+    if not path.exists():
+        return {"docs": {}}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict, out_dir: str):
+    with open(Path(out_dir) / MANIFEST_NAME, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+
+
+class _PreviousBuild:
+    """the last build in out_dir, hands back one document's records + vectors at a time"""
+
+    def __init__(self, out_dir: str):
+        self.store = None
+        self.ranges: dict[str, tuple[int, int]] = {} # doc_name -> (first row, rows)
+        store = StoreKnowledge.from_dir(out_dir)
+        if not store.exists():
+            return
+
+        store.load()
+        # flat/hnsw/ivf keep the raw vectors so we can just read them back, so does a
+        # compressed index that kept vectors.npy. PQ/SQ codes alone dont and those docs
+        # get embedded again (the embedding cache makes that cheap)
+        exact = store.reconstructable()
+        if not exact or store.index.ntotal != len(store.chunks):
+            return
+        self.store = store
+        # every build writes a document's chunks next to each other, a document whose rows
+        # got split up somehow is not reused
+        self.ranges = {name: (r[0][0], r[0][1] - r[0][0]) if len(r) == 1 else None
+                       for name, r in store.doc_ranges.items()}
+
+    def has(self, doc_name: str, chunks: int) -> bool:
+        if chunks == 0:
+            return True
+        found = self.ranges.get(doc_name)
+        return self.store is not None and found is not None and found[1] == chunks
+
+    def copy_to(self, writer: ChunkMetaWriter, doc_name: str) -> np.ndarray | None:
+        """append the document's old rows to writer, returns their vectors"""
+        found = self.ranges.get(doc_name)
+        if found is None:
+            return None
+        start, count = found
+        if isinstance(self.store.chunks, ChunkMeta):
+            # the bytes the rows cover go over as one piece, shared overlap stays shared
+            writer.append_spans(doc_name, *self.store.chunks.spans(start, start + count))
+        else:
+            writer.append([self.store.chunks[row] for row in range(start, start + count)])
+        if self.store.vectors is not None:
+            return np.array(self.store.vectors[start:start + count], dtype="float32")
+        return self.store.index.reconstruct_n(start, count)
+
+
+def _job_key(fingerprints: dict[str, str], index_options: dict, model: str) -> str:
+    """a checkpoint is only good for the exact same inputs"""
+    payload = json.dumps([sorted(fingerprints.items()), index_options, model], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _read_checkpoint(work_dir: Path) -> dict | None:
+    try:
+        with open(work_dir / CHECKPOINT_NAME, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(work_dir: Path, checkpoint: dict):
+    tmp = work_dir / f"{CHECKPOINT_NAME}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, work_dir / CHECKPOINT_NAME)
+
+
+def run_ingest(docs_dir: str = "docs", out_dir: str = "data", fingerprints: dict[str, str] | None = None,
+               index_type: str | None = None, progress=None, compression: str | None = None,
+               keep_vectors: bool | None = None, shard_rows: int | None = None,
+               work_dir: str | None = None) -> dict:
+    """build or update the index in out_dir from the documents in docs_dir
 
+    fingerprints maps doc_name -> fingerprint for the whole corpus, docs that match the
+    manifest dont need to be in docs_dir at all (the api only downloads changed ones).
+    without it we hash every file in docs_dir ourselves
+    index_type is flat/hnsw/ivf/ivfpq or auto (pick by corpus size), default INDEX_TYPE env
+    compression is none/fp16/sq8/pq (default INDEX_COMPRESSION env), keep_vectors also keeps
+    the full vectors for an exact rerank (default INDEX_KEEP_VECTORS env)
+    shard_rows splits a bigger index into shards of at most that many vectors, 0 never does
+    (default INDEX_SHARD_ROWS env)
+    progress(stage, **counters) if given is called as the work moves along (see jobs.py)
+    work_dir keeps the checkpoint + spool (default out_dir/.ingest-work), a run that died
+    picks up from there, so it has to outlive out_dir if out_dir is a temp folder
+    report["timings_ms"] has the time per stage, parsing runs next to embedding so they overlap
+    """
+    with metrics.collect_timings() as timings:
+        with metrics.stage("ingest.total"):
+            report = _run_ingest(docs_dir, out_dir, fingerprints, index_type, progress, compression, keep_vectors,
+                                 shard_rows, work_dir)
+    report["timings_ms"] = metrics.rounded(timings)
+    for result in ("added", "updated", "unchanged", "removed", "failed"):
+        metrics.inc("themind_ingest_docs_total", len(report[result]), result=result)
+    metrics.inc("themind_ingest_chunks_embedded_total", report["chunks_embedded"])
+    if report["changed"]:
+        print("[ingest] timings " + ", ".join(f"{name} {ms:.0f}ms" for name, ms in report["timings_ms"].items()))
+    return report
 
-def run_ingest(docs_dir: str = "docs", out_dir: str = "data"):
+
+def _run_ingest(docs_dir: str, out_dir: str, fingerprints: dict[str, str] | None, index_type: str | None,
+                progress, compression: str | None, keep_vectors: bool | None, shard_rows: int | None,
+                work_dir: str | None = None) -> dict:
+    index_type = index_type or os.getenv("INDEX_TYPE", "auto")
+    compression = compression or os.getenv("INDEX_COMPRESSION", "none")
+    if keep_vectors is None:
+        keep_vectors = os.getenv("INDEX_KEEP_VECTORS", "0") == "1"
+    shard_rows = SHARD_ROWS if shard_rows is None else shard_rows
+    index_options = {"index_type": index_type, "compression": compression, "keep_vectors": keep_vectors,
+                     "shard_rows": shard_rows}
+    progress = progress or (lambda stage, **counters: None)
     embedder = Embedder() # initialize instance of the class
 
-    docs = list(load_documents(docs_dir)) # get the generator here and not in the loop
-    # so the generator does not get exhausted and return nothing
+    paths = {p.name: p for p in iter_document_paths(docs_dir)}
+    if fingerprints is None:
+        fingerprints = {name: file_fingerprint(p) for name, p in paths.items()}
+
+    report = {"added": [], "updated": [], "unchanged": [], "removed": [], "failed": [],
+              "chunks_embedded": 0, "chunks_total": 0, "changed": False}
 
-    if not docs:
+    if not fingerprints:
+        previous_docs = load_manifest(out_dir).get("docs", {})
+        if previous_docs:
+            # every document was deleted, their vectors have to go too not stay searchable
+            report["removed"] = sorted(previous_docs)
+            report["changed"] = True
+            remove_index_files(out_dir)
+            (Path(out_dir) / MANIFEST_NAME).unlink()
+            print(f"[ingest] no documents left in {docs_dir}, removed the index of {len(previous_docs)}")
+            return report
         print(f"[ingest] no documents found in {docs_dir}, please add files")
-        return
-    
-    for doc in docs:
-        print(f"[ingest] loaded {doc['doc_name']} → {len(doc['text'])} characters")
-
-    all_chunks_records: list[dict] = [] # stores text metadata and text
-    all_vectors: list[np.ndarray] = [] # corresponding numeric embeddings
-
-    for doc in docs:
-        # the generator is going to "run" as many documents that are uploaded
-        doc_name = doc["doc_name"]
-        raw_text = doc["text"]
-
-        chunks = chunk_text(raw_text)
-        # we want to just keep the text portion of chunks not the metadata
-        texts = [chunk["text"] for chunk in chunks]
-        
-        # check if texts is empty
-        # this shouldnt happen since we safety'd it in chunking but its good in case
-        # should not slow down performance lol :)
-        if not texts:
-            continue
-
-        # now embed all the chunks into a vector - this is a per-document
-        vectors = embedder.encode(texts) # on current model you should (get no_chunks, 384)
-
-        # store metadata now that we've embedded
-        for chunk in chunks:
-            all_chunks_records.append({
-                "doc_name": doc_name,
-                "chunk_id": chunk["chunk_id"],
-                "text": chunk["text"],
-            })
-    
-        # store embedding data as a vector into all_vectors
-        all_vectors.append(vectors)
-
-    # we need now need to stack loads of numpy arrays one per document onto each other
-    # thats because FAISS wants [num_of_chunks, total dimensions] as its input 
-    # the best way to achieve this is to use .vstack for numpy stacking is doing row-wise
-    # basically glue everything into a 2D array
-    stacked_mtx = np.vstack(all_vectors).astype("float32")
-    save_index_chunk(stacked_mtx, all_chunks_records, out_dir=out_dir)
+        return report
+
+    previous = load_manifest(out_dir)
+    previous_docs = previous.get("docs", {})
+    if previous.get("model") != embedder.model_name:
+        previous_docs = {} # vectors from another model are useless to us
+    old = _PreviousBuild(out_dir) if previous_docs else None
+
+    # decide what happens to every document before touching any of them
+    plan: list[tuple[str, dict, bool]] = [] # (doc_name, manifest entry, reuse old rows)
+    for doc_name in sorted(fingerprints):
+        fingerprint = fingerprints[doc_name]
+        prev = previous_docs.get(doc_name)
+
+        # same content as last time -> reuse what we already have
+        if prev is not None and prev["fingerprint"] == fingerprint and old.has(doc_name, prev["chunks"]):
+            plan.append((doc_name, prev, True))
+            report["unchanged"].append(doc_name)
+        elif doc_name not in paths:
+            # told it exists but its not here, dont guess -> leave it out of this build
+            print(f"[ingest] {doc_name} is not in {docs_dir}, skipping")
+            report["failed"].append(doc_name)
+        else:
+            plan.append((doc_name, {"fingerprint": fingerprint}, False))
+            report["updated" if prev is not None else "added"].append(doc_name)
+
+    report["removed"] = sorted(name for name in previous_docs if name not in fingerprints)
+    print(f"[ingest] adding {len(report['added'])}, updating {len(report['updated'])}, "
+          f"skipping {len(report['unchanged'])} unchanged, removing {len(report['removed'])}")
+
+    # asking for another index type (or compression) is a change too even if the docs are the same
+    # (builds from before sharding count as the current setting, they only change along with the docs)
+    before = {"index_type": "auto", "compression": "none", "keep_vectors": False, "shard_rows": shard_rows}
+    before.update({key: previous[key] for key in before if key in previous})
+    same_index = before == index_options
+    if not (report["added"] or report["updated"] or report["removed"]) and previous_docs and same_index:
+        return report # nothing changed, keep the old files as they are
+
+    progress("planned", docs_total=len(plan), docs_done=0, chunks_done=0)
+
+    # pick up an interrupted run of the same job, anything else in the work dir is stale
+    work_dir = Path(work_dir) if work_dir else Path(out_dir) / WORK_DIR_NAME
+    job = _job_key(fingerprints, index_options, embedder.model_name)
+    checkpoint = _read_checkpoint(work_dir)
+    if checkpoint is None or checkpoint["job"] != job:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        checkpoint = None
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    writer = ChunkMetaWriter(str(work_dir))
+    spool_path = work_dir / "vectors.f32"
+    spool = open(spool_path, "ab")
+    manifest_docs: dict[str, dict] = {}
+    dim = None
+    if checkpoint is not None:
+        writer.truncate(checkpoint["meta"])
+        dim = checkpoint["dim"]
+        spool.truncate(checkpoint["meta"]["rows"] * (dim or 0) * 4)
+        manifest_docs = checkpoint["docs"]
+        report["chunks_embedded"] = checkpoint["chunks_embedded"]
+        print(f"[ingest] resuming, {len(manifest_docs)} documents already done")
+
+    todo = [item for item in plan if item[0] not in manifest_docs]
+    docs_queue: queue.Queue = queue.Queue(maxsize=LOAD_QUEUE_DOCS)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # blocks while the queue is full (thats the backpressure) but gives up if we stopped
+        while not stop.is_set():
+            try:
+                docs_queue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def load_docs():
+        # parsing fans out over a process pool, results still come back in todo order
+        parser = DocumentParser()
+        parsed = parser.parse(paths[doc_name] for doc_name, _, reuse in todo if not reuse)
+        try:
+            for doc_name, entry, reuse in todo:
+                chunks = None
+                if not reuse:
+                    # spans over the one copy of the text, chunks dont get their own strings
+                    with metrics.stage("ingest.parse"):
+                        _, doc = next(parsed)
+                    chunks = (doc["text"], chunk_spans(len(doc["text"]))) if doc is not None else ("", [])
+                    if chunks[1]:
+                        print(f"[ingest] loaded {doc_name} → {len(doc['text'])} characters")
+                if not put((doc_name, entry, chunks)):
+                    return
+            put(None)
+        except BaseException as e:
+            put(e) # the main thread raises it
+        finally:
+            parsed.close()
+            parser.close()
+
+    # rows go into the writer as soon as a document arrives, their vectors follow once the
+    # group they are in is embedded. at a checkpoint both are always level
+    group_texts: list[str] = [] # chunk texts waiting to be embedded
+    finished: list[tuple[str, dict]] = [] # docs whose rows are all in the current group
+    spooled = writer.rows # rows that have their vector in the spool
+
+    def spool_vectors(vectors: np.ndarray):
+        nonlocal dim, spooled
+        dim = vectors.shape[1]
+        spool.write(np.ascontiguousarray(vectors, dtype="float32").tobytes())
+        spooled += len(vectors)
+
+    def flush():
+        if group_texts:
+            with metrics.stage("ingest.embed"):
+                vectors = embedder.encode(group_texts)
+            spool_vectors(vectors)
+            report["chunks_embedded"] += len(group_texts)
+            group_texts.clear()
+        for doc_name, entry in finished:
+            manifest_docs[doc_name] = entry
+        finished.clear()
+        progress("embedding", docs_done=len(manifest_docs), chunks_done=spooled,
+                 chunks_embedded=report["chunks_embedded"])
+
+    checkpointed_rows = writer.rows
+
+    def checkpoint(force: bool = False):
+        # only called between documents, a resume always restarts at a whole document
+        nonlocal checkpointed_rows
+        if not force and writer.rows - checkpointed_rows < EMBED_GROUP_CHUNKS:
+            return
+        flush()
+        with metrics.stage("ingest.checkpoint"):
+            spool.flush()
+            _write_checkpoint(work_dir, {"job": job, "meta": writer.state(), "dim": dim,
+                                         "docs": manifest_docs, "chunks_embedded": report["chunks_embedded"]})
+        checkpointed_rows = writer.rows
+        print(f"[ingest] {len(manifest_docs)}/{len(plan)} documents, {writer.rows} chunks")
+
+    # the loader gets a copy of our context so its parse timings end up in the report too
+    loader = threading.Thread(target=contextvars.copy_context().run, args=(load_docs,),
+                              name="ingest-loader", daemon=True)
+    loader.start()
+    try:
+        while True:
+            with metrics.stage("ingest.wait_for_docs"): # parsing cant keep up when this is big
+                item = docs_queue.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            doc_name, entry, chunks = item
+
+            if chunks is None:
+                # unchanged, copy its old rows over (after whatever is waiting so the order holds)
+                flush()
+                with metrics.stage("ingest.reuse"):
+                    vectors = old.copy_to(writer, doc_name)
+                if vectors is not None:
+                    spool_vectors(vectors)
+                manifest_docs[doc_name] = entry
+            else:
+                text, spans = chunks
+                writer.append_document(doc_name, text, spans)
+                for start, end in spans:
+                    group_texts.append(text[start:end])
+                    if len(group_texts) >= EMBED_GROUP_CHUNKS:
+                        flush() # a big document spans several groups
+                finished.append((doc_name, {**entry, "chunks": len(spans)}))
+            checkpoint()
+        checkpoint(force=bool(group_texts or finished) or writer.rows != checkpointed_rows)
+    finally:
+        stop.set()
+        spool.close()
+
+    report["chunks_total"] = writer.rows
+    if writer.rows == 0:
+        print(f"[ingest] no text found in {docs_dir}, nothing to index")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        return report
+    report["changed"] = True
+
+    # FAISS wants [num_of_chunks, dimensions], the spool already is exactly that on disk
+    progress("building_index", docs_done=len(manifest_docs), chunks_done=writer.rows)
+    vectors = np.memmap(spool_path, dtype="float32", mode="r", shape=(writer.rows, dim))
+    with metrics.stage("ingest.build_index"):
+        report["index"] = save_index_chunk(vectors, writer, out_dir=out_dir, index_type=index_type,
+                                           embedding=embedder.describe(), compression=compression,
+                                           keep_vectors=keep_vectors, shard_rows=shard_rows)
+    del vectors
+    info = report["index"]
+    print(f"[ingest] built {info['index_type']} index ({info['compression']}, {info['index_bytes']} bytes), "
+          f"recall@{info['recall_k']} = {info['recall_at_k']}"
+          + (f", {info['rerank_recall_at_k']} with rerank" if info["rerank"] else "")
+          + (f", {len(info['shards'])} shards" if info.get("shards") else ""))
+    # keep the manifest in corpus order, resumed docs come back from the checkpoint
+    manifest_docs = {name: manifest_docs[name] for name, _, _ in plan if name in manifest_docs}
+    save_manifest({"model": embedder.model_name, **index_options, "docs": manifest_docs}, out_dir)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return report
 
 
 if __name__ == "__main__": # when running file do ingest.py not when importing
     print("ingest starting")
-    run_ingest()
+    print(run_ingest())
     # confirmation it ran properly
     print("done!")
@@ -0,0 +1,140 @@
+# background jobs for long running work (ingest)
+# an ingest is minutes of downloading, parsing, embedding and uploading, doing that
+# inside the http request means the client times out while the work keeps going.
+# now the request only enqueues a job and gets an id back, the status can be polled
+
+# a job has a key (for ingest the tenant), while a job for a key is queued or running
+# submitting the same key again hands back that job instead of starting a second one
+
+# where the work actually runs is the backend, ThreadPoolBackend runs it in this process
+# which is all we need for now. anything with submit(fn) / shutdown() can replace it
+# (a process pool, a queue consumer on another box...)
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+class ThreadPoolBackend:
+    """runs jobs on a bounded pool of threads in this process"""
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+
+    def submit(self, fn: Callable[[], None]):
+        self._pool.submit(fn)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class Job:
+    def __init__(self, key, kind: str):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.kind = kind
+        self.state = QUEUED
+        self.stage = QUEUED
+        self.progress: dict = {} # whatever counters the work reports (docs_done, chunks_done, ...)
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self) -> dict:
+        end = self.finished or time.time()
+        elapsed = end - self.started if self.started else 0.0
+        chunks = self.progress.get("chunks_done", 0)
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "key": list(self.key) if isinstance(self.key, tuple) else self.key,
+            "state": self.state,
+            "stage": self.stage,
+            "progress": dict(self.progress),
+            "elapsed_seconds": round(elapsed, 2),
+            "chunks_per_second": round(chunks / elapsed, 1) if elapsed > 0 else None,
+            "queued_seconds": round((self.started or time.time()) - self.created, 2),
+            "error": self.error,
+            "result": self.result,
+        }
+
+
+class JobManager:
+    """keeps track of jobs, dedupes them per key and hands the work to a backend"""
+
+    def __init__(self, backend=None, history: int = 200):
+        self.backend = backend or ThreadPoolBackend()
+        self.history = history
+        self._lock = threading.Lock()
+        self._jobs: OrderedDict = OrderedDict() # id -> Job, oldest first
+        self._active: dict = {} # key -> Job that is queued or running
+
+    def submit(self, key, work: Callable, kind: str = "job") -> tuple[Job, bool]:
+        """start work(progress) for key unless one is already on its way
+
+        progress(stage, **counters) is how the work tells us where it is
+        returns (job, created), created is False when an existing job was handed back
+        """
+        with self._lock:
+            running = self._active.get(key)
+            if running is not None:
+                return running, False
+            job = Job(key, kind)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            self._trim()
+
+        self.backend.submit(lambda: self._run(job, work))
+        return job, True
+
+    def _run(self, job: Job, work: Callable):
+        def progress(stage: str, **counters):
+            job.stage = stage
+            job.progress.update(counters)
+
+        job.started = time.time()
+        job.state = job.stage = RUNNING
+        try:
+            job.result = work(progress)
+            job.state = job.stage = SUCCEEDED
+        except Exception as e:
+            job.error = f"{type(e).__name__}: {e}"
+            job.state = FAILED # stage stays where it broke
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                if self._active.get(job.key) is job:
+                    del self._active[job.key]
+
+    def _trim(self):
+        # forget the oldest finished jobs, never the ones still going
+        finished = [i for i, j in self._jobs.items() if j.state in (SUCCEEDED, FAILED)]
+        for job_id in finished[:max(0, len(self._jobs) - self.history)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self, key=None) -> list[Job]:
+        with self._lock:
+            return [j for j in self._jobs.values() if key is None or j.key == key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            states = [j.state for j in self._jobs.values()]
+        return {state: states.count(state) for state in (QUEUED, RUNNING, SUCCEEDED, FAILED)}
+
+    def shutdown(self):
+        self.backend.shutdown()
@@ -7,14 +7,18 @@
 # CURRENTLY this is a stub -> just returns a placeholder for now
 # havent decided what LLM to use
 
+import json
 import os 
-import requests
+
+from . import metrics
+from .http_transport import HedgedTransport
 
 
 class LLMProvider:
     """thin wrapper to swap out easily different LLMs"""
 
-    def __init__(self, model_name: str="gpt-4o-mini", api_key: str = None, base_url: str = None):
+    def __init__(self, model_name: str="gpt-4o-mini", api_key: str = None, base_url: str = None,
+                 transport: HedgedTransport | None = None):
         self.model_name = model_name
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         # call client and other stuff
@@ -22,11 +26,10 @@ class LLMProvider:
             raise ValueError("OPENAI_API_KEY is not set in this environment")
         
         self.base_url = base_url or os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        # pooled keep-alive connections, retries and optional hedging, see http_transport.py
+        self.transport = transport or HedgedTransport.from_env()
 
-    def generate_answer(self, prompt: str) -> str:
-        """call actual LLM here, send a prompt to the API, wait for a response,
-        extract the models answer from JSON that is returned, return it as plain text"""
-    
+    def _request(self, prompt: str) -> tuple[str, dict, dict]:
         # api endpoint where we'll send the question
         url = f"{self.base_url}/chat/completions"  
 
@@ -50,17 +53,70 @@ class LLMProvider:
             ],
                 "temperature": 0.1, # how random the model's text generation 
         }
+        return url, headers, payload
 
-        # send post
-        resp = requests.post(url, headers=headers, json=payload, timeout=20)
-        # check if there were any issues by checking status
-        resp.raise_for_status()
-
-        data = resp.json() # get data into json format
+    def _count_usage(self, data: dict):
+        # the API tells us what we paid for, streams dont include it unless asked
+        usage = data.get("usage") or {}
+        metrics.inc("themind_llm_tokens_total", usage.get("prompt_tokens", 0), model=self.model_name, kind="prompt")
+        metrics.inc("themind_llm_tokens_total", usage.get("completion_tokens", 0), model=self.model_name,
+                    kind="completion")
 
+    @staticmethod
+    def _extract(data: dict) -> str:
         # attempt to extract data text
         try:
             return data["choices"][0]["message"]["content"].strip() # usually there only one choice anyway
         except Exception as e:
             return f"[LLM Provider] error occured in loading text: {e}"
-    
+
+    def generate_answer(self, prompt: str) -> str:
+        """call actual LLM here, send a prompt to the API, wait for a response,
+        extract the models answer from JSON that is returned, return it as plain text"""
+        url, headers, payload = self._request(prompt)
+        metrics.inc("themind_llm_requests_total", model=self.model_name)
+
+        # send post, retried on 429/5xx and connection errors
+        data = self.transport.post_json(url, headers, payload)
+        self._count_usage(data)
+        return self._extract(data)
+
+    async def agenerate_answer(self, prompt: str) -> str:
+        """same as generate_answer but doesnt block the event loop while the LLM thinks"""
+        url, headers, payload = self._request(prompt)
+        metrics.inc("themind_llm_requests_total", model=self.model_name)
+        data = await self.transport.apost_json(url, headers, payload)
+        self._count_usage(data)
+        return self._extract(data)
+
+    async def astream_answer(self, prompt: str):
+        """yield the answer piece by piece as the model writes it (OpenAI style SSE stream)"""
+        url, headers, payload = self._request(prompt)
+        metrics.inc("themind_llm_requests_total", model=self.model_name)
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True} # last event carries the token counts
+
+        # retried until the response starts, after that tokens are already on their way to the user
+        resp = await self.transport.astream(url, headers, payload)
+        try:
+            async for line in resp.aiter_lines():
+                # every event is "data: {...}", blank lines separate them
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    event = json.loads(data)
+                    if event.get("usage"):
+                        self._count_usage(event)
+                    delta = event["choices"][0].get("delta", {})
+                except (ValueError, KeyError, IndexError, AttributeError):
+                    continue
+                if delta.get("content"):
+                    yield delta["content"]
+        finally:
+            await resp.aclose()
+
+    async def aclose(self):
+        await self.transport.aclose()
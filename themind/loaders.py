@@ -1,7 +1,12 @@
+import multiprocessing
 import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from pypdf import PdfReader
 
+from .parse_cache import ParsedTextCache, content_hash
+
 ROOT_DIR = Path(__file__).resolve().parent.parent
 
 def load_text_file(path: Path)-> str:
@@ -15,31 +20,126 @@ def load_pdf_file(path: Path) -> str:
         pages.append(page.extract_text() or "")
     return "\n".join(pages)
 
-def load_documents(docs_dir: str = "docs"):
-    """
-    goes into docs_dir and get (doc_name, text)
-    """
+def _extract_pages(path: str, start: int, end: int) -> list[str]:
+    """text of pages [start, end) of a PDF, runs inside a worker process"""
+    reader = PdfReader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+SUPPORTED_EXTENSIONS = [".md", ".txt", ".pdf"]
+
+def iter_document_paths(docs_dir: str = "docs"):
+    """every file in docs_dir we know how to read"""
     docs_dir = (ROOT_DIR / docs_dir).resolve()
-    for p in docs_dir.rglob("*"):
+    for p in sorted(docs_dir.rglob("*")):
         if p.is_dir():
             continue
-        ext = p.suffix.lower() # get suffix in lowercase easier to work with
+        if p.suffix.lower() in SUPPORTED_EXTENSIONS:
+            yield p
+
+def load_document(path: Path) -> dict | None:
+    """read a single file into {doc_name, path, text}, None if there is no text in it"""
+    ext = path.suffix.lower() # get suffix in lowercase easier to work with
+    if ext in [".md", ".txt"]:
+        text = load_text_file(path)
+    elif ext in [".pdf"]:
+        text = load_pdf_file(path)
+    else:
+        # future imports will be available at some point lol
+        return None
+
+    return _make_document(path, text)
+
+def _make_document(path: Path, text: str) -> dict | None:
+    # does two things clears empty space but also creates condition only ocntinue if data exists
+    if not text.strip():
+        return None
+
+    return {
+        "doc_name": path.name, # the full path shortened -> no extensions
+        "path": str(path), # full path
+        "text": text
+    }
+
+PAGES_PER_TASK = 8 # big PDFs are split into page ranges so one file can use every core
+
+class DocumentParser:
+    """parses documents on a process pool and remembers PDF text by file content
+
+    parse() gives the documents back in the order they went in, no matter which worker
+    finished first. only a few files are in flight at a time so memory stays bounded
+    """
+
+    def __init__(self, max_workers: int = None, cache: ParsedTextCache | None = None):
+        self.max_workers = max_workers or int(os.getenv("PARSE_WORKERS", str(min(4, os.cpu_count() or 1))))
+        self.cache = cache if cache is not None else ParsedTextCache.from_env()
+        self._executor = None # only started once we actually have a PDF to parse
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, forking a process that already runs threads (uvicorn, ingest loader) isnt safe
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _submit(self, path: Path):
+        """start parsing path, returns (path, cache key, text or list of page futures)"""
+        ext = path.suffix.lower()
         if ext in [".md", ".txt"]:
-            text = load_text_file(p)
-        elif ext in [".pdf"]:
-            text = load_pdf_file(p)
-        else:
-            # future imports will be available at some point lol
-            continue
+            # plain reads arent worth a process, or a cache entry (reading is cheaper than hashing)
+            return path, None, load_text_file(path)
+        if ext != ".pdf":
+            return path, None, None
+
+        key = content_hash(path) if self.cache is not None else None
+        text = self.cache.get(key) if key is not None else None
+        if text is not None:
+            return path, None, text # parsed before, nothing to do
+        if self.max_workers <= 1:
+            return path, key, load_pdf_file(path)
+
+        n_pages = len(PdfReader(str(path)).pages)
+        futures = [self._pool().submit(_extract_pages, str(path), start, min(start + PAGES_PER_TASK, n_pages))
+                   for start in range(0, n_pages, PAGES_PER_TASK)]
+        return path, key, futures
 
-        # does two things clears empty space but also creates condition only ocntinue if data exists
-        if text.strip():
+    def _collect(self, pending) -> tuple[Path, dict | None]:
+        path, key, result = pending
+        if result is None:
+            return path, None
+        if isinstance(result, list):
+            result = "\n".join(page for future in result for page in future.result())
+        if key is not None:
+            self.cache.put(key, result)
+        return path, _make_document(path, result)
+
+    def parse(self, paths):
+        """yields (path, document or None) for every path, in order"""
+        window: deque = deque()
+        lookahead = max(2, self.max_workers * 2)
+        for path in paths:
+            window.append(self._submit(Path(path)))
+            if len(window) >= lookahead:
+                yield self._collect(window.popleft())
+        while window:
+            yield self._collect(window.popleft())
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+def load_documents(docs_dir: str = "docs"):
+    """
+    goes into docs_dir and get (doc_name, text)
+    """
+    parser = DocumentParser()
+    try:
+        for _, doc in parser.parse(iter_document_paths(docs_dir)):
+            if doc is None:
+                continue
             # we use yield cause it creates a generator function
             # pauses mid execution and yields a value back to the caller, then resume
             # from that point the next time you call the function
-            yield {
-                "doc_name": p.name, # the full path shortened -> no extensions
-                "path": str(p), # full path
-                "text": text
-            }
-    
\ No newline at end of file
+            yield doc
+    finally:
+        parser.close()
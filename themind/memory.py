@@ -0,0 +1,59 @@
+# what this worker holds in memory and how much of it the other uvicorn workers share
+# reads /proc/self/smaps, so linux only (the docker image), elsewhere the report says so
+
+# file backed mappings (the mmap'd faiss.index, chunks.bin, vectors.npy) live in the page
+# cache: N workers mapping the same file hold one copy and each is charged 1/N of it (pss).
+# anonymous memory (python objects, the heap, an index read without mmap) is private to
+# every worker and is what multiplies with --workers
+
+import os
+
+SMAPS_PATH = "/proc/self/smaps"
+_FIELDS = ("Rss", "Pss", "Shared_Clean", "Shared_Dirty", "Private_Clean", "Private_Dirty", "Anonymous")
+
+
+def read_smaps(path: str = SMAPS_PATH) -> list[dict]:
+    """one dict per mapping, {"path": file or "", field: bytes}"""
+    mappings = []
+    current = None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            if not parts[0].endswith(":"): # "start-end perms offset dev inode [path]" starts a mapping
+                current = {"path": " ".join(parts[5:])}
+                mappings.append(current)
+            elif current is not None and parts[0][:-1] in _FIELDS:
+                current[parts[0][:-1]] = int(parts[1]) * 1024
+    return mappings
+
+
+def _usage(mappings: list[dict]) -> dict:
+    total = lambda field: sum(m.get(field, 0) for m in mappings)
+    return {
+        "rss_bytes": total("Rss"),
+        "pss_bytes": total("Pss"), # rss with shared pages split between the processes mapping them
+        "shared_bytes": total("Shared_Clean") + total("Shared_Dirty"), # also mapped by another process right now
+        "private_bytes": total("Private_Clean") + total("Private_Dirty"),
+    }
+
+
+def process_report(files: list[str] | None = None) -> dict:
+    """totals for this process + usage per file in files (absolute paths of mapped artifacts)"""
+    try:
+        mappings = read_smaps()
+    except OSError:
+        return {"pid": os.getpid(), "supported": False}
+
+    anonymous = sum(m.get("Anonymous", 0) for m in mappings)
+    report = {"pid": os.getpid(), "supported": True, **_usage(mappings), "anonymous_bytes": anonymous}
+    report["file_backed_bytes"] = report["rss_bytes"] - anonymous
+
+    wanted = {os.path.realpath(f) for f in files or []}
+    by_file: dict[str, list[dict]] = {}
+    for m in mappings:
+        if m["path"] in wanted:
+            by_file.setdefault(m["path"], []).append(m)
+    report["files"] = {path: _usage(ms) for path, ms in by_file.items()}
+    return report
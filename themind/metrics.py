@@ -0,0 +1,184 @@
+# in process timers and counters, /metrics renders them in the prometheus text format
+# when /ask is slow this tells us where the time went: S3, loading the index, embedding
+# the question, the FAISS search, building the prompt or the LLM
+
+# with metrics.stage("store.search"):
+#     ...
+# records the seconds in the themind_stage_seconds histogram (label stage) and, if the
+# caller asked for a breakdown (collect_timings), adds the ms to that request's dict too.
+# stages nest (retrieve.search contains store.search), so a breakdown doesnt add up to
+# the total and isnt meant to
+
+# METRICS=off turns the histograms and counters off, a stage() outside collect_timings
+# is then one contextvar read that hands back a shared do-nothing context
+
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+ENABLED = os.getenv("METRICS", "on").lower() not in ("0", "off", "false", "no")
+
+STAGE_METRIC = "themind_stage_seconds"
+# seconds, from sub-millisecond FAISS searches up to multi minute ingests
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_timings: ContextVar[dict | None] = ContextVar("themind_timings", default=None)
+_NULL = nullcontext()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _number(value: float) -> str:
+    # byte counters get big, %g would round them
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Registry:
+    """histograms + counters keyed by (name, labels), one lock for all of them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: dict[tuple, Histogram] = {}
+        self._counters: dict[tuple, float] = {}
+        self._help: dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str):
+        self._help[name] = help_text
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = {k: (list(h.counts), h.sum, h.count, h.buckets) for k, h in self._histograms.items()}
+            counters = dict(self._counters)
+
+        lines = []
+        seen = set()
+
+        def header(name: str, kind: str):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_labels(dict(labels))} {_number(value)}")
+        for (name, labels), (counts, total, count, buckets) in sorted(histograms.items()):
+            header(name, "histogram")
+            labels = dict(labels)
+            cumulative = 0
+            for bound, n in zip(list(buckets) + ["+Inf"], counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REGISTRY.describe(STAGE_METRIC, "time spent per pipeline stage")
+
+
+def record(name: str, seconds: float):
+    """a stage that was already timed some other way"""
+    if ENABLED:
+        REGISTRY.observe(STAGE_METRIC, seconds, stage=name)
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds * 1000
+
+
+class _Stage:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def stage(name: str):
+    """with stage("name"): times the block, see the top of the file"""
+    if not ENABLED and _timings.get() is None:
+        return _NULL
+    return _Stage(name)
+
+
+def inc(name: str, amount: float = 1, **labels):
+    if ENABLED and amount:
+        REGISTRY.inc(name, amount, **labels)
+
+
+@contextmanager
+def collect_timings():
+    """per request breakdown, yields a dict that fills up with stage -> ms
+    threads started with asyncio.to_thread (or a copied context) report into it too"""
+    timings: dict[str, float] = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        try:
+            _timings.reset(token)
+        except ValueError:
+            pass # closed from another context (a stream the client dropped), that context is gone anyway
+
+
+def rounded(timings: dict) -> dict:
+    return {name: round(ms, 3) for name, ms in timings.items()}
+
+
+def render_stats(prefix: str, stats: dict | None) -> str:
+    """numbers from the existing .stats() dicts (caches, transfers, jobs) as gauges"""
+    lines = []
+
+    def walk(name: str, value):
+        if isinstance(value, dict):
+            for key, v in value.items():
+                walk(f"{name}_{key}", v)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {_number(value)}")
+
+    walk(f"themind_{prefix}", stats or {})
+    return "\n".join(lines) + ("\n" if lines else "")
@@ -0,0 +1,126 @@
+# disk cache for text we already pulled out of a file
+# pypdf is slow, re-ingesting a tenant used to parse every PDF again even when only one
+# file changed (or none did and only the index type did)
+
+# keyed by sha256 of the file bytes (+ the parser version so a parser fix invalidates
+# everything), the text is stored zlib compressed in sqlite, same idea as embed_cache.py.
+# when it grows past max_bytes the least recently used texts get dropped, the byte count
+# lives in the file (size table) like there
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+
+DEFAULT_CACHE_PATH = "/tmp/themind/parsed.sqlite"
+PARSER_VERSION = "1" # bump when the way we extract text changes
+
+
+def content_hash(path: Path) -> str:
+    digest = hashlib.sha256(PARSER_VERSION.encode("utf-8") + b"\0")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ParsedTextCache:
+    """content addressed extracted text on disk with LRU eviction"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = 1024 * 1024 * 1024):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("BEGIN IMMEDIATE") # another process can be opening the same file
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS texts ("
+            " key TEXT PRIMARY KEY, body BLOB NOT NULL, last_used REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS texts_last_used ON texts(last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER NOT NULL)")
+        self._conn.execute(
+            "INSERT OR IGNORE INTO size (id, bytes) SELECT 0, COALESCE(SUM(LENGTH(body)), 0) FROM texts")
+        self._conn.commit()
+        self.used_bytes = self._size()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def from_env(cls):
+        """cache configured by PARSE_CACHE_PATH / PARSE_CACHE_MAX_MB, None if turned off"""
+        path = os.getenv("PARSE_CACHE_PATH", DEFAULT_CACHE_PATH)
+        if not path or path.lower() == "off":
+            return None
+        max_mb = int(os.getenv("PARSE_CACHE_MAX_MB", "1024"))
+        return cls(path, max_bytes=max_mb * 1024 * 1024)
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT body FROM texts WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            # touch it so it survives the next eviction
+            self._conn.execute("UPDATE texts SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: str, text: str):
+        body = zlib.compress(text.encode("utf-8", errors="replace"), 3)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE") # size read + eviction see every process' writes
+            try:
+                existing = self._conn.execute(
+                    "SELECT COALESCE(SUM(LENGTH(body)), 0) FROM texts WHERE key = ?", (key,)).fetchone()[0]
+                self._conn.execute("INSERT OR REPLACE INTO texts (key, body, last_used) VALUES (?, ?, ?)",
+                                   (key, body, time.time()))
+                self._conn.execute("UPDATE size SET bytes = bytes + ?", (len(body) - existing,))
+                self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _size(self) -> int:
+        return self._conn.execute("SELECT bytes FROM size").fetchone()[0]
+
+    def _evict(self):
+        self.used_bytes = self._size()
+        if self.used_bytes <= self.max_bytes:
+            return
+        # go down to 90% so we dont evict again on the very next put, oldest first
+        target = int(self.max_bytes * 0.9)
+        while self.used_bytes > target:
+            rows = self._conn.execute(
+                "SELECT key, LENGTH(body) FROM texts ORDER BY last_used LIMIT 32").fetchall()
+            if not rows:
+                break
+            self._conn.executemany("DELETE FROM texts WHERE key = ?", [(k,) for k, _ in rows])
+            freed = sum(n for _, n in rows)
+            self._conn.execute("UPDATE size SET bytes = bytes - ?", (freed,))
+            self.used_bytes -= freed
+            self.evictions += len(rows)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            self.used_bytes = self._size()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -1,24 +1,145 @@
 # the actual brain of the system
 # retrievel -> prompt build -> LLM -> answer and cited sources
 
+import contextvars
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
 
+from . import metrics
 from .retrieve import Retriever
 from .llm_provider import LLMProvider
+from .answer_cache import AnswerCache
+from .embedding_backends import estimate_tokens
+
+# top-k chunks overlap: chunk_spans repeats the last 200 chars of a chunk at the start of
+# the next one, and two hits from neighbouring chunks used to go into the prompt twice.
+# pack_context glues neighbouring chunks of a document back into one passage, drops
+# passages that are (nearly) the same text as one already in, then fills CONTEXT_MAX_TOKENS
+# best hit first. the sources handed back to the client are still the chunks themselves
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "4000")) # 0 -> no budget
+DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", "0.9"))
+MAX_OVERLAP_CHARS = 2000 # how far back to look for the text two neighbouring chunks share
+MIN_TAIL_TOKENS = 50 # dont cut the last passage down to less than this, leave it out
+
+def _overlap(a: str, b: str) -> int:
+    """length of the longest suffix of a that b starts with"""
+    limit = min(len(a), len(b), MAX_OVERLAP_CHARS)
+    if limit == 0:
+        return 0
+    # an overlap of 32+ chars starts with b[:32], find those with str.find
+    pos = a.find(b[:32], len(a) - limit) if limit >= 32 else -1
+    while pos != -1: # earliest match first, that is the longest overlap
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(b[:32], pos + 1)
+    for n in range(min(limit, 31), 0, -1): # short ones by hand
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+def _shingles(text: str) -> set:
+    words = text.lower().split()
+    return {hash(tuple(words[i:i + 3])) for i in range(max(1, len(words) - 2))}
+
+def _merge_neighbours(results: list[dict]) -> list[dict]:
+    """passages of {doc_name, first, last, text, rank}, neighbouring chunk ids of a
+    document joined, in the order of their best hit"""
+    by_doc: dict[str, list[tuple[int, dict]]] = {}
+    for rank, r in enumerate(results):
+        by_doc.setdefault(r["doc_name"], []).append((rank, r))
+
+    passages = []
+    for doc_name, hits in by_doc.items():
+        hits.sort(key=lambda h: h[1]["chunk_id"])
+        current = None
+        for rank, r in hits:
+            if current is not None and r["chunk_id"] == current["last"]:
+                current["rank"] = min(current["rank"], rank) # same chunk twice
+            elif current is not None and r["chunk_id"] == current["last"] + 1:
+                current["text"] += r["text"][_overlap(current["text"], r["text"]):]
+                current["last"] = r["chunk_id"]
+                current["rank"] = min(current["rank"], rank)
+                current["chunks"] += 1
+            else:
+                current = {"doc_name": doc_name, "first": r["chunk_id"], "last": r["chunk_id"],
+                           "text": r["text"], "rank": rank, "chunks": 1}
+                passages.append(current)
+    passages.sort(key=lambda p: p["rank"])
+    return passages
+
+def _passage_block(i: int, p: dict) -> str:
+    chunks = f"#{p['first']}" if p["first"] == p["last"] else f"#{p['first']}-{p['last']}"
+    return f"[{i}] (Source: {p['doc_name']} {chunks})\n {p['text']}\n"
+
+def pack_context(results: list[dict], max_tokens: int | None = None) -> tuple[str, dict]:
+    """context block for the prompt + what packing did to it (tokens are estimates)"""
+    max_tokens = CONTEXT_MAX_TOKENS if max_tokens is None else max_tokens
+    raw_tokens = estimate_tokens(build_context_block(results))
+
+    kept: list[dict] = []
+    kept_shingles: list[set] = []
+    duplicates = 0
+    for p in _merge_neighbours(results):
+        shingles = _shingles(p["text"])
+        if any(len(shingles & other) >= DUPLICATE_THRESHOLD * len(shingles) for other in kept_shingles):
+            duplicates += 1
+            continue
+        kept.append(p)
+        kept_shingles.append(shingles)
+
+    blocks = []
+    used = 0
+    truncated = over_budget = 0
+    for p in kept:
+        block = _passage_block(len(blocks) + 1, p)
+        tokens = estimate_tokens(block)
+        if max_tokens and used + tokens > max_tokens:
+            room = max_tokens - used
+            if room < MIN_TAIL_TOKENS:
+                over_budget += 1
+                continue # a shorter passage further down might still fit
+            # cut the text to roughly what is left, at a word boundary
+            text = p["text"][:max(0, len(p["text"]) - (tokens - room) * 4)]
+            p = {**p, "text": text[:text.rfind(" ")] if " " in text else text}
+            block = _passage_block(len(blocks) + 1, p)
+            tokens = estimate_tokens(block)
+            truncated += 1
+        blocks.append(block)
+        used += tokens
+
+    context_block = "\n".join(blocks)
+    packed_tokens = estimate_tokens(context_block)
+    stats = {
+        "chunks": len(results),
+        "passages": len(blocks),
+        "merged_chunks": sum(p["chunks"] - 1 for p in kept),
+        "duplicates_dropped": duplicates,
+        "truncated": truncated,
+        "over_budget": over_budget,
+        "tokens_raw": raw_tokens,
+        "tokens": packed_tokens,
+        "tokens_saved": max(0, raw_tokens - packed_tokens),
+        "max_tokens": max_tokens,
+    }
+    metrics.inc("themind_context_tokens_saved_total", stats["tokens_saved"])
+    return context_block, stats
 
 def build_context_block(results: list[dict]) -> str:
+    """every chunk verbatim, what the prompt used to get (pack_context compares against it)"""
     lines = []
     for i, r in enumerate(results, 1):
         lines.append(
-            f"[i] (Source: {r['doc_name']} #{r['chunk_id']})\n {r['text']}\n"
+            f"[{i}] (Source: {r['doc_name']} #{r['chunk_id']})\n {r['text']}\n"
         )
 
     return "\n".join(lines)
 
 # for the prompt I asked gpt to make a great prompt -> gave me inspiration :)
-def build_prompt(question: str, results: list[dict]) -> str:
-    context_block = build_context_block(results) # get context block
+def build_prompt(question: str, results: list[dict], max_tokens: int | None = None) -> tuple[str, dict]:
+    """the prompt + the pack_context stats"""
+    context_block, packing = pack_context(results, max_tokens) # get context block
     prompt = f"""
     You are a domain expert assistant.
     Answer ONLY using the CONTEXT.
@@ -32,27 +153,191 @@ def build_prompt(question: str, results: list[dict]) -> str:
 
     FINAL ANSWER:"""
 
-    return prompt
+    return prompt, packing
 
-# the function will return the string that the info holds but it can be of many data types
-def answer_question(question: str, retriever: Retriever, llm: LLMProvider) -> dict[str, Any]:
-    time_start = time.perf_counter()
-    results = retriever.retrieve(question)
-    prompt = build_prompt(question, results)
-    answer_text = llm.generate_answer(prompt)
-    latency = int((time.perf_counter() - time_start) * 1000) # convert seconds to milliseconds
+def _cache_settings(retriever: Retriever, max_context_tokens: int | None) -> tuple:
+    # a cached answer is only good for a request that would have retrieved and packed the same way
+    return retriever.top_k, CONTEXT_MAX_TOKENS if max_context_tokens is None else max_context_tokens
 
+def to_sources(results: list[dict]) -> list[dict]:
     # capture all the sources into a nice list
-    sources = [{
+    return [{
         "doc_name": r["doc_name"],
         "chunk_id": r["chunk_id"],
         "text": r["text"],
     } for r in results]
 
+# the function will return the string that the info holds but it can be of many data types
+def answer_question(question: str, retriever: Retriever, llm: LLMProvider,
+                    cache: AnswerCache | None = None, tenant=None,
+                    doc_names: list[str] | None = None, max_context_tokens: int | None = None) -> dict[str, Any]:
+    time_start = time.perf_counter()
+    if doc_names:
+        cache = None # cached answers came from the whole index, not from these documents
+
+    # with a cache we embed once up front, the same vector is used for lookup and search
+    question_vector = None
+    if cache is not None:
+        question_vector = retriever.embed(question)
+        with metrics.stage("answer.cache_lookup"):
+            hit = cache.lookup(tenant, retriever.store.version, question_vector,
+                               _cache_settings(retriever, max_context_tokens))
+        if hit is not None:
+            return {
+                "answer": hit["answer"],
+                "sources": hit["sources"],
+                "latency_ms": int((time.perf_counter() - time_start) * 1000),
+                "cached": True,
+            }
+
+    results = retriever.retrieve(question, question_vector=question_vector, doc_names=doc_names)
+    with metrics.stage("answer.prompt"):
+        prompt, packing = build_prompt(question, results, max_context_tokens)
+    with metrics.stage("answer.llm"):
+        answer_text = llm.generate_answer(prompt)
+    latency = int((time.perf_counter() - time_start) * 1000) # convert seconds to milliseconds
+
+    sources = to_sources(results)
+
+    if cache is not None:
+        cache.store(tenant, retriever.store.version, question_vector, answer_text, sources,
+                    _cache_settings(retriever, max_context_tokens))
+
     # now return everything aesthetically
     return  {
         "answer": answer_text,
         "sources": sources,
         "latency_ms": latency, # this might be used for debugging or part of the response too
+        "cached": False,
+        "context": packing, # tokens the prompt got vs the chunks verbatim
+    }
+
+
+async def aanswer_question(question: str, retriever: Retriever, llm: LLMProvider,
+                           cache: AnswerCache | None = None, tenant=None,
+                           doc_names: list[str] | None = None,
+                           max_context_tokens: int | None = None) -> dict[str, Any]:
+    """async answer_question, the network calls are awaited and the FAISS search runs
+    on the retriever's thread pool so many of these can run at once on one event loop"""
+    time_start = time.perf_counter()
+    if doc_names:
+        cache = None
+
+    question_vector = None
+    if cache is not None:
+        question_vector = await retriever.aembed(question)
+        with metrics.stage("answer.cache_lookup"):
+            hit = cache.lookup(tenant, retriever.store.version, question_vector,
+                               _cache_settings(retriever, max_context_tokens))
+        if hit is not None:
+            return {
+                "answer": hit["answer"],
+                "sources": hit["sources"],
+                "latency_ms": int((time.perf_counter() - time_start) * 1000),
+                "cached": True,
+            }
+
+    results = await retriever.aretrieve(question, question_vector=question_vector, doc_names=doc_names)
+    with metrics.stage("answer.prompt"):
+        prompt, packing = build_prompt(question, results, max_context_tokens)
+    with metrics.stage("answer.llm"):
+        answer_text = await llm.agenerate_answer(prompt)
+    latency = int((time.perf_counter() - time_start) * 1000)
+
+    sources = to_sources(results)
+    if cache is not None:
+        cache.store(tenant, retriever.store.version, question_vector, answer_text, sources,
+                    _cache_settings(retriever, max_context_tokens))
+
+    return {
+        "answer": answer_text,
+        "sources": sources,
+        "latency_ms": latency,
+        "cached": False,
+        "context": packing, # tokens the prompt got vs the chunks verbatim
     }
 
+
+async def astream_answer_question(question: str, retriever: Retriever, llm: LLMProvider,
+                                  cache: AnswerCache | None = None, tenant=None,
+                                  doc_names: list[str] | None = None, max_context_tokens: int | None = None):
+    """same pipeline as aanswer_question but yields (event, data) as things happen
+    sources right after retrieval, then tokens as the LLM writes them, then done with timings"""
+    time_start = time.perf_counter()
+    if doc_names:
+        cache = None
+    elapsed_ms = lambda: int((time.perf_counter() - time_start) * 1000)
+
+    question_vector = await retriever.aembed(question)
+    if cache is not None:
+        with metrics.stage("answer.cache_lookup"):
+            hit = cache.lookup(tenant, retriever.store.version, question_vector,
+                               _cache_settings(retriever, max_context_tokens))
+        if hit is not None:
+            yield "sources", {"sources": hit["sources"], "retrieval_ms": elapsed_ms()}
+            first_token_ms = elapsed_ms()
+            yield "token", {"text": hit["answer"]}
+            yield "done", {"latency_ms": elapsed_ms(), "ttfb_ms": first_token_ms, "cached": True}
+            return
+
+    results = await retriever.aretrieve(question, question_vector=question_vector, doc_names=doc_names)
+    sources = to_sources(results)
+    yield "sources", {"sources": sources, "retrieval_ms": elapsed_ms()}
+
+    # ttfb here is the time until the first piece of the answer, thats what users wait for
+    first_token_ms = None
+    pieces: list[str] = []
+    with metrics.stage("answer.prompt"):
+        prompt, packing = build_prompt(question, results, max_context_tokens)
+    llm_start = time.perf_counter()
+    async for piece in llm.astream_answer(prompt):
+        if first_token_ms is None:
+            first_token_ms = elapsed_ms()
+            metrics.record("answer.llm_first_token", time.perf_counter() - llm_start)
+        pieces.append(piece)
+        yield "token", {"text": piece}
+    metrics.record("answer.llm", time.perf_counter() - llm_start) # includes the client reading the tokens
+
+    answer_text = "".join(pieces).strip()
+    if cache is not None and answer_text:
+        cache.store(tenant, retriever.store.version, question_vector, answer_text, sources,
+                    _cache_settings(retriever, max_context_tokens))
+
+    yield "done", {"latency_ms": elapsed_ms(), "ttfb_ms": first_token_ms, "cached": False, "context": packing}
+
+
+def answer_questions(questions: list[str], retriever: Retriever, llm: LLMProvider | None = None,
+                     generate: bool = True, max_workers: int = 4,
+                     doc_names: list[str] | None = None,
+                     max_context_tokens: int | None = None) -> list[dict[str, Any]]:
+    """many questions against one index, retrieval is batched into one embed + one search
+    generate=False skips the LLM and only returns the sources (eval jobs want that)"""
+    time_start = time.perf_counter()
+    all_results = retriever.retrieve_many(questions, doc_names=doc_names)
+    retrieval_ms = int((time.perf_counter() - time_start) * 1000)
+
+    def answer(pair):
+        question, results = pair
+        if not generate:
+            return None, None
+        prompt, packing = build_prompt(question, results, max_context_tokens)
+        with metrics.stage("answer.llm"):
+            return llm.generate_answer(prompt), packing
+
+    # the LLM calls are still one per question, run a few at the same time
+    if generate and questions:
+        # a context each (one cant be entered by two threads at once) so the pool threads
+        # still report into the caller's timings
+        contexts = [contextvars.copy_context() for _ in questions]
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(questions)))) as pool:
+            answers = list(pool.map(lambda c, pair: c.run(answer, pair), contexts, zip(questions, all_results)))
+    else:
+        answers = [(None, None)] * len(questions)
+
+    return [{
+        "question": question,
+        "answer": answer_text,
+        "sources": to_sources(results),
+        "retrieval_ms": retrieval_ms, # shared by the whole batch
+        "context": packing, # None without generate, no prompt was built
+    } for question, (answer_text, packing), results in zip(questions, answers, all_results)]
@@ -1,21 +1,76 @@
 # if we get a human question we need to pull top-k relevant chunks from our documents
 # this is what that function solves
 
+import asyncio
+import contextvars
+import os
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
+from . import metrics
 from .embedder import Embedder
 from .store import StoreKnowledge
 
+# FAISS releases the GIL while it searches, so a few threads let searches from
+# concurrent async requests overlap without ever blocking the event loop
+SEARCH_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_THREADS", "4")),
+                                 thread_name_prefix="faiss-search")
+
 class Retriever:
     # again we use a class so we dont have to pass two heavy objects repetitively
-    def __init__(self, store: StoreKnowledge, embedder: Embedder, top_k: int = 5):
+    def __init__(self, store: StoreKnowledge, embedder: Embedder, top_k: int = 5,
+                 nprobe: int | None = None, ef_search: int | None = None):
+        # an index built with other embeddings would return nonsense (or crash on the dimension)
+        store.check_embedding(embedder.describe())
         self.store = store
         self.embedder = embedder
         self.top_k = top_k
+        # search knobs for approximate indexes, None keeps what the index was built with
+        self.nprobe = nprobe
+        self.ef_search = ef_search
 
-    def retrieve(self, question: str):
+    def embed(self, question: str) -> np.ndarray:
         # get the embedding vector for the question
-        question_vector = self.embedder.encode([question])[0] # expects a list of texts so use []
-        results = self.store.query(question_vector.astype("float32"), top_k=self.top_k)
+        with metrics.stage("retrieve.embed"):
+            return self.embedder.encode([question])[0].astype("float32") # expects a list of texts so use []
+
+    def retrieve(self, question: str, question_vector: np.ndarray | None = None,
+                 doc_names: list[str] | None = None):
+        # callers that already embedded the question (eg. for the answer cache) pass it in
+        # doc_names only searches those documents
+        if question_vector is None:
+            question_vector = self.embed(question)
+        with metrics.stage("retrieve.search"):
+            results = self.store.query(question_vector, top_k=self.top_k,
+                                       nprobe=self.nprobe, ef_search=self.ef_search, doc_names=doc_names)
 
         return results
+
+    def retrieve_many(self, questions: list[str], doc_names: list[str] | None = None) -> list[list[dict]]:
+        # one embeddings call (the embedder batches it) and one FAISS search for all questions
+        if not questions:
+            return []
+        with metrics.stage("retrieve.embed"):
+            question_vectors = self.embedder.encode(questions).astype("float32")
+        with metrics.stage("retrieve.search"):
+            return self.store.query_many(question_vectors, top_k=self.top_k,
+                                     nprobe=self.nprobe, ef_search=self.ef_search, doc_names=doc_names)
+
+    async def aembed(self, question: str) -> np.ndarray:
+        with metrics.stage("retrieve.embed"):
+            return (await self.embedder.aencode([question]))[0].astype("float32")
+
+    async def aretrieve(self, question: str, question_vector: np.ndarray | None = None,
+                        doc_names: list[str] | None = None):
+        if question_vector is None:
+            question_vector = await self.aembed(question)
+        loop = asyncio.get_running_loop()
+        # run_in_executor doesnt carry the context over, copy it so the timings of the
+        # search thread still land in this request's breakdown
+        search = contextvars.copy_context().run
+        with metrics.stage("retrieve.search"): # includes waiting for a free search thread
+            return await loop.run_in_executor(
+                SEARCH_POOL,
+                lambda: search(self.store.query, question_vector, top_k=self.top_k,
+                               nprobe=self.nprobe, ef_search=self.ef_search, doc_names=doc_names),
+            )
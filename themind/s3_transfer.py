@@ -0,0 +1,128 @@
+# every bulk S3 operation the api does goes through here
+# ingest used to download and upload one file at a time, for a tenant with a few
+# hundred docs that was most of the wall time of an ingest. now files move on a shared
+# pool of threads and big ones are split into multipart ranges that move in parallel too
+
+# listing is always paginated (1000 keys per page is the S3 limit, so is delete_objects)
+# and every batch reports how many bytes it moved and how fast
+
+# S3_ENDPOINT_URL points the client at something else than AWS (moto server, minio)
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from . import metrics
+
+MB = 1024 * 1024
+_DELETE_BATCH = 1000 # delete_objects takes at most this many keys
+
+
+def make_client(session: boto3.session.Session, max_pool_connections: int = 50):
+    """s3 client with a connection pool big enough for all our transfer threads"""
+    return session.client(
+        "s3",
+        endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+        config=Config(max_pool_connections=max_pool_connections, retries={"max_attempts": 5, "mode": "adaptive"}),
+    )
+
+
+class S3Transfer:
+    """concurrent downloads/uploads/deletes for one bucket"""
+
+    def __init__(self, client, bucket: str, max_workers: int = 8, multipart_threshold: int = 16 * MB,
+                 multipart_chunksize: int = 16 * MB, part_concurrency: int = 4):
+        self.client = client
+        self.bucket = bucket
+        self.max_workers = max_workers
+        # files above the threshold are fetched as parallel byte ranges, 16MB parts are
+        # big enough that request overhead doesnt matter and small enough to retry cheaply
+        self.config = TransferConfig(multipart_threshold=multipart_threshold,
+                                     multipart_chunksize=multipart_chunksize,
+                                     max_concurrency=part_concurrency, use_threads=True)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="s3")
+        self._lock = threading.Lock()
+        self._totals = {"download": {"files": 0, "bytes": 0, "seconds": 0.0},
+                        "upload": {"files": 0, "bytes": 0, "seconds": 0.0}}
+
+    @classmethod
+    def from_env(cls, client, bucket: str):
+        return cls(
+            client,
+            bucket,
+            max_workers=int(os.getenv("S3_TRANSFER_WORKERS", "8")),
+            multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "16")) * MB,
+            multipart_chunksize=int(os.getenv("S3_MULTIPART_CHUNK_MB", "16")) * MB,
+            part_concurrency=int(os.getenv("S3_PART_CONCURRENCY", "4")),
+        )
+
+    def list_objects(self, prefix: str) -> list[dict]:
+        """every object under prefix, all pages, without the folder placeholder keys"""
+        objects: list[dict] = []
+        for page in self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            objects.extend(page.get("Contents", []))
+        return [obj for obj in objects if not obj["Key"].endswith("/")]
+
+    def _download(self, key: str, path: str) -> int:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.client.download_file(self.bucket, key, path, Config=self.config)
+        return os.path.getsize(path)
+
+    def _upload(self, path: str, key: str) -> int:
+        self.client.upload_file(path, self.bucket, key, Config=self.config)
+        return os.path.getsize(path)
+
+    def _run(self, kind: str, fn: Callable, jobs: list[tuple], progress: Callable | None) -> dict:
+        start = time.perf_counter()
+        files = 0
+        nbytes = 0
+        futures = [self._pool.submit(fn, *job) for job in jobs]
+        try:
+            for future in as_completed(futures):
+                nbytes += future.result()
+                files += 1
+                if progress is not None:
+                    progress(files, nbytes)
+        except Exception:
+            for future in futures:
+                future.cancel() # one failed file fails the batch, dont start the rest
+            raise
+        seconds = time.perf_counter() - start
+        metrics.record(f"s3.{kind}", seconds)
+        metrics.inc("themind_s3_bytes_total", nbytes, direction=kind)
+        metrics.inc("themind_s3_files_total", files, direction=kind)
+
+        with self._lock:
+            totals = self._totals[kind]
+            totals["files"] += files
+            totals["bytes"] += nbytes
+            totals["seconds"] += seconds
+        return {"files": files, "bytes": nbytes, "seconds": round(seconds, 3),
+                "bytes_per_sec": round(nbytes / seconds) if seconds > 0 else None}
+
+    def download_many(self, pairs: list[tuple[str, str]], progress: Callable | None = None) -> dict:
+        """download (key, local_path) pairs, progress(files_done, bytes_done) after each file"""
+        return self._run("download", self._download, pairs, progress)
+
+    def upload_many(self, pairs: list[tuple[str, str]], progress: Callable | None = None) -> dict:
+        """upload (local_path, key) pairs, progress(files_done, bytes_done) after each file"""
+        return self._run("upload", self._upload, pairs, progress)
+
+    def delete_many(self, keys: list[str]):
+        for i in range(0, len(keys), _DELETE_BATCH):
+            part = keys[i:i + _DELETE_BATCH]
+            self.client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": k} for k in part]})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                kind: {**t, "seconds": round(t["seconds"], 3),
+                       "bytes_per_sec": round(t["bytes"] / t["seconds"]) if t["seconds"] > 0 else None}
+                for kind, t in self._totals.items()
+            }
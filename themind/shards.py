@@ -0,0 +1,215 @@
+# one faiss.index per tenant gets slow to build and slow to search once a tenant has
+# millions of chunks. past INDEX_SHARD_ROWS vectors the index is split into shards, each
+# a normal index over a contiguous block of rows (shard-000.index, shard-001.index, ...)
+# built one after the other, so a build only ever holds one shard's worth of index
+
+# ShardedIndex looks like a faiss index to StoreKnowledge (d, ntotal, search,
+# reconstruct_n) with global row ids. a search goes to every shard at once on a thread
+# pool and the per shard top-k are merged, which is exact: the best k overall are always
+# among the best k of their own shard
+
+# shards load on first use. fetch(name) can pull a shard that isnt on disk yet (the api
+# passes one that downloads it from S3), so a cold tenant is ready after the small files
+# and a query only waits for the shards it touches, all of them in parallel
+
+import contextvars
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+import numpy as np
+
+from . import metrics
+from .indexing import (build_index, mask_selector, prepare_reconstruct, range_selector, read_index, scan_ranges,
+                       search_alive, search_params, takes_selector, write_index)
+
+SHARD_ROWS = int(os.getenv("INDEX_SHARD_ROWS", "1000000")) # 0 -> never shard
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", str(min(16, os.cpu_count() or 4))))
+_SHARD_FILE = re.compile(r"^shard-\d{3}\.index$")
+
+_pool = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS, thread_name_prefix="shard")
+
+
+def shard_name(i: int) -> str:
+    return f"shard-{i:03d}.index"
+
+
+def is_shard_file(name: str) -> bool:
+    return bool(_SHARD_FILE.match(name))
+
+
+def shard_bounds(n: int, shard_rows: int) -> list[tuple[int, int]]:
+    """[start, end) rows of every shard, as even as possible and none over shard_rows"""
+    count = max(1, math.ceil(n / shard_rows))
+    edges = np.linspace(0, n, count + 1).round().astype(int)
+    return [(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+
+
+def build_shards(vectors: np.ndarray, out_dir: str, shard_rows: int, index_type: str = "auto",
+                 compression: str = "none", keep_vectors: bool = False) -> dict:
+    """build and write every shard, returns the info of the whole thing (shards listed in it)"""
+    n, dim = vectors.shape
+    shards = []
+    for i, (start, end) in enumerate(shard_bounds(n, shard_rows)):
+        index, info = build_index(vectors[start:end], index_type, compression, keep_vectors)
+        name = shard_name(i)
+        shards.append({"file": name, "start": start, "rows": end - start,
+                       "index_bytes": write_index(index, str(Path(out_dir) / name)), **info})
+        del index
+        print(f"[ingest] shard {i + 1}: rows {start}-{end}, {info['index_type']}, "
+              f"recall@{info['recall_k']} = {info['recall_at_k']}")
+
+    # the shards are the same kind of index (same sizes -> same pick), describe them as one
+    weighted = lambda key: round(sum(s[key] * s["rows"] for s in shards) / max(n, 1), 4)
+    info = {key: shards[0][key] for key in ("index_type", "compression", "factory", "search", "recall_k", "rerank")}
+    info.update(
+        ntotal=int(n),
+        dim=int(dim),
+        build_seconds=round(sum(s["build_seconds"] for s in shards), 3),
+        recall_at_k=weighted("recall_at_k"), # each measured inside its own shard
+        raw_vector_bytes=int(n) * int(dim) * 4,
+        index_bytes=sum(s["index_bytes"] for s in shards),
+        shards=[{key: s[key] for key in ("file", "start", "rows", "index_type", "compression", "index_bytes",
+                                         "recall_at_k")} for s in shards],
+    )
+    if info["rerank"]:
+        info["rerank_recall_at_k"] = weighted("rerank_recall_at_k")
+    return info
+
+
+def remove_stale_shards(out_dir: str, keep: set[str]):
+    for path in Path(out_dir).iterdir():
+        if is_shard_file(path.name) and path.name not in keep:
+            path.unlink()
+
+
+class _Shard:
+    def __init__(self, index_dir: Path, spec: dict, fetch: Callable | None):
+        self.path = index_dir / spec["file"]
+        self.name = spec["file"]
+        self.start = spec["start"]
+        self.rows = spec["rows"]
+        self.compression = spec.get("compression", "none")
+        self.index = None
+        self.mapped = False
+        self._fetch = fetch
+        self._lock = threading.Lock()
+        self._direct_map = False
+        self.alive = None # (selector, bitmap) when some of this shard's rows are tombstoned
+        self.alive_rows = None # the mask behind it, for a shard that cant take a selector
+
+    def get(self):
+        """the loaded shard index, fetched / read on the first call"""
+        if self.index is None:
+            with self._lock:
+                if self.index is None:
+                    start = time.perf_counter()
+                    if not self.path.exists() and self._fetch is not None:
+                        self._fetch(self.name)
+                    self.index, self.mapped = read_index(self.path)
+                    metrics.record("store.shard_load", time.perf_counter() - start)
+        return self.index
+
+    def search(self, x: np.ndarray, k: int, nprobe: int | None, ef_search: int | None,
+               ranges: list[tuple[int, int]] | None) -> tuple[np.ndarray, np.ndarray]:
+        index = self.get()
+        if ranges and not takes_selector(index):
+            # flat + pq shard, scan the decoded rows of the ranges (same distances as its search)
+            distances, ids = scan_ranges(x, k, ranges, index.reconstruct_n)
+            return distances, np.where(ids >= 0, ids + self.start, -1)
+        if not ranges and self.alive_rows is not None and not takes_selector(index):
+            distances, ids = search_alive(index, x, k, self.alive_rows)
+            return distances, np.where(ids >= 0, ids + self.start, -1)
+        selector, _keep_alive = range_selector(ranges, self.rows) if ranges else (self.alive or (None, None))
+        distances, ids = index.search(x, k, params=search_params(index, nprobe, ef_search, selector))
+        return distances, np.where(ids >= 0, ids + self.start, -1)
+
+    def reconstruct_n(self, start: int, n: int) -> np.ndarray:
+        index = self.get()
+        if not self._direct_map:
+            with self._lock:
+                if not self._direct_map:
+                    prepare_reconstruct(index)
+                    self._direct_map = True
+        return index.reconstruct_n(start, n)
+
+
+class ShardedIndex:
+    """the shards of a build as one index, global ids, see the top of the file"""
+
+    def __init__(self, index_dir: str, info: dict, fetch: Callable | None = None):
+        self.shards = [_Shard(Path(index_dir), spec, fetch) for spec in info["shards"]]
+        self.d = int(info["dim"])
+        self.ntotal = sum(s.rows for s in self.shards)
+
+    def params(self, nprobe: int | None = None, ef_search: int | None = None,
+               ranges: list[tuple[int, int]] | None = None) -> dict:
+        """what search(params=...) takes, every shard turns it into its own faiss params"""
+        return {"nprobe": nprobe, "ef_search": ef_search, "ranges": ranges}
+
+    def _local_ranges(self, shard: _Shard, ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        end = shard.start + shard.rows
+        return [(max(a, shard.start) - shard.start, min(b, end) - shard.start)
+                for a, b in ranges if a < end and b > shard.start]
+
+    def search(self, x: np.ndarray, k: int, params: dict | None = None) -> tuple[np.ndarray, np.ndarray]:
+        params = params or {}
+        ranges = params.get("ranges")
+        jobs = []
+        for shard in self.shards:
+            local = self._local_ranges(shard, ranges) if ranges else None
+            if ranges and not local:
+                continue # none of the wanted rows live here, dont even load it
+            jobs.append((shard, local))
+
+        if len(jobs) == 1:
+            shard, local = jobs[0]
+            parts = [shard.search(x, k, params.get("nprobe"), params.get("ef_search"), local)]
+        else:
+            # a copied context each so shard loads show up in the caller's timings
+            futures = [_pool.submit(contextvars.copy_context().run, shard.search, x, k, params.get("nprobe"),
+                                    params.get("ef_search"), local) for shard, local in jobs]
+            parts = [f.result() for f in futures]
+        return merge_topk(parts, k, len(x))
+
+    def set_alive(self, mask: np.ndarray | None):
+        """rows a search without ranges may return (delta.py tombstones), None for all"""
+        for shard in self.shards:
+            part = mask[shard.start:shard.start + shard.rows] if mask is not None else None
+            shard.alive_rows = part if part is not None and not part.all() else None
+            shard.alive = mask_selector(part) if shard.alive_rows is not None else None
+
+    def reconstruct_n(self, start: int, n: int) -> np.ndarray:
+        out = []
+        end = start + n
+        for shard in self.shards:
+            a, b = max(start, shard.start), min(end, shard.start + shard.rows)
+            if a < b:
+                out.append(shard.reconstruct_n(a - shard.start, b - a))
+        return np.vstack(out) if out else np.empty((0, self.d), dtype="float32")
+
+    def prepare_reconstruct(self) -> bool:
+        """True when every shard keeps the exact vectors, the direct maps get built lazily"""
+        return all(s.compression == "none" for s in self.shards)
+
+    def loaded(self) -> list[_Shard]:
+        return [s for s in self.shards if s.index is not None]
+
+
+def merge_topk(parts: list[tuple[np.ndarray, np.ndarray]], k: int, nq: int) -> tuple[np.ndarray, np.ndarray]:
+    """k smallest distances per row over every (distances, ids) part, padded with (inf, -1)"""
+    if not parts:
+        return np.full((nq, k), np.inf, dtype="float32"), np.full((nq, k), -1, dtype="int64")
+    distances = np.hstack([d for d, _ in parts])
+    ids = np.hstack([i for _, i in parts])
+    distances = np.where(ids >= 0, distances, np.inf) # faiss' padding for missing results
+    if distances.shape[1] < k:
+        pad = k - distances.shape[1]
+        distances = np.hstack([distances, np.full((nq, pad), np.inf, dtype=distances.dtype)])
+        ids = np.hstack([ids, np.full((nq, pad), -1, dtype=ids.dtype)])
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
@@ -5,39 +5,219 @@
 # you can call here to create FAISS binary index then when answering a query you can have a
 # persistent memory, allowing it to "remember" document embeddings between different runs
 
-import faiss
 import json
+import threading
 import numpy as np
 from pathlib import Path
 
+from . import metrics
+from .chunk_meta import ChunkMeta, ChunkMetaWriter, doc_ranges, write_chunk_meta
+from .delta import COMPACT_DELTA_ROWS, COMPACT_RATIO, DELTA_FILES, DeltaSegment, remove_delta
+from .shards import SHARD_ROWS, ShardedIndex, build_shards, merge_topk, remove_stale_shards
+from .indexing import (INFO_NAME, RERANK_FACTOR, VECTORS_NAME, build_index, keeps_exact_vectors, load_info, load_vectors,
+                       mask_selector, prepare_reconstruct, range_selector, read_index, rerank, save_info,
+                       save_vectors, scan_ranges, search_alive, search_params, takes_selector, write_index)
+
+INDEX_NAME = "faiss.index"
+CHUNKS_NAME = "chunks.bin" # columnar + mmap, see chunk_meta.py
+LEGACY_CHUNKS_NAME = "chunks.jsonl" # what older builds wrote, still loads
+# a search limited to documents with at most this many chunks just compares against all
+# of them (exact, and the approximate indexes can miss rows that are this rare)
+EXACT_FILTER_ROWS = 50_000
+
+
+class EmbeddingMismatchError(ValueError):
+    """the index was built with other embeddings than the ones we would query it with"""
+
+
 class StoreKnowledge:
-    def __init__(self, index_path: str, chunks_path: str):
+    def __init__(self, index_path: str, chunks_path: str, fetch=None):
         self.index_path = index_path # where FAISS index vector lives
         self.chunks_path = chunks_path # what the vector means in  words
         self.index = None
         self.chunks = None
+        self.version = None # identifies this build of the index, set by whoever loads it
+        self.info = None # index_info.json -> type, default search knobs, recall at build time
+        self.doc_ranges: dict[str, list] = {} # doc_name -> [start, end) rows, for doc filters
+        self.vectors = None # full vectors (mmap) next to a compressed index, for the exact rerank
+        self.index_mapped = False # faiss.index mmap'd (shared between processes) or on our heap
+        self.fetch = fetch # fetch(file name) brings a shard that isnt on disk yet, see shards.py
+        self.rerank_factor = RERANK_FACTOR
+        self._reconstruct_lock = threading.Lock()
+        self._can_reconstruct = None # worked out on the first filtered search
+        self.delta = None # documents changed since the build, see delta.py
+        self._alive = (None, None) # selector skipping tombstoned rows + the bitmap it reads
+        self._alive_rows = None # the same as a mask, for an index that cant take the selector
+
+    @classmethod
+    def from_dir(cls, index_dir: str, fetch=None):
+        """store for a folder written by save_index_chunk, falls back to old chunks.jsonl builds"""
+        index_dir = Path(index_dir)
+        chunks_path = index_dir / CHUNKS_NAME
+        if not chunks_path.exists():
+            chunks_path = index_dir / LEGACY_CHUNKS_NAME
+        return cls(index_path=index_dir / INDEX_NAME, chunks_path=chunks_path, fetch=fetch)
+
+    def exists(self) -> bool:
+        """a complete build is on disk, faiss.index or the shards index_info.json lists"""
+        if not Path(self.chunks_path).exists():
+            return False
+        if Path(self.index_path).exists():
+            return True
+        shards = load_info(Path(self.index_path).parent).get("shards")
+        return bool(shards) and all((Path(self.index_path).parent / s["file"]).exists() for s in shards)
 
     def load(self):
         """load faiss index and then chunk metadata"""
-        self.index = faiss.read_index(str(self.index_path))
+        index_dir = Path(self.index_path).parent
+        self.info = load_info(index_dir)
+        if self.info.get("shards"):
+            # nothing is read yet, every shard loads on its first search (shards.py)
+            self.index = ShardedIndex(index_dir, self.info, self.fetch)
+            exact = not self.info.get("rerank")
+        else:
+            self.index, self.index_mapped = read_index(self.index_path)
+            exact = keeps_exact_vectors(self.index)
+        if not exact:
+            # stays on disk, a rerank only pages in the rows of its candidates
+            self.vectors = load_vectors(index_dir)
+
+        if str(self.chunks_path).endswith(".jsonl"):
+            self.chunks = self._load_jsonl(self.chunks_path)
+            names: dict[str, int] = {}
+            ids = np.array([names.setdefault(c["doc_name"], len(names)) for c in self.chunks], dtype="int32")
+            self.doc_ranges = dict(zip(names, doc_ranges(ids, len(names))))
+        else:
+            # only the rows a query hits get decoded
+            self.chunks = ChunkMeta(self.chunks_path)
+            self.doc_ranges = dict(zip(self.chunks.doc_names, self.chunks.doc_ranges))
+
+        self.delta = DeltaSegment.load(index_dir, self.index.d, len(self.chunks))
+        if self.delta is not None:
+            for name in self.delta.removed:
+                self.doc_ranges.pop(name, None) # their rows are tombstoned, the delta may have a new copy
+            self._refresh_alive()
+
+    @property
+    def base_rows(self) -> int:
+        return len(self.chunks)
+
+    def documents(self) -> list[str]:
+        """every document that is searchable right now, build + delta"""
+        names = list(self.doc_ranges)
+        if self.delta is not None:
+            names += [name for name in self.delta.docs if name not in self.doc_ranges]
+        return names
 
+    def add_document(self, doc_name: str, vectors: np.ndarray, texts: list[str]) -> list[int]:
+        """add a document that isnt in here yet, returns the ids its chunks got"""
+        if doc_name in self.doc_ranges or (self.delta is not None and doc_name in self.delta.docs):
+            raise ValueError(f"{doc_name} is already in the index, replace it instead")
+        if len(texts) and vectors.shape[1] != self.index.d:
+            raise EmbeddingMismatchError(f"index has {self.index.d} dims but got {vectors.shape[1]} dim vectors")
+        return self._delta().add(doc_name, vectors, texts)
+
+    def replace_document(self, doc_name: str, vectors: np.ndarray, texts: list[str]) -> list[int]:
+        """new version of a document (or a new one), the old chunks stop showing up"""
+        self.remove_document(doc_name)
+        return self.add_document(doc_name, vectors, texts)
+
+    def remove_document(self, doc_name: str) -> bool:
+        """False if there was no such document"""
+        found = False
+        ranges = self.doc_ranges.pop(doc_name, None)
+        if ranges is not None:
+            self._delta().tombstone(doc_name, ranges)
+            self._refresh_alive()
+            found = True
+        if self.delta is not None and self.delta.remove(doc_name):
+            found = True
+        return found
+
+    def save_delta(self, out_dir: str | None = None) -> list[str]:
+        """write the delta (next to the build by default), returns the files written"""
+        out = Path(out_dir or Path(self.index_path).parent)
+        if self.delta is None:
+            return []
+        self.delta.save(str(out))
+        return [str(out / name) for name in DELTA_FILES]
+
+    def delta_stats(self) -> dict:
+        delta = self.delta
+        return {
+            "base_rows": self.base_rows,
+            "delta_rows": delta.rows if delta else 0,
+            "delta_documents": len(delta.docs) if delta else 0,
+            "tombstoned_rows": delta.tombstoned_rows() if delta else 0,
+            "seq": delta.seq if delta else 0,
+        }
+
+    def needs_compaction(self) -> bool:
+        """the delta got big enough that a fresh build beats searching around it"""
+        stats = self.delta_stats()
+        changed = stats["delta_rows"] + stats["tombstoned_rows"]
+        return stats["delta_rows"] >= COMPACT_DELTA_ROWS or changed > COMPACT_RATIO * max(stats["base_rows"], 1)
+
+    def _delta(self) -> DeltaSegment:
+        if self.delta is None:
+            self.delta = DeltaSegment(self.index.d, self.base_rows)
+        return self.delta
+
+    def _refresh_alive(self):
+        mask = self.delta.alive()
+        if isinstance(self.index, ShardedIndex):
+            self.index.set_alive(mask) # every shard keeps the selector for its own rows
+        elif takes_selector(self.index):
+            self._alive = mask_selector(mask) if mask is not None else (None, None)
+        else:
+            self._alive_rows = mask # flat + pq, _search drops the tombstoned rows afterwards
+
+    def artifacts(self) -> dict:
+        """file -> {path, bytes, mapped} of what load() opened, mapped files are shared
+        with every other process that maps them (see memory.py)"""
+        if isinstance(self.index, ShardedIndex):
+            files = {shard.name: (shard.path, shard.mapped) for shard in self.index.loaded()}
+        else:
+            files = {"index": (self.index_path, self.index_mapped)}
+        files["chunks"] = (self.chunks_path, isinstance(self.chunks, ChunkMeta))
+        if self.vectors is not None:
+            files["vectors"] = (Path(self.index_path).parent / VECTORS_NAME, True)
+        return {name: {"path": str(path), "bytes": Path(path).stat().st_size if Path(path).exists() else None,
+                       "mapped": mapped} for name, (path, mapped) in files.items()}
+
+    def check_embedding(self, embedding: dict):
+        """raise EmbeddingMismatchError unless vectors from embedding (Embedder.describe())
+        can be searched in this index. builds from before backends only have the dimension"""
+        built = self.info.get("embedding", {})
+        if built.get("model") and built["model"] != embedding["model"]:
+            raise EmbeddingMismatchError(
+                f"index was built with {built['model']} but queries use {embedding['model']}, re-ingest")
+        if embedding.get("dim") and embedding["dim"] != self.index.d:
+            raise EmbeddingMismatchError(
+                f"index has {self.index.d} dims but {embedding['model']} gives {embedding['dim']}, re-ingest")
+
+    @staticmethod
+    def _load_jsonl(chunks_path) -> list[dict]:
         chunks: list[dict] = []
         # now chunk metadata
-        with open(self.chunks_path, "r", encoding="utf-8", errors="replace") as f:
+        with open(chunks_path, "r", encoding="utf-8", errors="replace") as f:
             for line in f:
                 line = line.strip()
                 if not line:
                     continue
                 chunks.append(json.loads(line)) # deserialization
-            self.chunks = chunks
+        return chunks
 
-    # currently only using one query
-    def query(self, query_vector: np.ndarray, top_k: int = 5) -> list[dict]:
+    def query(self, query_vector: np.ndarray, top_k: int = 5,
+              nprobe: int | None = None, ef_search: int | None = None,
+              doc_names: list[str] | str | None = None) -> list[dict]:
         """take query embedding then search FAISS index for most 
         similar document chunk. then just return a list of dictionaries
         describing those top-k chunks
         in short: find me 5 pieces of text in knowledge base that are 
         closest to this question
+        nprobe (IVF) / ef_search (HNSW) trade speed for recall, None keeps the build defaults
+        doc_names limits the search to those documents
         """
         # make sure you got the right shape for FAISS
         # usually a user will only ask one question that will collapse the dimesions
@@ -46,58 +226,218 @@ class StoreKnowledge:
         if query_vector.ndim == 1:
             query_vector = query_vector[np.newaxis, :]
 
-        # do a similarity search with faiss - dont have to do this manually
-        distances, indices = self.index.search(query_vector, top_k)
-
-        # flatten arrays out so we only got a 1D array instead of 2D array
-        distances = distances[0]; indices = indices[0]
+        return self.query_many(query_vector[:1], top_k=top_k, nprobe=nprobe, ef_search=ef_search,
+                               doc_names=doc_names)[0]
 
+    def query_many(self, query_vectors: np.ndarray, top_k: int = 5,
+                   nprobe: int | None = None, ef_search: int | None = None,
+                   doc_names: list[str] | str | None = None) -> list[list[dict]]:
+        """same as query but for a [num_questions, dim] matrix, one FAISS call for all of them"""
         if self.chunks is None:
             raise RuntimeError("Store is empty rerun data/")
-    
+
+        query_vectors = np.ascontiguousarray(query_vectors, dtype="float32")
+
+        delta = self.delta
+        with metrics.stage("store.search"):
+            if doc_names:
+                names = [doc_names] if isinstance(doc_names, str) else list(doc_names)
+                ranges = self.doc_rows(names)
+                in_delta = delta is not None and any(name in delta.docs for name in names)
+                if not ranges and not in_delta:
+                    return [[] for _ in range(len(query_vectors))] # none of those documents are in here
+                if ranges:
+                    distances, indices = self._search_ranges(query_vectors, top_k, ranges, nprobe, ef_search)
+                else:
+                    distances, indices = merge_topk([], top_k, len(query_vectors))
+                delta_part = delta.search(query_vectors, top_k, names) if in_delta else None
+            else:
+                # do a similarity search with faiss - dont have to do this manually
+                params, _ = self._params(nprobe, ef_search)
+                distances, indices = self._search(query_vectors, top_k, params, self._alive_rows)
+                delta_part = delta.search(query_vectors, top_k) if delta is not None and delta.rows else None
+            if delta_part is not None:
+                # the delta is exact and tiny next to the build, its top-k just joins the build's
+                distances, indices = merge_topk([(distances, indices), delta_part], top_k, len(query_vectors))
+        with metrics.stage("store.lookup"):
+            return self._results(distances, indices)
+
+    def _results(self, distances: np.ndarray, indices: np.ndarray) -> list[list[dict]]:
+        # Faiss gives -1 when it cant find top-k, mask those out for every question at once
+        base = (indices >= 0) & (indices < len(self.chunks))
+        records = self.delta.records if self.delta is not None else {}
+        rows = np.where(base, indices, 0)
+        doc_names, chunk_ids = self._lookup(rows)
+
         results = []
-        for distance, idx in zip(distances, indices):
-            if idx < 0 or idx >= len(self.chunks): # Faiss might return error if top-k is not found
-                continue # skip unwanted indices
-            metadata = self.chunks[idx]
-            results.append(
-                {
-                    "dist_score": float(distance),
-                    "doc_name": metadata["doc_name"],
-                    "chunk_id": metadata["chunk_id"],
-                    "text": metadata["text"],
-                }
-            )
+        for q in range(len(indices)):
+            hits = []
+            for j in range(indices.shape[1]):
+                if not base[q, j]:
+                    record = records.get(int(indices[q, j])) # ids past the build are delta chunks
+                    if record is not None:
+                        hits.append({"dist_score": float(distances[q, j]), **record})
+                    continue
+                hits.append(
+                    {
+                        "dist_score": float(distances[q, j]),
+                        "doc_name": doc_names[q][j],
+                        "chunk_id": int(chunk_ids[q, j]),
+                        "text": self._text(int(rows[q, j])),
+                    }
+                )
+            results.append(hits)
         return results
-    
+
+    def doc_rows(self, doc_names: list[str] | str) -> list[tuple[int, int]]:
+        """sorted [start, end) row ranges (= vector ids) of the given documents"""
+        if isinstance(doc_names, str):
+            doc_names = [doc_names]
+        ranges = [tuple(r) for name in set(doc_names) for r in self.doc_ranges.get(name, [])]
+        return sorted(ranges)
+
+    def _search_ranges(self, query_vectors: np.ndarray, top_k: int, ranges: list[tuple[int, int]],
+                       nprobe: int | None, ef_search: int | None) -> tuple[np.ndarray, np.ndarray]:
+        """search limited to some id ranges, same (distances, indices) shape as index.search"""
+        rows = sum(end - start for start, end in ranges)
+        if rows <= EXACT_FILTER_ROWS and self.reconstructable():
+            return self._scan_ranges(query_vectors, top_k, ranges)
+        if not isinstance(self.index, ShardedIndex) and not takes_selector(self.index):
+            # flat + pq cant skip rows while it searches, it scans everything anyway and the
+            # decoded codes give the same distances it would
+            return self._scan_ranges(query_vectors, top_k, ranges)
+        # lots of rows, let the index skip everything outside the ranges while it searches
+        params, _keep_alive = self._params(nprobe, ef_search, ranges)
+        return self._search(query_vectors, top_k, params)
+
+    def _params(self, nprobe: int | None, ef_search: int | None, ranges: list[tuple[int, int]] | None = None):
+        """(params for self.index.search, a buffer the params need alive)"""
+        if isinstance(self.index, ShardedIndex):
+            return self.index.params(nprobe, ef_search, ranges), None # each shard makes its own
+        selector, keep_alive = range_selector(ranges, self.index.ntotal) if ranges else self._alive
+        return search_params(self.index, nprobe=nprobe, ef_search=ef_search, selector=selector), keep_alive
+
+    def _search(self, query_vectors: np.ndarray, top_k: int, params,
+                alive: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """alive (a mask over the rows) filters after the search instead of a selector in params"""
+        def search(k):
+            if alive is None:
+                return self.index.search(query_vectors, k, params=params)
+            return search_alive(self.index, query_vectors, k, alive)
+
+        if self.vectors is None or self.rerank_factor <= 1:
+            return search(top_k)
+        # compressed codes only roughly order the vectors, fetch more candidates than we
+        # need and let the full vectors decide which of them are really the closest
+        _, candidates = search(top_k * self.rerank_factor)
+        return rerank(query_vectors, candidates, self.vectors, top_k)
+
+    def _rows(self, start: int, n: int) -> np.ndarray:
+        if self.vectors is not None:
+            return np.ascontiguousarray(self.vectors[start:start + n], dtype="float32")
+        return self.index.reconstruct_n(start, n)
+
+    def reconstructable(self) -> bool:
+        """True when exact vectors can be read back (vectors.npy or an index that keeps them)"""
+        if self.vectors is not None:
+            return True
+        with self._reconstruct_lock:
+            if self._can_reconstruct is None:
+                if isinstance(self.index, ShardedIndex):
+                    self._can_reconstruct = self.index.prepare_reconstruct()
+                else:
+                    self._can_reconstruct = prepare_reconstruct(self.index)
+            return self._can_reconstruct
+
+    def _scan_ranges(self, query_vectors: np.ndarray, top_k: int,
+                     ranges: list[tuple[int, int]]) -> tuple[np.ndarray, np.ndarray]:
+        # exact top_k over just these rows (kept vectors, else what the index reconstructs)
+        return scan_ranges(query_vectors, top_k, ranges, self._rows)
+
+    def _lookup(self, rows: np.ndarray) -> tuple[list[list[str]], np.ndarray]:
+        """doc names and chunk ids for a matrix of rows"""
+        if isinstance(self.chunks, ChunkMeta):
+            # columns are numpy arrays, gather the whole matrix with one fancy index
+            names = np.array(self.chunks.doc_names, dtype=object)
+            return names[self.chunks.doc_ids[rows]].tolist(), self.chunks.chunk_ids[rows]
+        doc_names = [[self.chunks[r]["doc_name"] for r in row] for row in rows]
+        chunk_ids = np.array([[self.chunks[r]["chunk_id"] for r in row] for row in rows]).reshape(rows.shape)
+        return doc_names, chunk_ids
+
+    def _text(self, row: int) -> str:
+        if isinstance(self.chunks, ChunkMeta):
+            return self.chunks.text(row) # only decode what we return
+        return self.chunks[row]["text"]
+
     @staticmethod
-    def save_index_chunk(vectors: np.ndarray, chunk_records: list[dict], out_dir: str="data"):
+    def save_index_chunk(vectors: np.ndarray, chunk_records: list[dict] | ChunkMetaWriter, out_dir: str="data",
+                         index_type: str = "auto", embedding: dict | None = None,
+                         compression: str = "none", keep_vectors: bool = False,
+                         shard_rows: int | None = None) -> dict:
+        """vectors can be a memmap and chunk_records a ChunkMetaWriter, thats what the
+        streaming ingest hands us so nothing has to sit in memory all at once
+        embedding (Embedder.describe()) is recorded so the index can refuse other vectors
+        compression (fp16/sq8/pq) shrinks the index, keep_vectors also saves the full ones for reranking
+        more than shard_rows vectors (default INDEX_SHARD_ROWS) get split into shards, see shards.py"""
         # safe check if directory exists
         out = Path(out_dir)
         out.mkdir(parents=True, exist_ok=True)
 
         # build the faiss index
-        dim = vectors.shape[1]
         # faiss index a data structure optimized for searching nearest neighbour in vector space
-        index = faiss.IndexFlatL2(dim) # simple and highly accurate -> for a small dataset it shouldnt be too slow
-        # print("index.is_trained") -> used to debug
-        index.add(vectors)
-
-        # write this binary mass into output
-        faiss.write_index(index, str(out / "faiss.index"))
+        # small corpora stay on IndexFlatL2 (exact), bigger ones get an approximate index
+        # see indexing.py for how we pick and what recall we measured
+        shard_rows = SHARD_ROWS if shard_rows is None else shard_rows
+        if shard_rows and len(vectors) > shard_rows:
+            info = build_shards(vectors, str(out), shard_rows, index_type, compression, keep_vectors)
+            if (out / INDEX_NAME).exists():
+                (out / INDEX_NAME).unlink() # from an unsharded build
+        else:
+            index, info = build_index(vectors, index_type, compression, keep_vectors)
+            # write this binary mass into output
+            info["index_bytes"] = write_index(index, str(out / INDEX_NAME))
+            del index
+        remove_stale_shards(str(out), {shard["file"] for shard in info.get("shards", [])})
+        remove_delta(str(out)) # the new build already has whatever the delta changed
+        if embedding is not None:
+            info["embedding"] = {**embedding, "dim": int(vectors.shape[1])}
+        info["compression_ratio"] = round(info["raw_vector_bytes"] / max(info["index_bytes"], 1), 2)
 
-        # each line represents on chunk of text + its metadata(doc_name and id)
-        # the errors="replace" lets us replace really weird chars(happens in these kind of docs)
-        with open(out / "chunks.jsonl", "w", encoding="utf-8", errors="replace") as f:
-            for record in chunk_records:
-                # dont ensure ascii we might have different languages or math/greek letters
-                f.write(json.dumps(record, ensure_ascii=False) + "\n") 
-
-# expose the class so it can be accessed in ingest.py
-def save_index_chunk(vectors, chunk_records, out_dir: str = "data"):
-    return StoreKnowledge.save_index_chunk(vectors, chunk_records, out_dir)
+        # the full vectors only make sense next to an index that doesnt have them already
+        stale_vectors = out / VECTORS_NAME
+        if info["rerank"]:
+            info["vectors_bytes"] = save_vectors(vectors, out)
+        elif stale_vectors.exists():
+            stale_vectors.unlink()
+        save_info(info, out)
 
+        # chunk text + metadata (doc_name and id) in one columnar file that loads with mmap
+        if isinstance(chunk_records, ChunkMetaWriter):
+            chunk_records.finish(str(out / CHUNKS_NAME))
+        else:
+            write_chunk_meta(str(out / CHUNKS_NAME), chunk_records)
 
+        # a chunks.jsonl from an older build in the same folder is stale now
+        legacy = out / LEGACY_CHUNKS_NAME
+        if legacy.exists():
+            legacy.unlink()
 
+        return info
 
+def remove_index_files(out_dir: str):
+    """delete every file of the build in out_dir (index or shards, chunks, vectors, delta)"""
+    out = Path(out_dir)
+    if not out.exists():
+        return
+    for name in (INDEX_NAME, CHUNKS_NAME, LEGACY_CHUNKS_NAME, VECTORS_NAME, INFO_NAME):
+        if (out / name).exists():
+            (out / name).unlink()
+    remove_stale_shards(str(out), set())
+    remove_delta(str(out))
 
+# expose the class so it can be accessed in ingest.py
+def save_index_chunk(vectors, chunk_records, out_dir: str = "data", index_type: str = "auto",
+                     embedding: dict | None = None, compression: str = "none", keep_vectors: bool = False,
+                     shard_rows: int | None = None):
+    return StoreKnowledge.save_index_chunk(vectors, chunk_records, out_dir, index_type, embedding,
+                                           compression, keep_vectors, shard_rows)
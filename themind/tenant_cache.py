@@ -0,0 +1,137 @@
+# keeps loaded tenant stores in memory between requests
+# loading a store means faiss.read_index + parsing all the chunk metadata, doing that
+# on every /ask was most of our latency so we keep them around in a small LRU
+
+# every entry carries a version token (for us ETag/LastModified of the index files)
+# so when a tenant re-ingests we notice on the next check and reload
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class _Entry:
+    def __init__(self, value, version, nbytes: int):
+        self.value = value
+        self.version = version
+        self.nbytes = nbytes
+        self.checked_at = time.monotonic()
+
+
+class TenantCache:
+    """LRU of loaded tenant pipelines bounded by an approximate memory budget"""
+
+    def __init__(self, max_bytes: int = 1024 * 1024 * 1024, check_interval: float = 5.0):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval # seconds between freshness checks per tenant
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock() # guards _entries and the counters
+        self._key_locks: dict = {} # key -> [lock, threads using it], so cold loads happen once
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+
+    @contextmanager
+    def _key_lock(self, key):
+        # a tenant's lock only exists while someone holds or waits for it, otherwise
+        # every tenant we ever served would leave one behind
+        with self._lock:
+            slot = self._key_locks.get(key)
+            if slot is None:
+                slot = self._key_locks[key] = [threading.Lock(), 0]
+            slot[1] += 1
+        try:
+            with slot[0]:
+                yield
+        finally:
+            with self._lock:
+                slot[1] -= 1
+                if not slot[1]:
+                    del self._key_locks[key]
+
+    def get(self, key, fingerprint_fn, load_fn):
+        """return the cached value for key, loading or reloading it if needed
+
+        fingerprint_fn() -> version token, should be cheap (one S3 listing)
+        load_fn(version) -> (value, nbytes)
+        """
+        # fast path, recently checked entry -> no S3 call at all
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.value
+
+        # everyone asking for the same tenant queues here, the first one does the work
+        # and the rest find a fresh entry when they get the lock
+        with self._key_lock(key):
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and time.monotonic() - entry.checked_at < self.check_interval:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry.value
+
+            version = fingerprint_fn()
+            if entry is not None and entry.version == version:
+                with self._lock:
+                    entry.checked_at = time.monotonic()
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return entry.value
+
+            value, nbytes = load_fn(version)
+            with self._lock:
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.reloads += 1
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.used_bytes -= old.nbytes
+                self._entries[key] = _Entry(value, version, nbytes)
+                self.used_bytes += nbytes
+                self._evict()
+            return value
+
+    def _evict(self):
+        # drop least recently used tenants until we fit, always keep the newest one
+        # even if it alone is over budget otherwise we would reload it every request
+        while self.used_bytes > self.max_bytes and len(self._entries) > 1:
+            _, old = self._entries.popitem(last=False)
+            self.used_bytes -= old.nbytes
+            self.evictions += 1
+
+    def version(self, key):
+        """version token of the currently loaded entry or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.version if entry is not None else None
+
+    def items(self) -> list[tuple]:
+        """(key, value, version) of every loaded entry, least recently used first"""
+        with self._lock:
+            return [(key, entry.value, entry.version) for key, entry in self._entries.items()]
+
+    def invalidate(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.used_bytes -= old.nbytes
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tenants": len(self._entries),
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reloads": self.reloads,
+                "evictions": self.evictions,
+            }
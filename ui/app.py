@@ -1,10 +1,12 @@
 # this will be used for the streamlit frontend
 # streamlit is a great to build interactive web UIs in python quickly
 
+import json
 import requests
 import streamlit as st
 import os
 import sys
+import time
 import boto3
 from pathlib import Path
 from datetime import datetime, timezone
@@ -33,6 +35,14 @@ user_id = "default_user" # figure it out later with authentication
 BUCKET = st.secrets["S3_BUCKET_NAME"]
 APP_ENV = st.secrets["APP_ENV"]
 
+def document_request(action: str, key: str) -> requests.Response:
+    # /documents/upsert or /documents/remove, the backend only takes the file name under docs/
+    return requests.post(
+        f"{BACKEND_URL}/documents/{action}",
+        json={"user_id": user_id, "env": APP_ENV, "doc_name": key.rsplit("/", 1)[-1]},
+        timeout=120,
+    )
+
 if "uploader_key" not in st.session_state: # do this so that files dont keep getting reuploaded all the time
     st.session_state.uploader_key = 0
 
@@ -48,33 +58,56 @@ if "indexed_files" not in st.session_state: # mini dictionary by streamlit to re
 if uploaded_files and st.button("Upload to S3"):
     # save file to docs
     ts = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+    failed = False
     for uploaded_file in uploaded_files:
         key = f"{APP_ENV}/users/{user_id}/docs/{ts}-{uploaded_file.name}"
 
     
         s3.upload_fileobj(uploaded_file, BUCKET, key)
         st.success(f"Uploaded to S3: {key}")
+        # searchable right away, no full ingest needed (409 = no index yet, Ingest builds it)
+        r = document_request("upsert", key)
+        if not r.ok and r.status_code != 409:
+            st.error(f"Indexing {key} failed: {r.status_code} {r.text}")
+            failed = True
 
     # now reset uploader so files dont appear and dont re run on reupload
     st.session_state.uploader_key += 1
-    st.rerun() # have it rerun so it resets nicely from the top
+    if not failed: # otherwise keep the errors on screen, Ingest picks those docs up later
+        st.rerun() # have it rerun so it resets nicely from the top
 
 
 st.caption(f"Indexed files: {st.session_state.indexed_files}")
 
 if st.button("Ingest docs from the S3"):
     try:
+        # the backend only queues the ingest and gives us a job id, then we poll it
         r = requests.post(
             f"{BACKEND_URL}/ingest",
             json={"user_id": user_id, "env": APP_ENV},
-            timeout=300, # gave loads of time since render is garbage on free version
+            timeout=30,
         )
-        if r.ok:
-            st.success("Ingestion triggered on backend")
-            st.session_state.pop("file_uploader", None)
-            st.session_state.uploaded_files = []
-        else:
+        if not r.ok:
             st.error(f"Ingest failed: {r.status_code} {r.text}")
+        else:
+            job_id = r.json()["job_id"]
+            with st.status("Ingesting...", expanded=True) as status:
+                line = st.empty()
+                while True:
+                    job = requests.get(f"{BACKEND_URL}/ingest/{job_id}", timeout=30).json()
+                    p = job["progress"]
+                    line.write(f"{job['stage']}: {p.get('docs_done', 0)}/{p.get('docs_total', '?')} docs, "
+                               f"{p.get('chunks_done', 0)} chunks")
+                    if job["state"] in ("succeeded", "failed"):
+                        break
+                    time.sleep(2)
+            if job["state"] == "succeeded":
+                status.update(label="Ingestion finished", state="complete")
+                st.session_state.pop("file_uploader", None)
+                st.session_state.uploaded_files = []
+            else:
+                status.update(label="Ingestion failed", state="error")
+                st.error(job["error"])
     except Exception as e:
         st.error(f"Could not reach backend: {e}")
     
@@ -101,11 +134,17 @@ with st.expander("Docs in S3", expanded=False):
     select = st.multiselect("Select docs to delete", docs, key="delete_docs_select")
     if st.button("Delete selected docs", type="secondary"):
         if select:
-            s3.delete_objects(
-                    Bucket=BUCKET,
-                    Delete={"Objects": [{"Key": k} for k in select]}
-            )
-            st.success(f"Deleted {len(select)} doc(s). Refresh the page to see the changes.")
+            # the backend drops the doc's vectors and deletes it from S3 in one go
+            deleted = 0
+            for k in select:
+                r = document_request("remove", k)
+                if r.status_code in (404, 409):
+                    s3.delete_object(Bucket=BUCKET, Key=k) # never made it into the index, nothing to drop
+                elif not r.ok:
+                    st.error(f"Deleting {k} failed: {r.status_code} {r.text}")
+                    continue
+                deleted += 1
+            st.success(f"Deleted {deleted} doc(s). Refresh the page to see the changes.")
         else:
             st.info("Pick at least one object.")
 
@@ -137,44 +176,57 @@ with st.expander("index files in S3", expanded=False):
 question = st.text_input(label="Ask a question:")
 
 if st.button("Ask") and question.strip(): # if question was empty all whitespace is removed and it returns False
-    response = requests.post(
-    f"{BACKEND_URL}/ask",
-    json={
-        "question": question.strip(),
-        "user_id": user_id,
-        "env": APP_ENV,
-    },
-    timeout=10,
-)
-    # backend failed, lets see what it said
-    if response.status_code != 200:
-        st.error(f"backend returned {response.status_code}")
-        st.code(response.text)
-    # backend ok but json, so can you show raw
-    elif "application/json" not in response.headers.get("content-type", ""):
-        st.error("backend did not return json")
-        st.code(response.text)
-    else:
-        # this was a good path
-        data = response.json() # parse the raw response body as JSON and get python dict object
-
-        # write the section for answer and default it to empty
-        st.subheader("Answer")
-        st.write(data.get("answer", ""))
-
-        # write the sources section 
-        st.subheader("Sources")
-        for src in data.get("sources", []):
-            # since we are currently using L2 distance a lower score -> means closer meaning
-            # if we were to use cosine similarity a higher score would be better
-            score = src.get("score", None)
-            if score is not None:
-                st.write(f"{src['doc_name']}#{src['chunk_id']} (score={round(score,3)})")
-            else:
-                st.write(f"{src['doc_name']}#{src['chunk_id']}")
-
-        # if we dont know the latency just put ?
-        st.caption(f"Latency: {data.get('latency_ms', '?')}ms")
-
+    sources: list[dict] = []
+    timing: dict = {}
+
+    # the answer comes in as server-sent events so we can show words as the LLM writes them
+    # timeout is (connect, between bytes) so a long answer doesnt trip it as long as tokens keep coming
+    def stream_answer():
+        with requests.post(
+            f"{BACKEND_URL}/ask/stream",
+            json={
+                "question": question.strip(),
+                "user_id": user_id,
+                "env": APP_ENV,
+            },
+            stream=True,
+            timeout=(10, 60),
+        ) as response:
+            # backend failed, lets see what it said
+            if response.status_code != 200:
+                st.error(f"backend returned {response.status_code}")
+                st.code(response.text)
+                return
+
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    data = json.loads(line[len("data:"):])
+                    if event == "sources":
+                        sources.extend(data.get("sources", []))
+                    elif event == "token":
+                        yield data.get("text", "")
+                    elif event == "done":
+                        timing.update(data)
+                    elif event == "error":
+                        st.error(f"backend error: {data.get('error')}")
+
+    # write the section for answer
+    st.subheader("Answer")
+    st.write_stream(stream_answer())
+
+    # write the sources section 
+    st.subheader("Sources")
+    for src in sources:
+        # since we are currently using L2 distance a lower score -> means closer meaning
+        # if we were to use cosine similarity a higher score would be better
+        score = src.get("score", None)
+        if score is not None:
+            st.write(f"{src['doc_name']}#{src['chunk_id']} (score={round(score,3)})")
+        else:
+            st.write(f"{src['doc_name']}#{src['chunk_id']}")
 
-        
\ No newline at end of file
+    # if we dont know the latency just put ?
+    st.caption(f"Latency: {timing.get('latency_ms', '?')}ms (first words after {timing.get('ttfb_ms', '?')}ms)")